@@ -0,0 +1,118 @@
+"""
+Time to build and serialise a chat session read from the database, validated with
+`ChatSession(**doc)` against the trusted, lazily decoded `ChatSession.from_trusted(doc)`,
+and to turn it into the chat history of the agent.
+
+Run from the repository root:
+
+   python -m benchmarks.chat_session_loading --num-messages 500
+"""
+
+
+import copy
+import time
+import argparse
+from typing import Any, Callable, Dict
+
+from src.db_handlers.schemas import (
+   ChatSession,
+   FeedbackLabel,
+   Message,
+   MessageCreatorRole,
+   SourceNodeWithScore,
+   User,
+   UserFeedback,
+)
+from src.utils import convert_db_messages_to_chatbot_messages
+
+
+def make_session_doc(num_messages: int, num_sources: int) -> Dict[str, Any]:
+   """Document shaped like the ones `MongoHandler` writes, with sources and feedback."""
+   user = User(email="user@example.com")
+   session = ChatSession(chat_session_id="session", name="benchmark", bot_id="bot", user=user)
+   for i in range(num_messages):
+       role = MessageCreatorRole.USER if i % 2 == 0 else MessageCreatorRole.ASSISTANT
+       message = Message.from_role(
+           role=role,
+           text=f"message {i} " * 40,
+           source_nodes=[
+               SourceNodeWithScore(node_id=f"node-{i}-{j}", url=f"https://example.com/{j}", score=0.5)
+               for j in range(num_sources)
+           ] if role == MessageCreatorRole.ASSISTANT else None,
+       )
+       if i % 10 == 1:
+           message.feedbacks.append(UserFeedback(user=user, feedback_label=FeedbackLabel.LIKED))
+       session.messages.append(message)
+   doc = session.model_dump(mode="json")
+   doc["_id"] = doc["chat_session_id"]
+   return doc
+
+
+def best_of(fn: Callable[[], Any], repeat: int) -> float:
+   best = float("inf")
+   for _ in range(repeat):
+       start = time.perf_counter()
+       fn()
+       best = min(best, time.perf_counter() - start)
+   return best
+
+
+def run(args: argparse.Namespace) -> None:
+   doc = make_session_doc(args.num_messages, args.num_sources)
+   # documents are fresh from the driver on every read
+   docs = [copy.deepcopy(doc) for _ in range(args.repeat)]
+
+   def load_all(build: Callable[[Dict[str, Any]], ChatSession]) -> Callable[[], None]:
+       def load() -> None:
+           for session_doc in docs:
+               build(session_doc)
+       return load
+
+   def access_all(build: Callable[[Dict[str, Any]], ChatSession]) -> Callable[[], None]:
+       def access() -> None:
+           for session_doc in docs:
+               for message in build(session_doc).messages:
+                   message.text
+       return access
+
+   def history_all(build: Callable[[Dict[str, Any]], ChatSession]) -> Callable[[], None]:
+       def history() -> None:
+           for session_doc in docs:
+               convert_db_messages_to_chatbot_messages(build(session_doc).messages)
+       return history
+
+   def serialise_all(build: Callable[[Dict[str, Any]], ChatSession]) -> Callable[[], None]:
+       def serialise() -> None:
+           for session_doc in docs:
+               build(session_doc).model_dump(mode="json")
+       return serialise
+
+   validated = lambda session_doc: ChatSession(**session_doc)
+   trusted = ChatSession.from_trusted
+
+   assert validated(doc).model_dump(mode="json") == trusted(doc).model_dump(mode="json")
+   assert list(validated(doc).messages) == list(trusted(doc).messages)
+
+   print(f"{args.num_messages} messages, best of {args.rounds} rounds, ms per session:")
+   steps = (
+       ("load", load_all),
+       ("load+access", access_all),
+       ("load+history", history_all),
+       ("load+serialise", serialise_all),
+   )
+   for name, make_step in steps:
+       validated_ms = 1000 * best_of(make_step(validated), args.rounds) / args.repeat
+       trusted_ms = 1000 * best_of(make_step(trusted), args.rounds) / args.repeat
+       print(
+           f"{name:>15}: validated={validated_ms:8.3f} trusted={trusted_ms:8.3f} "
+           f"speedup={validated_ms / trusted_ms:6.1f}x"
+       )
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description=__doc__)
+   parser.add_argument("--num-messages", type=int, default=500)
+   parser.add_argument("--num-sources", type=int, default=5)
+   parser.add_argument("--repeat", type=int, default=20)
+   parser.add_argument("--rounds", type=int, default=5)
+   run(parser.parse_args())
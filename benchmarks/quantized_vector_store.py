@@ -0,0 +1,85 @@
+"""
+Recall@k, memory and latency of `QuantizedVectorStore` against exact float32 search.
+
+Run from the repository root:
+
+   python -m benchmarks.quantized_vector_store --num-vectors 100000 --dim 1536
+"""
+
+
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from src.vector_stores import QuantizedVectorStore, QuantizationType
+from src.vector_stores.utils import normalize_rows, top_k_indices
+
+
+def make_corpus(num_vectors: int, dim: int, num_clusters: int, seed: int = 0) -> np.ndarray:
+   """Clustered synthetic embeddings, closer to real text embeddings than pure noise."""
+   rng = np.random.default_rng(seed)
+   centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+   assignments = rng.integers(0, num_clusters, num_vectors)
+   noise = 0.5 * rng.standard_normal((num_vectors, dim)).astype(np.float32)
+   return normalize_rows(centers[assignments] + noise)
+
+
+def run(args: argparse.Namespace) -> None:
+   corpus = make_corpus(args.num_vectors, args.dim, args.num_clusters)
+   queries = make_corpus(args.num_queries, args.dim, args.num_clusters, seed=1)
+
+   exact_start = time.perf_counter()
+   ground_truth = [set(top_k_indices(corpus @ q, args.top_k).tolist()) for q in queries]
+   exact_latency_ms = 1000 * (time.perf_counter() - exact_start) / len(queries)
+   print(
+       f"exact float32: memory={corpus.nbytes / 2**20:.1f}MiB "
+       f"latency={exact_latency_ms:.2f}ms/query"
+   )
+
+   for quantization in (QuantizationType.INT8, QuantizationType.PQ):
+       for rescore_factor in args.rescore_factors:
+           with tempfile.TemporaryDirectory() as persist_dir:
+               store = QuantizedVectorStore(
+                   persist_dir=persist_dir,
+                   quantization=quantization,
+                   rescore_factor=rescore_factor,
+                   pq_subvectors=args.pq_subvectors,
+               )
+               for start in range(0, len(corpus), 10000):
+                   store.add([
+                       TextNode(id_=str(i), text="", embedding=corpus[i].tolist())
+                       for i in range(start, min(start + 10000, len(corpus)))
+                   ])
+
+               hits = 0
+               query_start = time.perf_counter()
+               for query, expected in zip(queries, ground_truth):
+                   result = store.query(VectorStoreQuery(
+                       query_embedding=query.tolist(), similarity_top_k=args.top_k
+                   ))
+                   hits += len(expected & {int(node_id) for node_id in result.ids})
+               latency_ms = 1000 * (time.perf_counter() - query_start) / len(queries)
+
+               stats = store.memory_stats()
+               print(
+                   f"{quantization.value:>4} rescore={rescore_factor:<3} "
+                   f"recall@{args.top_k}={hits / (args.top_k * len(queries)):.3f} "
+                   f"memory={stats['in_memory_bytes'] / 2**20:.1f}MiB "
+                   f"latency={latency_ms:.2f}ms/query"
+               )
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description=__doc__)
+   parser.add_argument("--num-vectors", type=int, default=50000)
+   parser.add_argument("--num-queries", type=int, default=100)
+   parser.add_argument("--dim", type=int, default=1536)
+   parser.add_argument("--num-clusters", type=int, default=200)
+   parser.add_argument("--top-k", type=int, default=10)
+   parser.add_argument("--pq-subvectors", type=int, default=96)
+   parser.add_argument("--rescore-factors", type=int, nargs="+", default=[1, 4, 16])
+   run(parser.parse_args())
@@ -0,0 +1,89 @@
+"""
+Frames, bytes and correctness of the `raw` and `json` server-sent event formats
+for a simulated token stream.
+
+Run from the repository root:
+
+   python -m benchmarks.sse_framing --num-tokens 500 --token-interval-ms 20
+"""
+
+
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import AsyncIterator, List
+
+from src.sse import DELTA_EVENT, json_event_stream, raw_event_stream
+
+
+WORDS = ["the", "index", "returns", "nodes", "with\nnewlines", "and", "`code`", "données", "{json}"]
+
+
+def make_tokens(num_tokens: int, seed: int = 0) -> List[str]:
+   rng = random.Random(seed)
+   return [rng.choice(WORDS) + " " for _ in range(num_tokens)]
+
+
+async def paced(tokens: List[str], interval_seconds: float) -> AsyncIterator[str]:
+   for token in tokens:
+       await asyncio.sleep(interval_seconds)
+       yield token
+
+
+def parse_json_deltas(frames: List[str]) -> str:
+   text = []
+   for frame in frames:
+       lines = frame.rstrip("\n").split("\n")
+       if lines[0] == f"event: {DELTA_EVENT}":
+           text.append(json.loads(lines[1][len("data: "):])["text"])
+   return "".join(text)
+
+
+def parse_raw_tokens(frames: List[str]) -> str:
+   # what an SSE client reads: every `data:` line of the event, joined by newlines
+   text = []
+   for frame in frames[1:]:
+       lines = [line for line in frame.rstrip("\n").split("\n") if line.startswith("data: ")]
+       text.append("\n".join(line[len("data: "):] for line in lines))
+   return "".join(text)
+
+
+async def measure(name: str, events: AsyncIterator[str], expected: str, parse) -> None:
+   start = time.perf_counter()
+   frames = [frame async for frame in events]
+   elapsed = time.perf_counter() - start
+   print(
+       f"{name:>5}: frames={len(frames):<5} bytes={sum(len(f.encode('utf-8')) for f in frames):<7} "
+       f"elapsed={elapsed:.2f}s text_intact={parse(frames) == expected}"
+   )
+
+
+async def run(args: argparse.Namespace) -> None:
+   tokens = make_tokens(args.num_tokens)
+   expected = "".join(tokens)
+   interval = args.token_interval_ms / 1000
+   resources = ["https://example.com/docs"]
+
+   await measure("raw", raw_event_stream(resources, paced(tokens, interval)), expected, parse_raw_tokens)
+   await measure(
+       "json",
+       json_event_stream(
+           resources,
+           paced(tokens, interval),
+           window_seconds=args.coalesce_ms / 1000,
+           max_chars=args.coalesce_chars,
+       ),
+       expected,
+       parse_json_deltas,
+   )
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description=__doc__)
+   parser.add_argument("--num-tokens", type=int, default=500)
+   parser.add_argument("--token-interval-ms", type=float, default=5)
+   parser.add_argument("--coalesce-ms", type=float, default=50)
+   parser.add_argument("--coalesce-chars", type=int, default=256)
+   asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,71 @@
+"""
+Import time and resident memory of a fresh interpreter importing the server, against
+the same import plus the modules it now defers (document readers and parsers, chromadb
+and the Mongo docstore and index store), which is what every process paid before.
+
+Each measurement runs in its own interpreter. Run from the repository root:
+
+   python -m benchmarks.startup_time --repeat 5
+"""
+
+
+import sys
+import json
+import argparse
+import subprocess
+from typing import Dict, List
+
+
+DEFERRED_MODULES = [
+   "src.doc_readers.github_reader.github_reader",
+   "src.doc_readers.confluence_reader.confluence_reader",
+   "src.doc_readers.local_reader.local_directory_reader",
+   "chromadb",
+   "llama_index.vector_stores.chroma",
+   "llama_index.storage.docstore.mongodb",
+   "llama_index.storage.index_store.mongodb",
+]
+
+
+MEASURE = """
+import sys, json, time, resource, importlib
+start = time.perf_counter()
+for name in sys.argv[1:]:
+   importlib.import_module(name)
+seconds = time.perf_counter() - start
+# kilobytes on linux
+rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({"seconds": seconds, "rss_mb": rss_mb}))
+"""
+
+
+def measure(modules: List[str]) -> Dict[str, float]:
+   result = subprocess.run(
+       [sys.executable, "-c", MEASURE, *modules], capture_output=True, text=True, check=True
+   )
+   return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run(args: argparse.Namespace) -> None:
+   scenarios = {
+       "baseline interpreter": [],
+       "lazy (server)": [args.module],
+       "eager (server + deferred)": [args.module, *DEFERRED_MODULES],
+   }
+   print(f"best of {args.repeat} fresh interpreters:")
+   for name, modules in scenarios.items():
+       try:
+           runs = [measure(modules) for _ in range(args.repeat)]
+       except subprocess.CalledProcessError as e:
+           print(f"{name:>26}: import failed: {e.stderr.strip().splitlines()[-1]}")
+           continue
+       seconds = min(sample["seconds"] for sample in runs)
+       rss_mb = min(sample["rss_mb"] for sample in runs)
+       print(f"{name:>26}: import={1000 * seconds:8.1f}ms max_rss={rss_mb:8.1f}MB")
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description=__doc__)
+   parser.add_argument("--module", type=str, default="server", help="module imported at startup")
+   parser.add_argument("--repeat", type=int, default=5)
+   run(parser.parse_args())
@@ -1,9 +1,9 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field
 
 from llama_index.core.chat_engine.types import AgentChatResponse
 
-from src.db_handlers.schemas import CrawlResource, RagBot, SourceNodeWithScore, User
+from src.db_handlers.schemas import CrawlResource, FeedbackLabel, RagBot, RagBotPage, SourceNodeWithScore, User
 from src.db_handlers.schemas import BotIndex
 
 
@@ -46,6 +46,17 @@ class ChatBotOutput(BaseModel):
        )
 
 
+class ChatBotPageOutput(BaseModel):
+   items: List[ChatBotOutput]
+   next_after: Optional[str] = Field(
+       default=None, description="Pass as `after` to get the next page; unset on the last page"
+   )
+
+   @classmethod
+   def from_page(cls, page: RagBotPage) -> "ChatBotPageOutput":
+       return cls(items=[ChatBotOutput(bot) for bot in page.items], next_after=page.next_after)
+
+
 class BotNameUpdateResponse(BaseModel):
    status: bool
    message: Optional[str] = None
@@ -68,8 +79,23 @@ class InsertChatMessageFeedbackResponse(BaseModel):
    status: bool
 
 
+class ChatMessageFeedbackRequest(BaseModel):
+   message_id: str
+   comment: Optional[str] = None
+   label: Optional[FeedbackLabel] = None
+
+
+class InsertChatMessageFeedbacksResponse(BaseModel):
+   status: Dict[str, bool] = Field(description="Whether the feedback of each message id was inserted")
+
+
 class ChatRequest(BaseModel):
    query: str
+
+
+class LiveChatRequest(BaseModel):
+   type: str = Field(default="query", description="`query` to ask, `cancel` to stop the current answer")
+   query: Optional[str] = None
   
 
 class ChatResponse(BaseModel):
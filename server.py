@@ -1,47 +1,44 @@
+import os
 import time
 import uuid
+import asyncio
 import argparse
+from contextlib import asynccontextmanager
+from typing import Any, Callable
+
 import uvicorn
-from fastapi import FastAPI, status, Request
+from fastapi import APIRouter, Depends, FastAPI, status, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.requests import HTTPConnection
 from fastapi.responses import StreamingResponse
 from fastapi import HTTPException
 
 from io_schemas import *
 from src import config
 from src.chat_bot_manager import ChatBotManager
+from src.clients import close_clients
+from src.concurrency import (
+   AdmissionController, AdmissionRejected, AdmissionTicket, shutdown_chat_executor
+)
 from src.db_handlers.schemas import BotConfig, FeedbackLabel, RagBot, User
+from src.live_chat import ChatUnavailable, LiveChatSession
 from src.logger import CustomLogger
+from src.metrics import metrics
+from src.placement import current_placement
+from src.sse import STREAM_FORMATS
 from version import VERSION
 
 
 logger = CustomLogger(__name__)
 
 
-# Read config and env file paths from command line arguments
-parser = argparse.ArgumentParser(description='Chat Cohorts Application')
-parser.add_argument(
-   '--config',
-   type=str,
-   help='config file path',
-   default="configs/dev.config.json",
-)
-parser.add_argument('--env', type=str, help='env file path', default=".env")
+DEFAULT_CONFIG_PATH = "configs/dev.config.json"
+DEFAULT_ENV_PATH = ".env"
 
 
-args = parser.parse_args()
+router = APIRouter()
 
 
-# Load config and env files
-config.load_config(
-   app_version=VERSION,
-   config_json_path=args.config,
-   env_path=args.env
-)
-
-app = FastAPI()
-chatbot_manager= ChatBotManager()
-
 """
 APIs to implement:
 1. Create a new chatbot (given a config file containing list of resources, \
@@ -62,16 +59,77 @@ APIs to implement:
 """
 
 
-app.add_middleware(
-   CORSMiddleware,
-   allow_origins=["*"],  # Allow all origins (You can adjust this based on your requirements)
-   allow_credentials=True,
-   allow_methods=["GET", "POST", "PUT", "DELETE"],  # Allow specific HTTP methods
-   allow_headers=["*"],  # Allow all headers (You can adjust this based on your requirements)
-)
+def get_chatbot_manager(connection: HTTPConnection) -> ChatBotManager:
+   return connection.app.state.chatbot_manager
+
+
+def get_admission_controller(connection: HTTPConnection) -> AdmissionController:
+   return connection.app.state.admission_controller
+
+
+async def prewarm(app: FastAPI):
+   """
+   Loads the most active bots and marks the app ready once they are loaded, or once
+   `PrewarmTimeoutSeconds` have passed; loading then carries on in the background.
+   """
+   startup_cfg = config.startup_cfg
+   # with bot placement, a worker only loads the bots it owns
+   placement = current_placement()
+   prewarm_task = None
+   try:
+       if startup_cfg.PrewarmBots > 0:
+           prewarm_task = asyncio.create_task(app.state.chatbot_manager.prewarm(
+               top_k=startup_cfg.PrewarmBots,
+               lookback_hours=startup_cfg.PrewarmLookbackHours,
+               concurrency=startup_cfg.PrewarmConcurrency,
+               owns=placement.owns if placement is not None else None,
+           ))
+           done, _ = await asyncio.wait({prewarm_task}, timeout=startup_cfg.PrewarmTimeoutSeconds)
+           if not done:
+               logger.warning(
+                   message="prewarming timed out, reporting ready",
+                   fields={"timeout_seconds": startup_cfg.PrewarmTimeoutSeconds},
+               )
+           elif prewarm_task.exception() is not None:
+               logger.error(
+                   message="failed to prewarm bots",
+                   fields={"error": str(prewarm_task.exception())},
+               )
+       app.state.ready.set()
+       if prewarm_task is not None:
+           await asyncio.gather(prewarm_task, return_exceptions=True)
+   finally:
+       if prewarm_task is not None:
+           prewarm_task.cancel()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+   # storage context, db handler and caches live as long as the worker serving the app
+   app.state.chatbot_manager = ChatBotManager()
+   app.state.admission_controller = AdmissionController(
+       max_concurrent=config.admission_cfg.MaxConcurrentChats,
+       max_concurrent_per_bot=config.admission_cfg.MaxConcurrentChatsPerBot,
+       max_queue=config.admission_cfg.MaxQueuedChats,
+       queue_timeout_seconds=config.admission_cfg.QueueTimeoutSeconds,
+   )
+   if config.startup_cfg.WarmupStores:
+       await asyncio.to_thread(app.state.chatbot_manager.warmup)
+   # set by `prewarm`, requests are served before that but `/readiness` fails
+   app.state.ready = asyncio.Event()
+   prewarm_task = asyncio.create_task(prewarm(app))
+   logger.info(message="started worker", fields={"pid": os.getpid()})
+   try:
+       yield
+   finally:
+       prewarm_task.cancel()
+       await asyncio.gather(prewarm_task, return_exceptions=True)
+       app.state.chatbot_manager.close()
+       shutdown_chat_executor()
+       await close_clients()
+       logger.info(message="stopped worker", fields={"pid": os.getpid()})
 
 
-@app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
    start_time = time.time()
    # Generate a unique request ID
@@ -86,13 +144,96 @@ async def add_process_time_header(request: Request, call_next):
    return response
 
 
-@app.get("/healthcheck")
+def create_app(config_path: str, env_path: str) -> FastAPI:
+   """
+   Loads the config and env files and builds the app. Nothing is connected until the
+   app starts, so the factory is cheap to call in every worker and in tests.
+   """
+   config.load_config(app_version=VERSION, config_json_path=config_path, env_path=env_path)
+   
+   app = FastAPI(lifespan=lifespan)
+   app.add_middleware(
+       CORSMiddleware,
+       allow_origins=["*"],  # Allow all origins (You can adjust this based on your requirements)
+       allow_credentials=True,
+       allow_methods=["GET", "POST", "PUT", "DELETE"],  # Allow specific HTTP methods
+       allow_headers=["*"],  # Allow all headers (You can adjust this based on your requirements)
+   )
+   app.middleware("http")(add_process_time_header)
+   app.include_router(router)
+   return app
+
+
+def create_app_from_env() -> FastAPI:
+   """Factory run by every worker process, with the file paths passed down by `main`."""
+   return create_app(
+       config_path=os.getenv(config.CONFIG_FILEPATH_ENV_VAR, DEFAULT_CONFIG_PATH),
+       env_path=os.getenv(config.ENV_FILEPATH_ENV_VAR, DEFAULT_ENV_PATH),
+   )
+
+
+class ClosingStreamingResponse(StreamingResponse):
+   """
+   Runs `on_close` once the response is over: sent, failed, or cut short by the client,
+   also when it left before the stream was first read and the stream never got to run
+   its own cleanup.
+   """
+   def __init__(self, content: Any, on_close: Callable[[], None], **kwargs: Any) -> None:
+       super().__init__(content, **kwargs)
+       self._on_close = on_close
+
+   async def __call__(self, scope, receive, send) -> None:
+       try:
+           await super().__call__(scope, receive, send)
+       finally:
+           self._on_close()
+
+
+async def admit_chat(
+   admission_controller: AdmissionController, request: Request, bot_id: str
+) -> AdmissionTicket:
+   try:
+       return await admission_controller.acquire(bot_id)
+   except AdmissionRejected as e:
+       logger.info(
+           message="chat rejected by admission control",
+           fields={
+               "request_id": request.state.request_id,
+               "bot_id": bot_id,
+               "reason": e.reason,
+           }
+       )
+       raise HTTPException(
+           status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+           detail="too many chats in progress, retry later",
+           headers={"Retry-After": str(e.retry_after)},
+       )
+
+
+@router.get("/healthcheck")
 def healthcheck():
    return HealthCheckResponse(status='ok')
 
 
-@app.post("/create_chatbot")
-async def create_chatbot(config: BotConfig, request: Request) -> CreateChatBotOutput:
+@router.get("/readiness")
+def readiness(request: Request):
+   # load balancers hold traffic back until the most active bots are loaded
+   if not request.app.state.ready.is_set():
+       raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="prewarming")
+   return HealthCheckResponse(status='ready')
+
+
+@router.get("/metrics")
+def get_metrics():
+   return metrics.snapshot()
+
+
+@router.post("/create_chatbot")
+async def create_chatbot(
+   config: BotConfig,
+   request: Request,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+) -> CreateChatBotOutput:
    try:
        bot = await chatbot_manager.create_new_bot(config)
        return CreateChatBotOutput(bot)
@@ -107,8 +248,10 @@ async def create_chatbot(config: BotConfig, request: Request) -> CreateChatBotOu
        raise HTTPException(status_code=400)
 
 
-@app.get('/get_bot')
-def get_bot(bot_id: str, request: Request):
+@router.get('/get_bot')
+def get_bot(
+   bot_id: str, request: Request, chatbot_manager: ChatBotManager = Depends(get_chatbot_manager)
+):
    try:
        bot = chatbot_manager._db_handler.get_bot(bot_id)
        return ChatBotOutput(bot)
@@ -123,9 +266,17 @@ def get_bot(bot_id: str, request: Request):
        raise HTTPException(status_code=404, detail="bot not found")
 
 
-@app.get("/get_all_bots")
-def get_all_bots(request: Request):
+@router.get("/get_all_bots")
+def get_all_bots(
+   request: Request,
+   limit: Optional[int] = None,
+   after: Optional[str] = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+):
    try:
+       if limit is not None:
+           page = chatbot_manager._db_handler.list_bots(limit=limit, after=after)
+           return ChatBotPageOutput.from_page(page)
        bots: RagBot = chatbot_manager._db_handler.get_all_bots()
        bots_output = [ChatBotOutput(bot) for bot in bots]
        return bots_output
@@ -140,9 +291,20 @@ def get_all_bots(request: Request):
        raise HTTPException(status_code=500)
 
 
-@app.get("/get_user_bots")
-def list_user_chatbots(user_email_id: str, request: Request):
+@router.get("/get_user_bots")
+def list_user_chatbots(
+   user_email_id: str,
+   request: Request,
+   limit: Optional[int] = None,
+   after: Optional[str] = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+):
    try:
+       if limit is not None:
+           page = chatbot_manager._db_handler.list_bots(
+               limit=limit, after=after, email=user_email_id
+           )
+           return ChatBotPageOutput.from_page(page)
        bots: RagBot = chatbot_manager._db_handler.get_user_bots(email=user_email_id)
        bots_output = [ChatBotOutput(bot) for bot in bots]
        return bots_output
@@ -157,8 +319,10 @@ def list_user_chatbots(user_email_id: str, request: Request):
        raise HTTPException(status_code=404, detail="user not found")
 
 
-@app.get("/new_chat_session_id")
-def new_chat_session_id(request: Request):
+@router.get("/new_chat_session_id")
+def new_chat_session_id(
+   request: Request, chatbot_manager: ChatBotManager = Depends(get_chatbot_manager)
+):
    try:
        chat_session_id = chatbot_manager._db_handler.new_chat_session_id()
        return GetChatSessionIdResponse(chat_session_id=chat_session_id)
@@ -173,7 +337,7 @@ def new_chat_session_id(request: Request):
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.post("/chat")
+@router.post("/chat")
 async def chat(
    request: Request,
    bot_id: str,
@@ -181,8 +345,11 @@ async def chat(
    request_body: ChatRequest,
    email: str,
    username: str = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+   admission_controller: AdmissionController = Depends(get_admission_controller),
 ):
    user_obj = User(email=email, username=username)
+   ticket = await admit_chat(admission_controller, request, bot_id)
    try:
        llm_response = await chatbot_manager.chat(
            user_query=request_body.query,
@@ -200,9 +367,11 @@ async def chat(
            }
        )
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+   finally:
+       admission_controller.release(ticket)
       
 
-@app.post("/stream_chat")
+@router.post("/stream_chat")
 async def stream_chat(
    request: Request,
    bot_id: str,
@@ -210,17 +379,39 @@ async def stream_chat(
    request_body: ChatRequest,
    email: str,
    username: str = None,
+   stream_format: Optional[str] = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+   admission_controller: AdmissionController = Depends(get_admission_controller),
 ):
+   if stream_format is not None and stream_format not in STREAM_FORMATS:
+       raise HTTPException(
+           status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+           detail=f"stream_format must be one of {', '.join(STREAM_FORMATS)}",
+       )
    user_obj = User(email=email, username=username)
+   ticket = await admit_chat(admission_controller, request, bot_id)
    try:
-       content_stream = await chatbot_manager.stream_chat(
+       content_stream, lease = await chatbot_manager.stream_chat(
            user_query=request_body.query,
            bot_id=bot_id,
            chat_session_id=chat_session_id,
            user=user_obj,
+           stream_format=stream_format,
+       )
+
+       def on_close() -> None:
+           # the stream releases both when it ends, but one never read can not
+           admission_controller.release(ticket)
+           if lease is not None:
+               lease.abandon()
+
+       return ClosingStreamingResponse(
+           admission_controller.hold(ticket, content_stream),
+           on_close=on_close,
+           media_type="text/event-stream",
        )
-       return StreamingResponse(content_stream, media_type="text/event-stream")
    except Exception as e:
+       admission_controller.release(ticket)
        logger.exception(
            message="failed to chat",
            fields={
@@ -231,9 +422,116 @@ async def stream_chat(
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.get("/get_all_chat_session")
-def get_all_chat_session(bot_id: str, request: Request):
+async def run_live_turn(
+   websocket: WebSocket,
+   live_session: LiveChatSession,
+   user_query: str,
+   chatbot_manager: ChatBotManager,
+   admission_controller: AdmissionController,
+) -> None:
+   try:
+       ticket = await admission_controller.acquire(live_session.bot.bot_id)
+   except AdmissionRejected as e:
+       await websocket.send_json({
+           "type": "error",
+           "message": "too many chats in progress, retry later",
+           "retry_after": e.retry_after,
+       })
+       return
+  
+   events = chatbot_manager.live_turn(live_session, user_query)
+   try:
+       async for event in events:
+           await websocket.send_json(event)
+   except Exception as e:
+       logger.exception(
+           message="failed to chat",
+           fields={
+               "chat_session_id": live_session.chat_session_id,
+               "error": str(e),
+           }
+       )
+       await websocket.send_json({"type": "error", "message": "failed to chat"})
+   finally:
+       await events.aclose()
+       admission_controller.release(ticket)
+
+
+@router.websocket("/ws/chat")
+async def live_chat(
+   websocket: WebSocket,
+   bot_id: str,
+   chat_session_id: str,
+   email: str,
+   username: str = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+   admission_controller: AdmissionController = Depends(get_admission_controller),
+):
+   """
+   Multi-turn chat over one connection. The client sends `{"query": "..."}` per turn,
+   or `{"type": "cancel"}` to stop the current answer, and receives `sources`, `delta`,
+   `done`, `cancelled` and `error` events as JSON.
+   """
+   await websocket.accept()
+   try:
+       live_session = await chatbot_manager.open_live_session(
+           bot_id=bot_id,
+           chat_session_id=chat_session_id,
+           user=User(email=email, username=username),
+       )
+   except ChatUnavailable as e:
+       await websocket.send_json({"type": "error", "message": str(e)})
+       await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+       return
+  
+   turn: Optional[asyncio.Task] = None
+   try:
+       while True:
+           try:
+               message = LiveChatRequest(**await websocket.receive_json())
+           except ValueError:
+               await websocket.send_json({"type": "error", "message": "invalid message"})
+               continue
+          
+           in_progress = turn is not None and not turn.done()
+           if message.type == "cancel":
+               if in_progress:
+                   turn.cancel()
+                   await asyncio.gather(turn, return_exceptions=True)
+                   await websocket.send_json({"type": "cancelled"})
+           elif in_progress:
+               await websocket.send_json({"type": "error", "message": "an answer is in progress"})
+           elif not message.query:
+               await websocket.send_json({"type": "error", "message": "query is required"})
+           else:
+               turn = asyncio.create_task(run_live_turn(
+                   websocket, live_session, message.query, chatbot_manager, admission_controller
+               ))
+   except WebSocketDisconnect:
+       logger.info(
+           message="live chat closed",
+           fields={"chat_session_id": chat_session_id, "turns": live_session.turns},
+       )
+   finally:
+       if turn is not None:
+           turn.cancel()
+           await asyncio.gather(turn, return_exceptions=True)
+       await live_session.close()
+
+
+@router.get("/get_all_chat_session")
+def get_all_chat_session(
+   bot_id: str,
+   request: Request,
+   limit: Optional[int] = None,
+   after: Optional[str] = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+):
    try:
+       if limit is not None:
+           return chatbot_manager._db_handler.list_chat_sessions(
+               bot_id=bot_id, limit=limit, after=after
+           )
        chat_sessions = chatbot_manager._db_handler.get_all_chat_session(bot_id=bot_id)
        return chat_sessions
    except Exception as e:
@@ -247,9 +545,20 @@ def get_all_chat_session(bot_id: str, request: Request):
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.post("/get_chat_session_by_user")
-def get_chat_session_by_user(bot_id: str, user: User, request: Request):
+@router.post("/get_chat_session_by_user")
+def get_chat_session_by_user(
+   bot_id: str,
+   user: User,
+   request: Request,
+   limit: Optional[int] = None,
+   after: Optional[str] = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+):
    try:
+       if limit is not None:
+           return chatbot_manager._db_handler.list_chat_sessions(
+               bot_id=bot_id, limit=limit, after=after, user=user
+           )
        chat_sessions = chatbot_manager._db_handler.get_user_sessions(
            bot_id=bot_id, user=user
        )
@@ -265,8 +574,13 @@ def get_chat_session_by_user(bot_id: str, user: User, request: Request):
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.get("/update_bot_name")
-def update_bot_name(bot_id: str, new_name: str, request: Request):
+@router.get("/update_bot_name")
+def update_bot_name(
+   bot_id: str,
+   new_name: str,
+   request: Request,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+):
    try:
        updated_bot = chatbot_manager._db_handler.update_bot_name(
            bot_id = bot_id, new_name= new_name
@@ -283,8 +597,13 @@ def update_bot_name(bot_id: str, new_name: str, request: Request):
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.get("/update_bot_description")
-def update_bot_description(bot_id: str, new_description: str, request: Request):
+@router.get("/update_bot_description")
+def update_bot_description(
+   bot_id: str,
+   new_description: str,
+   request: Request,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+):
    try:
        updated_bot = chatbot_manager._db_handler.update_bot_description(
            bot_id = bot_id, new_description= new_description
@@ -301,9 +620,13 @@ def update_bot_description(bot_id: str, new_description: str, request: Request):
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.get("/update_chat_session_name")
+@router.get("/update_chat_session_name")
 def update_chat_session_name(
-   bot_id: str, chat_session_id: str, new_name: str, request: Request
+   bot_id: str,
+   chat_session_id: str,
+   new_name: str,
+   request: Request,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
 ):
    try:
        updated_bot = chatbot_manager._db_handler.update_chat_session_name(
@@ -321,7 +644,7 @@ def update_chat_session_name(
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.post("/insert_chat_session_feedback")
+@router.post("/insert_chat_session_feedback")
 def insert_chat_session_feedback(
    bot_id: str,
    session_id: str,
@@ -329,6 +652,7 @@ def insert_chat_session_feedback(
    request: Request,
    comment: str = None,
    label: FeedbackLabel = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
 ):
    try:
        if comment is not None or label is not None:
@@ -357,7 +681,7 @@ def insert_chat_session_feedback(
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.post("/insert_chat_message_feedback")
+@router.post("/insert_chat_message_feedback")
 def insert_chat_message_feedback(
    bot_id: str,
    session_id: str,
@@ -366,6 +690,7 @@ def insert_chat_message_feedback(
    request: Request,
    comment: str = None,
    label: FeedbackLabel = None,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
 ):
    try:
        if comment or label is not None:
@@ -395,4 +720,99 @@ def insert_chat_message_feedback(
        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-uvicorn.run(app, host=config.app_cfg.Host, port=config.app_cfg.Port)
+@router.post("/insert_chat_message_feedbacks")
+def insert_chat_message_feedbacks(
+   bot_id: str,
+   session_id: str,
+   user: User,
+   feedbacks: List[ChatMessageFeedbackRequest],
+   request: Request,
+   chatbot_manager: ChatBotManager = Depends(get_chatbot_manager),
+):
+   if any(not feedback.comment and feedback.label is None for feedback in feedbacks):
+       raise HTTPException(
+           status_code=status.HTTP_400_BAD_REQUEST,
+           detail="at least one of comment or label should be provided for every message"
+       )
+   try:
+       inserted = chatbot_manager._db_handler.insert_message_feedbacks(
+           bot_id=bot_id,
+           chat_session_id=session_id,
+           user=user,
+           feedbacks=[
+               (
+                   feedback.message_id,
+                   feedback.comment,
+                   feedback.label if feedback.label is not None else FeedbackLabel.NOT_SET,
+               )
+               for feedback in feedbacks
+           ],
+       )
+       return InsertChatMessageFeedbacksResponse(status=inserted)
+   except Exception as e:
+       logger.exception(
+           message="failed to insert message feedbacks",
+           fields={
+               "request_id": request.state.request_id,
+               "error": str(e),
+           }
+       )
+       raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def main():
+   # Read config and env file paths from command line arguments
+   parser = argparse.ArgumentParser(description='Chat Cohorts Application')
+   parser.add_argument(
+       '--config',
+       type=str,
+       help='config file path',
+       default=DEFAULT_CONFIG_PATH,
+   )
+   parser.add_argument('--env', type=str, help='env file path', default=DEFAULT_ENV_PATH)
+   parser.add_argument(
+       '--workers',
+       type=int,
+       help='number of worker processes, defaults to `Workers` of the config file',
+       default=None,
+   )
+   args = parser.parse_args()
+   
+   config.load_config(app_version=VERSION, config_json_path=args.config, env_path=args.env)
+   # workers are separate processes and build their own app from the same files
+   os.environ[config.CONFIG_FILEPATH_ENV_VAR] = args.config
+   os.environ[config.ENV_FILEPATH_ENV_VAR] = args.env
+   workers = args.workers or config.app_cfg.Workers
+   
+   if config.placement_cfg.Enabled and workers > 1:
+       from src.placement.dispatcher import WorkerPool, create_dispatcher_app
+       
+       # the dispatcher listens on the app port and forwards to the owning worker
+       pool = WorkerPool(
+           app_factory="server:create_app_from_env",
+           socket_dir=config.placement_cfg.SocketDir,
+           num_workers=workers,
+           replicas=config.placement_cfg.Replicas,
+           health_check_seconds=config.placement_cfg.HealthCheckSeconds,
+           graceful_shutdown_seconds=config.app_cfg.GracefulShutdownSeconds,
+       )
+       uvicorn.run(
+           create_dispatcher_app(pool),
+           host=config.app_cfg.Host,
+           port=config.app_cfg.Port,
+           timeout_graceful_shutdown=config.app_cfg.GracefulShutdownSeconds,
+       )
+       return
+   
+   uvicorn.run(
+       "server:create_app_from_env",
+       factory=True,
+       host=config.app_cfg.Host,
+       port=config.app_cfg.Port,
+       workers=workers,
+       timeout_graceful_shutdown=config.app_cfg.GracefulShutdownSeconds,
+   )
+
+
+if __name__ == "__main__":
+   main()
@@ -5,7 +5,9 @@ from llama_index.core.storage import StorageContext
 
 from src.bots.chat_bot import ChatBot
 from src.bots.simple_openai_chat_bot import SimpleOpenAIChatBot
+from src.caches.index_cache import IndexCache
 from src.db_handlers.schemas import RagBot
+from src.indices import BM25IndexStore
 
 
 class BotType(str, Enum):
@@ -13,10 +15,19 @@ class BotType(str, Enum):
 
 
 def create_chat_bot(
-   bot: RagBot, storage_context: StorageContext, bot_type: Optional[BotType] = BotType.SimpleOpenAIChatBot
+   bot: RagBot,
+   storage_context: StorageContext,
+   bm25_store: Optional[BM25IndexStore] = None,
+   index_cache: Optional[IndexCache] = None,
+   bot_type: Optional[BotType] = BotType.SimpleOpenAIChatBot,
 ) -> ChatBot:
    if bot_type == BotType.SimpleOpenAIChatBot:
-       return SimpleOpenAIChatBot.from_memory_obj(memory_obj=bot, storage_context=storage_context)
+       return SimpleOpenAIChatBot.from_memory_obj(
+           memory_obj=bot,
+           storage_context=storage_context,
+           bm25_store=bm25_store,
+           index_cache=index_cache,
+       )
    else:
        raise NotImplementedError(f'Bot type {bot_type} not implemented')
   
@@ -12,7 +12,12 @@ from llama_index.core.chat_engine.types import (
 )
 from llama_index.core.base.llms.types import ChatMessage
 
-from src.db_handlers.schemas import CrawlResource, RagBot, BotIndex
+from src.db_handlers.schemas import (
+   CrawlResource, RagBot, BotIndex, NodePostProcessingConfig
+)
+from src.caches.index_cache import IndexCache
+from src.concurrency.cancellation import CancellationToken
+from src.indices import BM25IndexStore
 
 
 class ChatBot(ABC):
@@ -26,6 +31,10 @@ class ChatBot(ABC):
        storage_context: StorageContext,
        indexes: List[BotIndex],
        crawl_resources: List[CrawlResource],
+       bm25_store: Optional[BM25IndexStore] = None,
+       node_postprocessing: Optional[NodePostProcessingConfig] = None,
+       index_cache: Optional[IndexCache] = None,
+       nprobe: Optional[int] = None,
    ) -> None:
        self.bot_id = bot_id
        self._name = name
@@ -37,6 +46,13 @@ class ChatBot(ABC):
            idx.resource: idx.index_id for idx in indexes
        }
        self._indexes: List[VectorStoreIndex] = []
+       # set when hybrid retrieval is enabled
+       self._bm25_store = bm25_store
+       self._node_postprocessing = node_postprocessing
+       # partitions scanned per query when the vector store is an IVF store
+       self._nprobe = nprobe
+       # indexes loaded by earlier chat turns, shared by every bot of the process
+       self._index_cache = index_cache
       
        self.crawl_resources = crawl_resources
       
@@ -56,12 +72,19 @@ class ChatBot(ABC):
        raise NotImplementedError
   
    @abstractmethod
-   async def acreate_or_load_indexes(self) -> bool:
+   async def acreate_or_load_indexes(self, concurrency: int = 1) -> bool:
+       raise NotImplementedError
+  
+   @abstractmethod
+   async def arefresh_indexes(self, concurrency: int = 1) -> bool:
        raise NotImplementedError
   
    @abstractmethod
    def create_super_agent(
-       self, chat_history: Optional[List[ChatMessage]] = None, verbose: bool = False
+       self,
+       chat_history: Optional[List[ChatMessage]] = None,
+       verbose: bool = False,
+       cancellation_token: Optional[CancellationToken] = None,
    ) -> None:
        raise NotImplementedError
   
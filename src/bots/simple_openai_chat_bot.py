@@ -1,11 +1,11 @@
-from typing import List, Optional
+import json
+import asyncio
+from typing import List, Optional, Tuple
 
 
-from llama_index.llms.openai import OpenAI
 from llama_index.agent.openai import OpenAIAgent
 from llama_index.core.storage import StorageContext
 from llama_index.core.base.llms.types import ChatMessage
-from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.core.chat_engine.types import (
    AgentChatResponse,
    StreamingAgentChatResponse,
@@ -14,19 +14,32 @@ from llama_index.core.vector_stores import MetadataFilter, MetadataFilters
 from llama_index.core.vector_stores import FilterOperator, FilterCondition
 from llama_index.core.indices import load_index_from_storage, VectorStoreIndex
 
+from src import config
+from src.config_constants import DOC_INDEX_ID_METADATA_KEY
 from src.db_handlers.schemas import (
     ConfluenceResource, 
     CrawlResource, 
     RagBot, 
     GithubResource, 
-    BotIndex
+    LocalDirectoryResource,
+    BotIndex,
+    NodePostProcessingConfig,
 )
 from src.bots.chat_bot import ChatBot
-from src.doc_readers.confluence_reader.confluence_reader import ConfluencePageReader
-from src.doc_readers.github_reader.github_reader import GithubReader
 from src.logger import CustomLogger
 from src.tools import StandardRetrieverQueryEngineTool
+from src.tools.standard_RQE.node_postprocessors import (
+   build_node_postprocessors,
+   resolve_postprocessing_config,
+)
 from src.bots.utils import create_unique_id
+from src.indices import BM25IndexStore
+from src.caches.index_cache import IndexCache
+from src.caches.query_embedding_cache import get_cached_embed_model
+from src.clients import get_llm, with_cancellation
+from src.concurrency.cancellation import CancellationToken
+from src.concurrency.priority import run_cpu_bound
+from src.vector_stores import IVFVectorStore
 
 
 logger = CustomLogger(__name__)
@@ -37,9 +50,6 @@ TODO: We can add `SYSTEM_PROMPT` to the super agent to improve performance.
 """
 
 
-DOC_INDEX_ID_METADATA_KEY = "index_id"
-
-
 class SimpleOpenAIChatBot(ChatBot):
    def __init__(
        self,
@@ -50,21 +60,35 @@ class SimpleOpenAIChatBot(ChatBot):
        embeddings_model_name: str,
        storage_context: StorageContext,
        indexes: List[BotIndex] = [],
-       crawl_resources: List[CrawlResource] = []
+       crawl_resources: List[CrawlResource] = [],
+       bm25_store: Optional[BM25IndexStore] = None,
+       node_postprocessing: Optional[NodePostProcessingConfig] = None,
+       index_cache: Optional[IndexCache] = None,
+       nprobe: Optional[int] = None,
    ) -> None:
        super().__init__(
            bot_id=bot_id,
            name=name,
            description=description,
-           llm= OpenAI(model=llm_model_name),
-           embeddings_model= OpenAIEmbedding(model=embeddings_model_name),
+           llm=get_llm(llm_model_name),
+           embeddings_model=get_cached_embed_model(embeddings_model_name),
            storage_context=storage_context,
            indexes=indexes,
            crawl_resources=crawl_resources,
+           bm25_store=bm25_store,
+           node_postprocessing=node_postprocessing,
+           index_cache=index_cache,
+           nprobe=nprobe,
        )
   
    @classmethod
-   def from_memory_obj(self, memory_obj: RagBot, storage_context: StorageContext) -> "SimpleOpenAIChatBot":
+   def from_memory_obj(
+       self,
+       memory_obj: RagBot,
+       storage_context: StorageContext,
+       bm25_store: Optional[BM25IndexStore] = None,
+       index_cache: Optional[IndexCache] = None,
+   ) -> "SimpleOpenAIChatBot":
        return SimpleOpenAIChatBot(
            bot_id=memory_obj.bot_id,
            name=memory_obj.name,
@@ -74,93 +98,258 @@ class SimpleOpenAIChatBot(ChatBot):
            storage_context=storage_context,
            indexes=memory_obj.indexes,
            crawl_resources=memory_obj.crawl_resources,
+           bm25_store=bm25_store,
+           node_postprocessing=memory_obj.node_postprocessing,
+           index_cache=index_cache,
+           nprobe=memory_obj.nprobe,
        )
   
-   async def acreate_or_load_indexes(self) -> bool:
-       logger.info(message="indexing started", fields={"bot_id": self.bot_id})
-       if not self._resource_to_index_map:
-           github_reader = GithubReader()
-           confluence_page_reader = ConfluencePageReader()
+   async def _aingest_resource(
+       self,
+       resource: CrawlResource,
+       github_reader,
+       confluence_page_reader,
+       local_directory_reader,
+   ) -> Optional[VectorStoreIndex]:
+       if isinstance(resource, LocalDirectoryResource) and resource.url in self._resource_to_index_map:
+           return await self._arefresh_local_directory(
+               resource, self._resource_to_index_map[resource.url], local_directory_reader
+           )
+      
+       _index_id = create_unique_id()
+       documents=None
+       nodes=None
+       if isinstance(resource, GithubResource):
+           documents = await github_reader.read_documents(
+               resource=resource, chatbot_id=self.bot_id, verbose=False
+           )
           
-           for resource in self.crawl_resources:
-               _index_id = create_unique_id()
-               documents=None
-               nodes=None
-               if isinstance(resource, GithubResource):
-                   documents = await github_reader.read_documents(
-                       resource=resource, chatbot_id=self.bot_id, verbose=False
-                   )
-                  
-                   # set index_id metadata field for each document
-                   for doc in documents:
-                       doc.metadata[DOC_INDEX_ID_METADATA_KEY] = _index_id
-                  
-                   nodes = github_reader.parse_documents(documents=documents)
-                   logger.info(
-                       message="read and parse documents from github",
-                       fields={"bot_id": self.bot_id},
-                   )
-               elif isinstance(resource, ConfluenceResource):
-                   documents = confluence_page_reader.read_documents(resource=resource, chatbot_id=self.bot_id, verbose=False)
-                  
-                   # set index_id metadata field for each document
-                   for doc in documents:
-                       doc.metadata[DOC_INDEX_ID_METADATA_KEY] = _index_id
-                  
-                   nodes = confluence_page_reader.parse_documents(documents=documents)
-                   logger.info(
-                       message="read and parse documents from confluence",
-                       fields={"bot_id": self.bot_id},
-                   )
-               else:
-                   logger.error(
-                       message="Invalid resource type",
-                       fields={"bot_id": self.bot_id, "resource": resource}
-                   )
-                   continue
-              
-               for doc in documents:
-                   self._storage_context.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
-              
-               logger.info(
-                   message="stored document hashes in docstore",
-                   fields={"bot_id": self.bot_id},
-               )
-              
-               logger.info(message="creating a new index")
-               index = VectorStoreIndex(
-                   nodes=nodes,
-                   storage_context=self._storage_context,
-                   embed_model=self._embeddings_model,
-                   show_progress=True,
-               )
-               index.set_index_id(_index_id)
-              
-               logger.info(
-                   message="Created a new index",
-                   fields={
-                       "bot_id": self.bot_id,
-                       "index_id": index.index_id,
-                       "resource_url": resource.url
-                   }
-               )
-              
-               # add the new index to the list of indexes
-               self._resource_to_index_map[resource.url] = index.index_id
-               self._indexes.append(index)
-              
-               # persist the index
-           self._storage_context.persist()
+           # set index_id metadata field for each document
+           for doc in documents:
+               doc.metadata[DOC_INDEX_ID_METADATA_KEY] = _index_id
+          
+           nodes = await run_cpu_bound(github_reader.parse_documents, documents=documents)
            logger.info(
-               message='persisted indexes to storage',
+               message="read and parse documents from github",
+               fields={"bot_id": self.bot_id},
+           )
+       elif isinstance(resource, ConfluenceResource):
+           documents = await run_cpu_bound(
+               confluence_page_reader.read_documents,
+               resource=resource,
+               chatbot_id=self.bot_id,
+               verbose=False,
+           )
+          
+           # set index_id metadata field for each document
+           for doc in documents:
+               doc.metadata[DOC_INDEX_ID_METADATA_KEY] = _index_id
+          
+           nodes = await run_cpu_bound(confluence_page_reader.parse_documents, documents=documents)
+           logger.info(
+               message="read and parse documents from confluence",
+               fields={"bot_id": self.bot_id},
+           )
+       elif isinstance(resource, LocalDirectoryResource):
+           documents = await run_cpu_bound(
+               local_directory_reader.read_documents,
+               resource=resource,
+               chatbot_id=self.bot_id,
+               verbose=False,
+           )
+          
+           # set index_id metadata field for each document
+           for doc in documents:
+               doc.metadata[DOC_INDEX_ID_METADATA_KEY] = _index_id
+          
+           nodes = await run_cpu_bound(local_directory_reader.parse_documents, documents=documents)
+           logger.info(
+               message="read and parse documents from local directory",
                fields={"bot_id": self.bot_id},
            )
        else:
-           for url, index_id in self._resource_to_index_map.items():
-               index = load_index_from_storage(storage_context=self._storage_context, index_id=index_id)
+           logger.error(
+               message="Invalid resource type",
+               fields={"bot_id": self.bot_id, "resource": resource}
+           )
+           return None
+      
+       for doc in documents:
+           self._storage_context.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+       if isinstance(resource, LocalDirectoryResource):
+           # a refresh finds the removed files from the documents of the index
+           from src.doc_readers.local_reader.local_directory_reader import local_files_key
+          
+           self._storage_context.docstore.set_document_hash(
+               local_files_key(_index_id), json.dumps([doc.get_doc_id() for doc in documents])
+           )
+      
+       logger.info(
+           message="stored document hashes in docstore",
+           fields={"bot_id": self.bot_id},
+       )
+      
+       logger.info(message="creating a new index")
+       index = await run_cpu_bound(
+           VectorStoreIndex,
+           nodes=nodes,
+           storage_context=self._storage_context,
+           embed_model=self._embeddings_model,
+           show_progress=True,
+           # BM25 hits are read back from the docstore
+           store_nodes_override=self._bm25_store is not None,
+       )
+       index.set_index_id(_index_id)
+      
+       if self._bm25_store is not None:
+           await run_cpu_bound(self._bm25_store.build, index_id=_index_id, nodes=nodes)
+           logger.info(
+               message="built bm25 index",
+               fields={"bot_id": self.bot_id, "index_id": _index_id},
+           )
+      
+       logger.info(
+           message="Created a new index",
+           fields={
+               "bot_id": self.bot_id,
+               "index_id": index.index_id,
+               "resource_url": resource.url
+           }
+       )
+       return index
+  
+   async def _arefresh_local_directory(
+       self,
+       resource: LocalDirectoryResource,
+       index_id: str,
+       local_directory_reader,
+   ) -> VectorStoreIndex:
+       """
+       Brings the index of a local directory up to date in place: only new and changed
+       files are parsed and embedded, the nodes of changed and removed files are deleted.
+       """
+       from src.doc_readers.local_reader.local_directory_reader import local_files_key
+      
+       docstore = self._storage_context.docstore
+       index = await self._aload_index(index_id)
+       changes = await run_cpu_bound(
+           local_directory_reader.read_changes,
+           resource=resource,
+           chatbot_id=self.bot_id,
+           docstore=docstore,
+           index_id=index_id,
+           verbose=False,
+       )
+      
+       for doc in changes.documents:
+           doc.metadata[DOC_INDEX_ID_METADATA_KEY] = index_id
+       nodes = await run_cpu_bound(local_directory_reader.parse_documents, documents=changes.documents)
+      
+       # as `refresh_ref_docs`, with the nodes of the readers' own parsers
+       for doc_id in changes.replaced_doc_ids + changes.deleted_doc_ids:
+           await run_cpu_bound(index.delete_ref_doc, doc_id, delete_from_docstore=True)
+       if nodes:
+           await run_cpu_bound(index.insert_nodes, nodes, show_progress=True)
+       for doc in changes.documents:
+           docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+       for doc_id, state in changes.touched.items():
+           docstore.set_document_hash(doc_id, state)
+       docstore.set_document_hash(local_files_key(index_id), json.dumps(changes.doc_ids))
+      
+       if self._bm25_store is not None and (nodes or changes.replaced_doc_ids or changes.deleted_doc_ids):
+           bm25_index = await run_cpu_bound(self._bm25_store.get, index_id)
+       else:
+           bm25_index = None
+       if bm25_index is not None:
+           for doc_id in changes.replaced_doc_ids + changes.deleted_doc_ids:
+               bm25_index.delete_ref_doc(doc_id)
+           bm25_index.insert_nodes(nodes)
+           await run_cpu_bound(self._bm25_store.persist, bm25_index)
+      
+       logger.info(
+           message="Refreshed index of local directory",
+           fields={
+               "bot_id": self.bot_id,
+               "index_id": index_id,
+               "resource_url": resource.url,
+               "num_changed": len(changes.documents),
+               "num_deleted": len(changes.deleted_doc_ids),
+               "num_nodes": len(nodes),
+           },
+       )
+       return index
+  
+   async def _aload_index(self, index_id: str) -> VectorStoreIndex:
+       if self._index_cache is not None:
+           index = self._index_cache.get(index_id)
+           if index is not None:
+               return index
+      
+       # reads the index struct from the index store, off the event loop
+       index = await asyncio.to_thread(
+           load_index_from_storage,
+           storage_context=self._storage_context,
+           index_id=index_id,
+           embed_model=self._embeddings_model,
+           store_nodes_override=self._bm25_store is not None,
+       )
+       if self._index_cache is not None:
+           self._index_cache.put(index_id, index)
+       return index
+  
+   async def _aingest_resources(self, concurrency: int) -> List[Tuple[CrawlResource, VectorStoreIndex]]:
+       # readers and their parsers are only needed for ingestion, not to serve chats
+       from src.doc_readers.confluence_reader.confluence_reader import ConfluencePageReader
+       from src.doc_readers.github_reader.github_reader import GithubReader
+       from src.doc_readers.local_reader.local_directory_reader import LocalDirectoryReader
+      
+       github_reader = GithubReader()
+       confluence_page_reader = ConfluencePageReader()
+       local_directory_reader = LocalDirectoryReader()
+       # resources are read, parsed and embedded `concurrency` at a time
+       semaphore = asyncio.Semaphore(concurrency)
+      
+       async def ingest(resource: CrawlResource) -> Optional[VectorStoreIndex]:
+           async with semaphore:
+               if (
+                   resource.url in self._resource_to_index_map
+                   and not isinstance(resource, LocalDirectoryResource)
+               ):
+                   # only local directories are refreshed in place
+                   return await self._aload_index(self._resource_to_index_map[resource.url])
+               return await self._aingest_resource(
+                   resource, github_reader, confluence_page_reader, local_directory_reader
+               )
+      
+       indexes = await asyncio.gather(*(ingest(resource) for resource in self.crawl_resources))
+       ingested = []
+       for resource, index in zip(self.crawl_resources, indexes):
+           if index is None:
+               continue
+           self._resource_to_index_map[resource.url] = index.index_id
+           if self._index_cache is not None:
+               self._index_cache.put(index.index_id, index)
+           ingested.append((resource, index))
+      
+       # persist the index
+       await run_cpu_bound(self._storage_context.persist)
+       logger.info(
+           message='persisted indexes to storage',
+           fields={"bot_id": self.bot_id},
+       )
+       return ingested
+  
+   async def acreate_or_load_indexes(self, concurrency: int = 1) -> bool:
+       logger.info(message="indexing started", fields={"bot_id": self.bot_id})
+       if not self._resource_to_index_map:
+           for _, index in await self._aingest_resources(concurrency):
+               # add the new index to the list of indexes
                self._indexes.append(index)
+       else:
+           for url, index_id in self._resource_to_index_map.items():
+               self._indexes.append(await self._aload_index(index_id))
                logger.info(
-                   message="Loaded index from storage",
+                   message="Loaded index",
                    fields={
                        "bot_id": self.bot_id,
                        "index_id": index_id,
@@ -169,11 +358,34 @@ class SimpleOpenAIChatBot(ChatBot):
                )
       
        return True
+  
+   async def arefresh_indexes(self, concurrency: int = 1) -> bool:
+       """
+       Brings the indexes of the bot up to date with its resources. Local directories
+       with an index only re-embed their new and changed files, resources without an
+       index are ingested, the other indexes are kept as they are.
+       """
+       logger.info(message="refresh started", fields={"bot_id": self.bot_id})
+       self._indexes = [index for _, index in await self._aingest_resources(concurrency)]
+       return True
               
    def create_super_agent(
-       self, chat_history: Optional[List[ChatMessage]] = None, verbose: bool = False
+       self,
+       chat_history: Optional[List[ChatMessage]] = None,
+       verbose: bool = False,
+       cancellation_token: Optional[CancellationToken] = None,
    ):
+       # requests of this turn stop once the token is cancelled, e.g. when the client leaves
+       llm = self._llm
+       if cancellation_token is not None:
+           llm = with_cancellation(self._llm, cancellation_token)
+      
        tools_list = []
+       postprocessing = resolve_postprocessing_config(self._node_postprocessing)
+       # other vector stores do not take the query kwarg
+       vector_store_kwargs = None
+       if self._nprobe is not None and isinstance(self._storage_context.vector_store, IVFVectorStore):
+           vector_store_kwargs = {"nprobe": self._nprobe}
        for index in self._indexes:
            filters = MetadataFilters(
                filters=[
@@ -185,16 +397,26 @@ class SimpleOpenAIChatBot(ChatBot):
                ],
                condition=FilterCondition.AND,
            )
+           bm25_index = None
+           if self._bm25_store is not None:
+               bm25_index = self._bm25_store.get(index.index_id)
            tool = StandardRetrieverQueryEngineTool.from_defaults(
                index=index,
-               llm=self._llm,
+               llm=llm,
                filters=filters,
+               vector_store_kwargs=vector_store_kwargs,
+               similarity_top_k=config.retrieval_cfg.SimilarityTopK,
+               bm25_index=bm25_index,
+               docstore=self._storage_context.docstore,
+               lexical_top_k=config.retrieval_cfg.LexicalTopK,
+               rrf_k=config.retrieval_cfg.RRFK,
+               node_postprocessors=build_node_postprocessors(postprocessing, bot_id=self.bot_id),
            )
            tools_list.append(tool)
       
        self.super_agent = OpenAIAgent.from_tools(
            tools=tools_list,
-           llm=self._llm,
+           llm=llm,
            chat_history=chat_history,
            verbose=verbose,
        )
@@ -0,0 +1,2 @@
+from src.caches.answer_cache import AnswerCache, CachedAnswer
+from src.caches.index_cache import IndexCache
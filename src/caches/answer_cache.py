@@ -0,0 +1,246 @@
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from src.db_handlers.schemas import Message, SourceNodeWithScore, roles_and_texts
+from src.metrics import metrics
+from src.vector_stores.utils import GrowableArray, normalize_rows
+
+
+AnswerCacheKey = Tuple[str, str, str, str]
+# bot, index set version and history fingerprint: a similar query is only reused within one
+SimilarityGroup = Tuple[str, str, str]
+
+
+def normalize_query(query: str) -> str:
+   """Case, unicode form, whitespace and trailing punctuation do not change the answer."""
+   query = unicodedata.normalize("NFKC", query).lower()
+   query = " ".join(query.split())
+   return query.rstrip("?!.").strip()
+
+
+def index_set_version(resource_to_index_map: Dict[str, str]) -> str:
+   """Changes whenever a resource of the bot is (re)indexed under a new index id."""
+   items = "\n".join(f"{resource}={index_id}" for resource, index_id in sorted(resource_to_index_map.items()))
+   return hashlib.sha1(items.encode("utf-8")).hexdigest()
+
+
+def history_fingerprint(messages: Optional[List[Message]]) -> str:
+   """Fingerprint of the role and text of the earlier messages of a chat session."""
+   digest = hashlib.sha1()
+   for role, text in roles_and_texts(messages):
+       digest.update(f"{role.value}\x00{text}\x01".encode("utf-8"))
+   return digest.hexdigest()
+
+
+def split_into_tokens(text: str) -> List[str]:
+   """Word-sized chunks used to replay answers that were cached from a non-streaming chat."""
+   return re.findall(r"\S+\s*|\s+", text)
+
+
+@dataclass
+class CachedAnswer:
+   text: str
+   source_nodes: List[SourceNodeWithScore]
+   # streamed chunks, replayed as they were originally sent
+   tokens: List[str] = field(default_factory=list)
+   query_embedding: Optional[np.ndarray] = None
+   created_at: float = field(default_factory=time.monotonic)
+
+   def iter_tokens(self) -> Iterator[str]:
+       return iter(self.tokens or split_into_tokens(self.text))
+
+
+def _similarity_group(key: AnswerCacheKey) -> SimilarityGroup:
+   return key[0], key[1], key[3]
+
+
+class _EmbeddingMatrix:
+   """
+   Normalised query embeddings of the cached answers of one similarity group, one row
+   per key. Rows are only appended; removed rows lose their key and are dropped when
+   the matrix is rebuilt into new arrays, so a snapshot stays valid without the lock.
+   """
+   def __init__(self) -> None:
+       self.keys: List[Optional[AnswerCacheKey]] = []
+       self._slot_by_key: Dict[AnswerCacheKey, int] = {}
+       self._vectors: Optional[GrowableArray] = None
+       self._num_removed = 0
+
+   def __len__(self) -> int:
+       return len(self._slot_by_key)
+
+   def add(self, key: AnswerCacheKey, embedding: np.ndarray) -> None:
+       self.remove(key)
+       if self._vectors is not None and self._vectors.view.shape[1] != len(embedding):
+           # the bot changed embeddings model, earlier queries are not comparable
+           self.keys, self._slot_by_key, self._num_removed = [], {}, 0
+           self._vectors = None
+       if self._vectors is None:
+           self._vectors = GrowableArray(dtype=np.float32, row_shape=(len(embedding),), capacity=64)
+       self._slot_by_key[key] = len(self.keys)
+       self.keys.append(key)
+       self._vectors.extend(normalize_rows(embedding[None, :]))
+
+   def remove(self, key: AnswerCacheKey) -> None:
+       slot = self._slot_by_key.pop(key, None)
+       if slot is None:
+           return
+       self.keys[slot] = None
+       self._num_removed += 1
+       if self._num_removed > len(self.keys) // 2:
+           slots = [slot for slot, key in enumerate(self.keys) if key is not None]
+           self._vectors = GrowableArray.from_array(self._vectors.view[slots])
+           self.keys = [self.keys[slot] for slot in slots]
+           self._slot_by_key = {key: slot for slot, key in enumerate(self.keys)}
+           self._num_removed = 0
+
+   def snapshot(self) -> Tuple[List[Optional[AnswerCacheKey]], np.ndarray]:
+       # rows past the snapshot may be appended, the ones in it are never written again
+       return self.keys, self._vectors.view
+
+
+class AnswerCache:
+   """
+   In-process cache of bot answers keyed by
+   `(bot_id, index set version, normalised query, history fingerprint)`.
+
+   Entries expire after `ttl_seconds` and the least recently used entries are evicted
+   beyond `max_entries`. When `similarity_threshold` is set, an exact miss falls back
+   to the cached query of the same bot, index set and history with the highest cosine
+   similarity to the query embedding, if it reaches the threshold. The similarities are
+   one product with the embedding matrix of that group, computed outside the lock.
+   """
+   def __init__(
+       self,
+       ttl_seconds: float = 3600,
+       max_entries: int = 10000,
+       similarity_threshold: Optional[float] = None,
+   ) -> None:
+       self._ttl_seconds = ttl_seconds
+       self._max_entries = max_entries
+       self._similarity_threshold = similarity_threshold
+       self._entries: "OrderedDict[AnswerCacheKey, CachedAnswer]" = OrderedDict()
+       self._embeddings: Dict[SimilarityGroup, _EmbeddingMatrix] = {}
+       self._lock = threading.Lock()
+
+   @property
+   def uses_embeddings(self) -> bool:
+       return self._similarity_threshold is not None
+
+   @staticmethod
+   def make_key(
+       bot_id: str, index_version: str, query: str, history: str = ""
+   ) -> AnswerCacheKey:
+       return bot_id, index_version, normalize_query(query), history
+
+   def _is_expired(self, entry: CachedAnswer) -> bool:
+       return time.monotonic() - entry.created_at > self._ttl_seconds
+
+   def _remove(self, key: AnswerCacheKey) -> None:
+       # called with the lock held
+       self._entries.pop(key, None)
+       group = _similarity_group(key)
+       embeddings = self._embeddings.get(group)
+       if embeddings is not None:
+           embeddings.remove(key)
+           if not len(embeddings):
+               del self._embeddings[group]
+
+   def _most_similar(
+       self, key: AnswerCacheKey, query_embedding: List[float]
+   ) -> Optional[Tuple[AnswerCacheKey, CachedAnswer]]:
+       with self._lock:
+           embeddings = self._embeddings.get(_similarity_group(key))
+           if embeddings is None:
+               return None
+           keys, vectors = embeddings.snapshot()
+
+       query_vector = normalize_rows(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+       if len(query_vector) != vectors.shape[1]:
+           return None
+       scores = vectors @ query_vector
+       candidates = np.flatnonzero(scores >= self._similarity_threshold)
+       candidates = candidates[np.argsort(-scores[candidates])]
+
+       with self._lock:
+           # the entries may have been replaced, evicted or expired since the snapshot
+           for slot in candidates:
+               other_key = keys[slot]
+               entry = self._entries.get(other_key) if other_key is not None else None
+               if entry is None:
+                   continue
+               if self._is_expired(entry):
+                   self._remove(other_key)
+                   continue
+               self._entries.move_to_end(other_key)
+               return other_key, entry
+       return None
+
+   def get(
+       self, key: AnswerCacheKey, query_embedding: Optional[List[float]] = None
+   ) -> Optional[CachedAnswer]:
+       with self._lock:
+           entry = self._entries.get(key)
+           if entry is not None and self._is_expired(entry):
+               self._remove(key)
+               entry = None
+           if entry is not None:
+               self._entries.move_to_end(key)
+
+       match = "exact"
+       if entry is None and self.uses_embeddings and query_embedding is not None:
+           similar = self._most_similar(key, query_embedding)
+           if similar is not None:
+               (key, entry), match = similar, "similar"
+
+       if entry is None:
+           metrics.increment("answer_cache_misses", bot_id=key[0])
+           return None
+       metrics.increment("answer_cache_hits", bot_id=key[0], match=match)
+       return entry
+
+   def put(
+       self,
+       key: AnswerCacheKey,
+       text: str,
+       source_nodes: List[SourceNodeWithScore],
+       tokens: Optional[List[str]] = None,
+       query_embedding: Optional[List[float]] = None,
+   ) -> None:
+       if not text:
+           return
+       entry = CachedAnswer(
+           text=text,
+           source_nodes=source_nodes,
+           tokens=tokens or [],
+           query_embedding=(
+               np.asarray(query_embedding, dtype=np.float32)
+               if query_embedding is not None else None
+           ),
+       )
+       with self._lock:
+           self._remove(key)
+           self._entries[key] = entry
+           if entry.query_embedding is not None:
+               group = _similarity_group(key)
+               self._embeddings.setdefault(group, _EmbeddingMatrix()).add(key, entry.query_embedding)
+           while len(self._entries) > self._max_entries:
+               self._remove(next(iter(self._entries)))
+           metrics.set_gauge("answer_cache_entries", len(self._entries))
+
+   def invalidate(self, bot_id: str) -> int:
+       """Drops every cached answer of the bot; returns the number of entries removed."""
+       with self._lock:
+           stale = [key for key in self._entries if key[0] == bot_id]
+           for key in stale:
+               self._remove(key)
+           metrics.set_gauge("answer_cache_entries", len(self._entries))
+       return len(stale)
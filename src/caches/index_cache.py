@@ -0,0 +1,41 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from llama_index.core.indices.base import BaseIndex
+
+from src.metrics import metrics
+
+
+class IndexCache:
+   """
+   Process-wide LRU of indexes loaded from storage, keyed by index id, so chat turns of
+   a bot do not read its index structs again. A bot gets new index ids when it is
+   re-ingested, so cached indexes never go stale; old ones are evicted.
+
+   Cached indexes are shared between chat turns and must not be modified.
+   """
+   def __init__(self, max_entries: int = 256) -> None:
+       self._max_entries = max_entries
+       self._entries: "OrderedDict[str, BaseIndex]" = OrderedDict()
+       self._lock = threading.Lock()
+
+   def get(self, index_id: str) -> Optional[BaseIndex]:
+       with self._lock:
+           index = self._entries.get(index_id)
+           if index is not None:
+               self._entries.move_to_end(index_id)
+       metrics.increment("index_cache_hits" if index is not None else "index_cache_misses")
+       return index
+
+   def put(self, index_id: str, index: BaseIndex) -> None:
+       with self._lock:
+           self._entries[index_id] = index
+           self._entries.move_to_end(index_id)
+           while len(self._entries) > self._max_entries:
+               self._entries.popitem(last=False)
+           metrics.set_gauge("index_cache_entries", len(self._entries))
+
+   def __contains__(self, index_id: str) -> bool:
+       with self._lock:
+           return index_id in self._entries
@@ -0,0 +1,207 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.embeddings.openai.base import get_embeddings
+
+from src import config
+from src.clients import get_embed_model
+from src.metrics import metrics
+
+
+class QueryEmbeddingCache:
+   """Process-wide LRU of query embeddings keyed by `(model, query)`."""
+   def __init__(self, max_entries: int = 10000) -> None:
+       self._max_entries = max_entries
+       self._entries: "OrderedDict[Tuple[str, str], Embedding]" = OrderedDict()
+       self._lock = threading.Lock()
+
+   def get(self, model_name: str, query: str) -> Optional[Embedding]:
+       with self._lock:
+           embedding = self._entries.get((model_name, query))
+           if embedding is not None:
+               self._entries.move_to_end((model_name, query))
+       metrics.increment(
+           "query_embedding_cache_hits" if embedding is not None else "query_embedding_cache_misses",
+           model=model_name,
+       )
+       return embedding
+
+   def put(self, model_name: str, query: str, embedding: Embedding) -> None:
+       with self._lock:
+           self._entries[(model_name, query)] = embedding
+           self._entries.move_to_end((model_name, query))
+           while len(self._entries) > self._max_entries:
+               self._entries.popitem(last=False)
+
+
+class QueryEmbeddingBatcher:
+   """
+   Coalesces queries arriving within `window_seconds` of each other into a single
+   `embed_batch` call. The first caller of a batch waits out the window and sends
+   the request; callers asking for a query that is pending or in flight share its result.
+   """
+   def __init__(
+       self,
+       embed_batch: Callable[[List[str]], List[Embedding]],
+       window_seconds: float = 0.005,
+       max_batch_size: int = 64,
+   ) -> None:
+       self._embed_batch = embed_batch
+       self._window_seconds = window_seconds
+       self._max_batch_size = max_batch_size
+       self._pending: Dict[str, Future] = {}
+       self._in_flight: Dict[str, Future] = {}
+       self._lock = threading.Lock()
+
+   def _take_pending(self) -> Dict[str, Future]:
+       with self._lock:
+           pending, self._pending = self._pending, {}
+           self._in_flight.update(pending)
+       return pending
+
+   def _send(self, pending: Dict[str, Future]) -> None:
+       if not pending:
+           return
+       queries = list(pending)
+       metrics.observe("query_embedding_batch_size", len(queries))
+       try:
+           embeddings = self._embed_batch(queries)
+       except Exception as e:
+           for future in pending.values():
+               future.set_exception(e)
+       else:
+           for query, embedding in zip(queries, embeddings):
+               pending[query].set_result(embedding)
+       finally:
+           with self._lock:
+               for query in queries:
+                   self._in_flight.pop(query, None)
+
+   def embed(self, query: str) -> Embedding:
+       with self._lock:
+           future = self._in_flight.get(query)
+           if future is not None:
+               is_leader = is_full = False
+           else:
+               future = self._pending.get(query)
+               is_leader = not self._pending
+               if future is None:
+                   future = self._pending[query] = Future()
+               is_full = len(self._pending) >= self._max_batch_size
+
+       if is_full:
+           self._send(self._take_pending())
+       elif is_leader:
+           time.sleep(self._window_seconds)
+           self._send(self._take_pending())
+       return future.result()
+
+
+class CachedQueryEmbedding(BaseEmbedding):
+   """
+   Wraps an embeddings model so that query embeddings are memoised per `(model, query)`
+   and concurrent queries are embedded in batches. Text embeddings, used when
+   indexing, go straight to the wrapped model.
+   """
+   _embed_model: BaseEmbedding = PrivateAttr()
+   _cache: QueryEmbeddingCache = PrivateAttr()
+   _batcher: QueryEmbeddingBatcher = PrivateAttr()
+
+   def __init__(
+       self,
+       embed_model: BaseEmbedding,
+       cache: QueryEmbeddingCache,
+       window_seconds: float = 0.005,
+       max_batch_size: int = 64,
+   ) -> None:
+       super().__init__(
+           model_name=embed_model.model_name,
+           embed_batch_size=embed_model.embed_batch_size,
+           callback_manager=embed_model.callback_manager,
+       )
+       self._embed_model = embed_model
+       self._cache = cache
+       self._batcher = QueryEmbeddingBatcher(
+           embed_batch=self._embed_queries,
+           window_seconds=window_seconds,
+           max_batch_size=max_batch_size,
+       )
+
+   @classmethod
+   def class_name(cls) -> str:
+       return "CachedQueryEmbedding"
+
+   def _embed_queries(self, queries: List[str]) -> List[Embedding]:
+       if len(queries) > 1 and isinstance(self._embed_model, OpenAIEmbedding):
+           # one request for the whole batch, with the same engine as `get_query_embedding`
+           embeddings = get_embeddings(
+               self._embed_model._get_client(),
+               queries,
+               engine=self._embed_model._query_engine,
+               **self._embed_model.additional_kwargs,
+           )
+       else:
+           embeddings = [self._embed_model.get_query_embedding(query) for query in queries]
+       # cached before the waiting callers are released
+       for query, embedding in zip(queries, embeddings):
+           self._cache.put(self.model_name, query, embedding)
+       return embeddings
+
+   def _get_query_embedding(self, query: str) -> Embedding:
+       embedding = self._cache.get(self.model_name, query)
+       if embedding is None:
+           embedding = self._batcher.embed(query)
+       return embedding
+
+   async def _aget_query_embedding(self, query: str) -> Embedding:
+       embedding = self._cache.get(self.model_name, query)
+       if embedding is None:
+           embedding = await asyncio.to_thread(self._batcher.embed, query)
+       return embedding
+
+   def _get_text_embedding(self, text: str) -> Embedding:
+       return self._embed_model.get_text_embedding(text)
+
+   async def _aget_text_embedding(self, text: str) -> Embedding:
+       return await self._embed_model.aget_text_embedding(text)
+
+   def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+       return self._embed_model.get_text_embedding_batch(texts)
+
+   async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+       return await self._embed_model.aget_text_embedding_batch(texts)
+
+
+_query_embedding_cache: Optional[QueryEmbeddingCache] = None
+_embed_models: Dict[str, CachedQueryEmbedding] = {}
+_embed_models_lock = threading.Lock()
+
+
+def get_cached_embed_model(model_name: str) -> CachedQueryEmbedding:
+   """
+   Returns the process-wide embeddings model for `model_name`, so every bot and index
+   tool using the model shares its query embedding cache and batches.
+   """
+   global _query_embedding_cache
+   with _embed_models_lock:
+       embed_model = _embed_models.get(model_name)
+       if embed_model is None:
+           if _query_embedding_cache is None:
+               _query_embedding_cache = QueryEmbeddingCache(
+                   max_entries=config.query_embedding_cfg.CacheSize
+               )
+           embed_model = CachedQueryEmbedding(
+               embed_model=get_embed_model(model_name),
+               cache=_query_embedding_cache,
+               window_seconds=config.query_embedding_cfg.BatchWindowMs / 1000,
+               max_batch_size=config.query_embedding_cfg.MaxBatchSize,
+           )
+           _embed_models[model_name] = embed_model
+   return embed_model
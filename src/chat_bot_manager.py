@@ -1,30 +1,50 @@
+import os
+import time
 import asyncio
-import json
-from typing import List, Optional, Tuple, Set
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, List, Optional, Tuple, Set
 
 
-import chromadb
-from chromadb.api.models.Collection import Collection
 from starlette.responses import ContentStream
 from llama_index.core.storage import StorageContext
-from llama_index.storage.docstore.mongodb import MongoDocumentStore
-from llama_index.storage.index_store.mongodb import MongoIndexStore
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.core.chat_engine.types import StreamingAgentChatResponse
+from llama_index.core.chat_engine.types import AgentChatResponse, StreamingAgentChatResponse
+from llama_index.core.schema import NodeWithScore, TextNode
 from llama_index.core.vector_stores.types import BasePydanticVectorStore
 from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
 from llama_index.core.storage.index_store.keyval_index_store import KVIndexStore
 
 
 from src import config
-from src.config_constants import MONGO_DB, CHROMA_DB
+from src.config_constants import MONGO_DB, CHROMA_DB, QUANTIZED, IVF, HYBRID_RETRIEVAL
 from src.db_handlers import get_db_handler, DBHandler
 from src.bots import create_chat_bot, ChatBot
+from src.caches import AnswerCache, CachedAnswer, IndexCache
+from src.caches.answer_cache import (
+   AnswerCacheKey, history_fingerprint, index_set_version, normalize_query
+)
+from src.caches.query_embedding_cache import get_cached_embed_model
+from src.concurrency import (
+   CancellationToken,
+   Priority,
+   SingleFlight,
+   SubscriberLease,
+   TokenBroadcast,
+   iterate_in_thread,
+   priority_scope,
+   run_in_chat_thread,
+)
+from src.indices import BM25IndexStore
+from src.live_chat import ChatUnavailable, LiveChatSession
 from src.logger import CustomLogger
+from src.metrics import metrics
+from src.snapshots import SnapshotError, SnapshotManifest, export_bot_snapshot, import_bot_snapshot
+from src.sse import JSON_FORMAT, coalesce, json_event_stream, raw_event_stream
+from src.db_handlers.utils import get_past_timestamp
 from src.db_handlers.schemas import (
-   RagBot, BotConfig, Message, ChatSession, User, MessageCreatorRole, SourceNodeWithScore
+   RagBot, BotConfig, BotIndex, Message, ChatSession, User, MessageCreatorRole, SourceNodeWithScore
 )
 from src.utils import convert_db_messages_to_chatbot_messages
+from src.vector_stores import QuantizedVectorStore, IVFVectorStore
 
 
 logger = CustomLogger(__name__)
@@ -32,9 +52,40 @@ logger = CustomLogger(__name__)
 
 class ChatBotManager:
    def __init__(self):
-       self._storage_context: StorageContext = self._get_storage_context()
+       # stores are connected on the first chat, or by `warmup`
+       self._storage_context: Optional[StorageContext] = None
+       self._bm25_store: Optional[BM25IndexStore] = None
+       self._stores_ready = False
+       self._stores_lock = threading.Lock()
        self._db_handler: DBHandler = get_db_handler(db_type=config.app_cfg.DbStore)
+       self._answer_cache: Optional[AnswerCache] = self._get_answer_cache()
+       self._index_cache = IndexCache(max_entries=config.index_cache_cfg.MaxEntries)
+       # identical first-turn queries in flight at the same time share one computation
+       self._chat_flights: SingleFlight[asyncio.Task] = SingleFlight(name="chat")
+       self._stream_flights: SingleFlight[TokenBroadcast] = SingleFlight(name="stream_chat")
       
+   def warmup(self):
+       """Connects the stores now instead of on the first chat."""
+       self._connect_stores()
+
+   def _connect_stores(self):
+       if self._stores_ready:
+           return
+       with self._stores_lock:
+           if self._stores_ready:
+               return
+           start = time.perf_counter()
+           self._storage_context = self._get_storage_context()
+           self._bm25_store = self._get_bm25_store()
+           self._stores_ready = True
+           elapsed = time.perf_counter() - start
+           metrics.observe("store_connect_seconds", elapsed)
+           logger.info(message="connected stores", fields={"seconds": elapsed})
+
+   async def _aconnect_stores(self):
+       if not self._stores_ready:
+           await asyncio.to_thread(self._connect_stores)
+
    def _get_storage_context(self) -> StorageContext:
        docstore = self._get_doc_store()
        index_store = self._get_index_store()
@@ -49,11 +100,31 @@ class ChatBotManager:
    def _get_vector_store(self) -> BasePydanticVectorStore:
        vector_store = None
        if config.llama_index_cfg.VectorStoreType == CHROMA_DB:
+           # chromadb is slow to import and only needed by deployments using it
+           import chromadb
+           from chromadb.api.models.Collection import Collection
+           from llama_index.vector_stores.chroma import ChromaVectorStore
+          
            chroma_client = chromadb.PersistentClient()
            chroma_collection: Collection = chroma_client.get_or_create_collection(
                name=config.llama_index_cfg.VectorStore.CollectionName
            )
            vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+       elif config.llama_index_cfg.VectorStoreType == QUANTIZED:
+           vector_store_cfg = config.llama_index_cfg.VectorStore
+           vector_store = QuantizedVectorStore(
+               persist_dir=os.path.join(vector_store_cfg.DirPath, vector_store_cfg.CollectionName),
+               quantization=vector_store_cfg.Quantization,
+               rescore_factor=vector_store_cfg.RescoreFactor,
+               pq_subvectors=vector_store_cfg.PQSubvectors,
+           )
+       elif config.llama_index_cfg.VectorStoreType == IVF:
+           vector_store_cfg = config.llama_index_cfg.VectorStore
+           vector_store = IVFVectorStore(
+               persist_dir=os.path.join(vector_store_cfg.DirPath, vector_store_cfg.CollectionName),
+               nlist=vector_store_cfg.NList,
+               nprobe=vector_store_cfg.NProbe,
+           )
        else:
            raise NotImplementedError(
                f"VectorStoreType: {config.llama_index_cfg.VectorStoreType} not implemented"
@@ -63,6 +134,7 @@ class ChatBotManager:
    def _get_doc_store(self) -> KVDocumentStore:
        docstore = None
        if config.llama_index_cfg.DocStoreType == MONGO_DB:
+           from llama_index.storage.docstore.mongodb import MongoDocumentStore
            docstore = MongoDocumentStore.from_uri(uri=config.llama_index_cfg.MongoURI)
        else:
            raise NotImplementedError(
@@ -73,6 +145,7 @@ class ChatBotManager:
    def _get_index_store(self) -> KVIndexStore:
        index_store = None
        if config.llama_index_cfg.DocStoreType == MONGO_DB:
+           from llama_index.storage.index_store.mongodb import MongoIndexStore
            index_store = MongoIndexStore.from_uri(uri=config.llama_index_cfg.MongoURI)
        else:
            raise NotImplementedError(
@@ -80,8 +153,46 @@ class ChatBotManager:
            )
        return index_store
   
-   async def acreate_bot(self, bot: RagBot, chat_history: Optional[List[Message]] = None) -> ChatBot:#
-       chat_bot: ChatBot = create_chat_bot(bot=bot, storage_context=self._storage_context)
+   def _get_bm25_store(self) -> Optional[BM25IndexStore]:
+       if config.retrieval_cfg.Mode != HYBRID_RETRIEVAL:
+           return None
+       if config.llama_index_cfg.DocStoreType == MONGO_DB:
+           # kept next to the docstore, in `<docstore namespace>/bm25`
+           return BM25IndexStore.from_mongo_uri(
+               uri=config.llama_index_cfg.MongoURI,
+               db_name=config.llama_index_cfg.DocStore.DbName,
+               namespace=config.llama_index_cfg.DocStore.Namespace,
+           )
+       raise NotImplementedError(
+           f"BM25 index store for DocStoreType: {config.llama_index_cfg.DocStoreType} not implemented"
+       )
+  
+   def _get_answer_cache(self) -> Optional[AnswerCache]:
+       if not config.answer_cache_cfg.Enabled:
+           return None
+       return AnswerCache(
+           ttl_seconds=config.answer_cache_cfg.TTLSeconds,
+           max_entries=config.answer_cache_cfg.MaxEntries,
+           similarity_threshold=config.answer_cache_cfg.SimilarityThreshold,
+       )
+
+   def close(self):
+       # buffered messages are written before the process exits
+       self._db_handler.close()
+
+   async def acreate_bot(
+       self,
+       bot: RagBot,
+       chat_history: Optional[List[Message]] = None,
+       cancellation_token: Optional[CancellationToken] = None,
+   ) -> ChatBot:
+       await self._aconnect_stores()
+       chat_bot: ChatBot = create_chat_bot(
+           bot=bot,
+           storage_context=self._storage_context,
+           bm25_store=self._bm25_store,
+           index_cache=self._index_cache,
+       )
        indexes_loaded = await chat_bot.acreate_or_load_indexes()
       
        if not indexes_loaded:
@@ -96,25 +207,182 @@ class ChatBotManager:
 
 
        bot_chat_history = convert_db_messages_to_chatbot_messages(chat_history)
-       chat_bot.create_super_agent(chat_history=bot_chat_history, verbose=True)
+       chat_bot.create_super_agent(
+           chat_history=bot_chat_history, verbose=True, cancellation_token=cancellation_token
+       )
       
        if not bot.indexes:
            self._db_handler.update_bot_indexes(
                bot_id=bot.bot_id,
                resource_to_index_map=chat_bot.get_resources_to_index_map()
            )
+           if self._answer_cache is not None:
+               self._answer_cache.invalidate(bot.bot_id)
       
        if not bot.ready:
            self._db_handler.update_bot_status(bot_id=bot.bot_id, status=True)
       
        return chat_bot
   
+   async def prewarm(
+       self,
+       top_k: int,
+       lookback_hours: float,
+       concurrency: int,
+       owns: Optional[Callable[[str], bool]] = None,
+   ) -> List[str]:
+       """
+       Loads the indexes, BM25 indexes and clients of the `top_k` bots with the most chat
+       sessions updated in the last `lookback_hours`, `concurrency` bots at a time,
+       skipping the bots `owns` rejects. Returns the ids of the bots that were loaded.
+       """
+       bot_ids = await asyncio.to_thread(
+           self._db_handler.most_active_bots,
+           since=get_past_timestamp(hours=lookback_hours),
+           limit=top_k,
+       )
+       if owns is not None:
+           bot_ids = [bot_id for bot_id in bot_ids if owns(bot_id)]
+       semaphore = asyncio.Semaphore(concurrency)
+      
+       async def prewarm_bot(bot_id: str) -> bool:
+           async with semaphore:
+               try:
+                   bot = await asyncio.to_thread(self._db_handler.get_bot, bot_id)
+                   # bots that are not ingested yet would be ingested by loading them
+                   if bot is None or not bot.ready or not bot.indexes:
+                       return False
+                   await self._aconnect_stores()
+                   chat_bot = create_chat_bot(
+                       bot=bot,
+                       storage_context=self._storage_context,
+                       bm25_store=self._bm25_store,
+                       index_cache=self._index_cache,
+                   )
+                   await chat_bot.acreate_or_load_indexes()
+                   if self._bm25_store is not None:
+                       for index in bot.indexes:
+                           await asyncio.to_thread(self._bm25_store.get, index.index_id)
+                   return True
+               except Exception as e:
+                   logger.exception(
+                       message="failed to prewarm bot",
+                       fields={"bot_id": bot_id, "error": str(e)},
+                   )
+                   return False
+      
+       start = time.perf_counter()
+       loaded = await asyncio.gather(*(prewarm_bot(bot_id) for bot_id in bot_ids))
+       prewarmed = [bot_id for bot_id, ok in zip(bot_ids, loaded) if ok]
+       metrics.observe("prewarm_seconds", time.perf_counter() - start)
+       logger.info(
+           message="prewarmed bots",
+           fields={"num_candidates": len(bot_ids), "num_prewarmed": len(prewarmed)},
+       )
+       return prewarmed
+
+   async def export_bot_snapshot(self, bot_id: str, snapshot_dir: str) -> SnapshotManifest:
+       """Writes the indexes of a ready bot to `snapshot_dir`, see `src.snapshots`."""
+       bot = await asyncio.to_thread(self._db_handler.get_bot, bot_id)
+       if not bot.ready or not bot.indexes:
+           raise SnapshotError(f"bot {bot_id} is not ingested yet")
+       await self._aconnect_stores()
+       return await asyncio.to_thread(
+           export_bot_snapshot, bot, self._storage_context, snapshot_dir
+       )
+
+   async def import_bot_snapshot(self, snapshot_dir: str, verify: bool = True) -> RagBot:
+       """
+       Loads a snapshot into the stores and registers its bot as ready, so the bot
+       serves chats without being ingested again.
+       """
+       await self._aconnect_stores()
+       manifest = await asyncio.to_thread(
+           import_bot_snapshot,
+           snapshot_dir,
+           self._storage_context,
+           bm25_store=self._bm25_store,
+           verify=verify,
+       )
+       bot = manifest.bot
+       # an existing bot keeps its sessions and gets the indexes of the snapshot
+       self._db_handler.create_bot(bot)
+       self._db_handler.update_bot_indexes(
+           bot_id=bot.bot_id,
+           resource_to_index_map={index.resource: index.index_id for index in bot.indexes},
+       )
+       self._db_handler.update_bot_status(bot_id=bot.bot_id, status=True)
+       if self._answer_cache is not None:
+           self._answer_cache.invalidate(bot.bot_id)
+       return bot
+
+   async def ingest_bot(self, bot_config: BotConfig, concurrency: int = 1) -> RagBot:
+       """
+       Creates a bot and builds its indexes in the stores, `concurrency` resources at a
+       time, before marking it ready. Used by offline ingestion, see `src.ingest`.
+       """
+       bot = RagBot.from_bot_config(bot_config=bot_config)
+       self._db_handler.create_bot(bot)
+       await self._aconnect_stores()
+       chat_bot = create_chat_bot(
+           bot=bot,
+           storage_context=self._storage_context,
+           bm25_store=self._bm25_store,
+       )
+       await chat_bot.acreate_or_load_indexes(concurrency=concurrency)
+
+       resource_to_index_map = chat_bot.get_resources_to_index_map()
+       self._db_handler.update_bot_indexes(
+           bot_id=bot.bot_id, resource_to_index_map=resource_to_index_map
+       )
+       self._db_handler.update_bot_status(bot_id=bot.bot_id, status=True)
+       bot.indexes = [
+           BotIndex(resource=resource, index_id=index_id)
+           for resource, index_id in resource_to_index_map.items()
+       ]
+       bot.ready = True
+       return bot
+
+   async def refresh_bot(self, bot_id: str, concurrency: int = 1) -> RagBot:
+       """
+       Brings the indexes of an ingested bot up to date with its resources, re-embedding
+       only the new and changed files of its local directories, see `arefresh_indexes`.
+       """
+       bot = await asyncio.to_thread(self._db_handler.get_bot, bot_id)
+       if not bot.ready or not bot.indexes:
+           raise ValueError(f"bot {bot_id} is not ingested yet")
+       await self._aconnect_stores()
+       chat_bot = create_chat_bot(
+           bot=bot,
+           storage_context=self._storage_context,
+           bm25_store=self._bm25_store,
+           index_cache=self._index_cache,
+       )
+       await chat_bot.arefresh_indexes(concurrency=concurrency)
+
+       resource_to_index_map = chat_bot.get_resources_to_index_map()
+       self._db_handler.update_bot_indexes(
+           bot_id=bot.bot_id, resource_to_index_map=resource_to_index_map
+       )
+       if self._answer_cache is not None:
+           self._answer_cache.invalidate(bot.bot_id)
+       bot.indexes = [
+           BotIndex(resource=resource, index_id=index_id)
+           for resource, index_id in resource_to_index_map.items()
+       ]
+       return bot
+
    async def create_new_bot(self, bot_config: BotConfig) -> RagBot:
-       bot_memory_obj = RagBot.from_config(config=bot_config)
+       bot_memory_obj = RagBot.from_bot_config(bot_config=bot_config)
        self._db_handler.create_bot(bot_memory_obj)
-       asyncio.create_task(self.acreate_bot(bot=bot_memory_obj))
+       asyncio.create_task(self._acreate_bot_in_background(bot=bot_memory_obj))
        return bot_memory_obj
   
+   async def _acreate_bot_in_background(self, bot: RagBot) -> None:
+       # ingestion yields OpenAI request slots and CPU to chats
+       with priority_scope(Priority.BACKGROUND):
+           await self.acreate_bot(bot=bot)
+  
    async def _chat(
        self, user_query: str, bot_id: str, chat_session_id: str, user: User
    ) -> Tuple[RagBot, ChatSession]:
@@ -142,6 +410,7 @@ class ChatBotManager:
                chat_session_id=chat_session_id,
                chat_session_name=user_query[:20],
                user=user,
+               check_bot=False,
            )
       
        self._db_handler.create_message(
@@ -158,14 +427,85 @@ class ChatBotManager:
        )
        return bot_memory_obj, chat_session
   
+   async def _answer_cache_lookup(
+       self, user_query: str, bot: RagBot, chat_session: ChatSession
+   ) -> Tuple[Optional[AnswerCacheKey], Optional[List[float]], Optional[CachedAnswer]]:
+       if self._answer_cache is None:
+           return None, None, None
+      
+       # the session already holds the current user query as its last message
+       history = ""
+       if config.answer_cache_cfg.KeyOnHistory:
+           history = history_fingerprint(chat_session.messages[:-1])
+       cache_key = self._answer_cache.make_key(
+           bot_id=bot.bot_id,
+           index_version=index_set_version({idx.resource: idx.index_id for idx in bot.indexes}),
+           query=user_query,
+           history=history,
+       )
+      
+       query_embedding = None
+       if self._answer_cache.uses_embeddings:
+           embed_model = get_cached_embed_model(bot.embeddings_model)
+           query_embedding = await embed_model.aget_query_embedding(cache_key[2])
+      
+       cached_answer = self._answer_cache.get(cache_key, query_embedding=query_embedding)
+       if cached_answer is not None:
+           logger.info(
+               message="answering from the answer cache",
+               fields={"bot_id": bot.bot_id, "chat_session_id": chat_session.chat_session_id},
+           )
+       return cache_key, query_embedding, cached_answer
+  
+   @staticmethod
+   def _single_flight_key(
+       user_query: str, bot: RagBot, chat_session: ChatSession
+   ) -> Optional[Hashable]:
+       # only history-free queries get the same answer in every session
+       if len(chat_session.messages) > 1:
+           return None
+       return (
+           bot.bot_id,
+           index_set_version({idx.resource: idx.index_id for idx in bot.indexes}),
+           normalize_query(user_query),
+       )
+  
+   async def _run_chat(
+       self, user_query: str, bot: RagBot, chat_session: ChatSession
+   ) -> AgentChatResponse:
+       chat_bot = await self.acreate_bot(bot=bot, chat_history=chat_session.messages)
+       return await run_in_chat_thread(chat_bot.chat, user_query=user_query)
+  
    async def chat(
        self, user_query: str, bot_id: str, chat_session_id: str, user: User,
    ) -> str:
        bot_memory_obj, chat_session = await self._chat(
            user_query, bot_id, chat_session_id, user
        )
-       chat_bot = await self.acreate_bot(bot=bot_memory_obj, chat_history=chat_session.messages)
-       response = chat_bot.chat(user_query=user_query)
+       cache_key, query_embedding, cached_answer = await self._answer_cache_lookup(
+           user_query, bot_memory_obj, chat_session
+       )
+       if cached_answer is not None:
+           self._db_handler.create_message(
+               chat_session_id=chat_session_id,
+               text=cached_answer.text,
+               role=MessageCreatorRole.ASSISTANT,
+               sources_nodes=cached_answer.source_nodes,
+           )
+           return AgentChatResponse(
+               response=cached_answer.text,
+               source_nodes=[
+                   NodeWithScore(node=TextNode(id_=sn.node_id, metadata={"url": sn.url}), score=sn.score)
+                   for sn in cached_answer.source_nodes
+               ],
+           )
+      
+       flight_key = self._single_flight_key(user_query, bot_memory_obj, chat_session)
+       run_chat = lambda: self._run_chat(user_query, bot_memory_obj, chat_session)
+       if flight_key is not None:
+           response = await self._chat_flights.do(flight_key, run_chat)
+       else:
+           response = await run_chat()
       
        source_nodes = [
            SourceNodeWithScore(
@@ -182,42 +522,178 @@ class ChatBotManager:
            role=MessageCreatorRole.ASSISTANT,
            sources_nodes=source_nodes,
        )
+       if cache_key is not None:
+           self._answer_cache.put(
+               cache_key, response.response, source_nodes, query_embedding=query_embedding
+           )
        return response
 
-   async def stream_chat(
-       self, user_query: str, bot_id: str, chat_session_id: str, user: User,
-   ) -> ContentStream:
-       bot_memory_obj, chat_session = await self._chat(
-           user_query, bot_id, chat_session_id, user
+   async def _produce_stream(
+       self,
+       broadcast: TokenBroadcast,
+       cancellation_token: CancellationToken,
+       user_query: str,
+       bot: RagBot,
+       chat_session: ChatSession,
+   ) -> None:
+       chat_bot = await self.acreate_bot(
+           bot=bot, chat_history=chat_session.messages, cancellation_token=cancellation_token
        )
-       chat_bot = await self.acreate_bot(bot=bot_memory_obj, chat_history=chat_session.messages)
-       response = chat_bot.chat_stream(user_query=user_query)
-      
-       return self.stream_generator(response=response, chat_session_id=chat_session_id)
-  
-   async def stream_generator(self, response: StreamingAgentChatResponse, chat_session_id: str):
-       token_array: List[str] = []
-      
-       resources_list: List[SourceNodeWithScore] = [
+       response: StreamingAgentChatResponse = await run_in_chat_thread(
+           chat_bot.chat_stream, user_query=user_query
+       )
+       await broadcast.start([
            SourceNodeWithScore(
                node_id=sn.node_id,
                url=sn.metadata["url"],
                score=sn.score
            )
            for sn in response.source_nodes
-       ]
+       ])
+       async for token in iterate_in_thread(response.response_gen):
+           await broadcast.publish(token)
+  
+   async def stream_chat(
+       self,
+       user_query: str,
+       bot_id: str,
+       chat_session_id: str,
+       user: User,
+       stream_format: Optional[str] = None,
+   ) -> Tuple[ContentStream, Optional[SubscriberLease]]:
+       """
+       The event stream of the answer, and the lease of the generation it reads, which
+       the response abandons once it is over, see `SubscriberLease`.
+       """
+       bot_memory_obj, chat_session = await self._chat(
+           user_query, bot_id, chat_session_id, user
+       )
+       cache_key, query_embedding, cached_answer = await self._answer_cache_lookup(
+           user_query, bot_memory_obj, chat_session
+       )
+       if cached_answer is not None:
+           return self.cached_stream_generator(
+               cached_answer=cached_answer,
+               chat_session_id=chat_session_id,
+               stream_format=stream_format,
+           ), None
+      
+       def launch() -> TokenBroadcast:
+           cancellation_token = CancellationToken()
+           return TokenBroadcast(
+               lambda broadcast: self._produce_stream(
+                   broadcast, cancellation_token, user_query, bot_memory_obj, chat_session
+               ),
+               cancellation_token=cancellation_token,
+           )
+      
+       flight_key = self._single_flight_key(user_query, bot_memory_obj, chat_session)
+       if flight_key is not None:
+           broadcast, _ = self._stream_flights.join(flight_key, launch)
+       else:
+           broadcast = launch()
+       # subscribed before waiting, so a client leaving now, or before the response
+       # reads the stream, still stops a generation nobody listens to
+       lease = SubscriberLease(
+           broadcast, on_abandoned=lambda: self._save_abandoned_stream(chat_session_id, broadcast)
+       )
+       try:
+           # errors before the first token still fail the request instead of the stream
+           await broadcast.wait_started()
+       except asyncio.CancelledError:
+           lease.abandon()
+           raise
+       except BaseException:
+           lease.release()
+           raise
       
+       return self.stream_generator(
+           broadcast=broadcast,
+           lease=lease,
+           chat_session_id=chat_session_id,
+           cache_key=cache_key,
+           query_embedding=query_embedding,
+           stream_format=stream_format,
+       ), lease
+  
+   @staticmethod
+   def _event_stream(
+       resources_list: List[SourceNodeWithScore],
+       tokens: AsyncIterator[str],
+       stream_format: Optional[str] = None,
+   ) -> AsyncIterator[str]:
        resources_set: Set[str] = set()
        for resource in resources_list:
            resources_set.add(resource.url)
       
-       # Yield Sources
-       sources_json = json.dumps({'resources': list(resources_set)})
-       yield f"data: {sources_json}\n\n"
+       if (stream_format or config.streaming_cfg.Format) == JSON_FORMAT:
+           return json_event_stream(
+               resources_set,
+               tokens,
+               window_seconds=config.streaming_cfg.CoalesceMs / 1000,
+               max_chars=config.streaming_cfg.CoalesceChars,
+               heartbeat_seconds=config.streaming_cfg.HeartbeatSeconds,
+           )
+       return raw_event_stream(resources_set, tokens)
+  
+   def _save_abandoned_stream(self, chat_session_id: str, broadcast: TokenBroadcast) -> None:
+       metrics.increment("streams_abandoned")
+       logger.info(
+           message="client left before the stream started",
+           fields={"chat_session_id": chat_session_id},
+       )
+       self._db_handler.create_message(
+           chat_session_id=chat_session_id,
+           text="",
+           role=MessageCreatorRole.ASSISTANT,
+           sources_nodes=broadcast.source_nodes,
+           truncated=True,
+       )
+  
+   async def stream_generator(
+       self,
+       broadcast: TokenBroadcast,
+       lease: SubscriberLease,
+       chat_session_id: str,
+       cache_key: Optional[AnswerCacheKey] = None,
+       query_embedding: Optional[List[float]] = None,
+       stream_format: Optional[str] = None,
+   ):
+       lease.mark_started()
+       token_array: List[str] = []
+       resources_list: List[SourceNodeWithScore] = broadcast.source_nodes
+      
+       async def tokens() -> AsyncIterator[str]:
+           async for token in broadcast.subscribe():
+               token_array.append(token)
+               yield token
       
-       for token in response.response_gen:
-           token_array.append(token)
-           yield f"data: {token}\n\n"
+       events = self._event_stream(resources_list, tokens(), stream_format)
+       client_left = False
+       try:
+           async for event in events:
+               yield event
+       except (asyncio.CancelledError, GeneratorExit):
+           # the server stops the stream when the client disconnects
+           client_left = True
+           raise
+       finally:
+           await events.aclose()
+           # the generation is cancelled once no client is listening to it
+           lease.release()
+           if client_left:
+               metrics.increment("streams_abandoned")
+               logger.info(
+                   message="client left before the end of the stream",
+                   fields={"chat_session_id": chat_session_id, "tokens_sent": len(token_array)},
+               )
+               self._db_handler.create_message(
+                   chat_session_id=chat_session_id,
+                   text="".join(token_array),
+                   role=MessageCreatorRole.ASSISTANT,
+                   sources_nodes=resources_list,
+                   truncated=True,
+               )
       
        assistant_response = "".join(token_array)
        self._db_handler.create_message(
@@ -226,3 +702,151 @@ class ChatBotManager:
            role=MessageCreatorRole.ASSISTANT,
            sources_nodes=resources_list,
        )
+       if cache_key is not None:
+           self._answer_cache.put(
+               cache_key,
+               assistant_response,
+               resources_list,
+               tokens=token_array,
+               query_embedding=query_embedding,
+           )
+  
+   async def cached_stream_generator(
+       self,
+       cached_answer: CachedAnswer,
+       chat_session_id: str,
+       stream_format: Optional[str] = None,
+   ):
+       """Replays a cached answer with the same events as `stream_generator`."""
+       async def tokens() -> AsyncIterator[str]:
+           for token in cached_answer.iter_tokens():
+               yield token
+      
+       async for event in self._event_stream(cached_answer.source_nodes, tokens(), stream_format):
+           yield event
+      
+       self._db_handler.create_message(
+           chat_session_id=chat_session_id,
+           text=cached_answer.text,
+           role=MessageCreatorRole.ASSISTANT,
+           sources_nodes=cached_answer.source_nodes,
+       )
+  
+   async def open_live_session(
+       self, bot_id: str, chat_session_id: str, user: User
+   ) -> LiveChatSession:
+       """Loads the bot, the session history and the agent once for a WebSocket connection."""
+       bot_memory_obj = self._db_handler.get_bot(bot_id)
+       if bot_memory_obj is None:
+           raise ChatUnavailable(f"Bot with id: `{bot_id}` not found")
+      
+       if not bot_memory_obj.ready:
+           raise ChatUnavailable("Bot is not ready yet to answer queries. Please try again later.")
+      
+       chat_session: Optional[ChatSession] = self._db_handler.get_chat_session(
+           chat_session_id=chat_session_id
+       )
+       cancellation_token = CancellationToken()
+       chat_bot = await self.acreate_bot(
+           bot=bot_memory_obj,
+           chat_history=chat_session.messages if chat_session is not None else None,
+           cancellation_token=cancellation_token,
+       )
+       metrics.add_to_gauge("live_chat_sessions", 1)
+       return LiveChatSession(
+           bot=bot_memory_obj,
+           chat_bot=chat_bot,
+           chat_session_id=chat_session_id,
+           user=user,
+           session_exists=chat_session is not None,
+           cancellation_token=cancellation_token,
+       )
+  
+   async def live_turn(
+       self, live_session: LiveChatSession, user_query: str
+   ) -> AsyncIterator[Dict[str, Any]]:
+       """
+       Answers one turn of a live session with the agent kept in memory. Yields the
+       `sources`, coalesced `delta` and `done` events; the messages are written behind.
+       A turn stopped before its end is persisted as a truncated message.
+       """
+       chat_session_id = live_session.chat_session_id
+       if not live_session.session_exists:
+           live_session.write_behind(
+               self._db_handler.create_session,
+               bot_id=live_session.bot.bot_id,
+               chat_session_id=chat_session_id,
+               chat_session_name=user_query[:20],
+               user=live_session.user,
+               check_bot=False,
+           )
+           live_session.session_exists = True
+       live_session.write_behind(
+           self._db_handler.create_message,
+           chat_session_id=chat_session_id,
+           text=user_query,
+           role=MessageCreatorRole.USER,
+       )
+       live_session.turns += 1
+       metrics.increment("live_chat_turns", bot_id=live_session.bot.bot_id)
+      
+       if live_session.cancellation_token.cancelled:
+           # the cancelled turn may still be running in its thread, on its agent and
+           # checking its token; this turn continues the history on a new agent and token
+           chat_history = list(live_session.chat_bot.super_agent.chat_history)
+           await run_in_chat_thread(
+               live_session.chat_bot.create_super_agent,
+               chat_history=chat_history,
+               verbose=True,
+               cancellation_token=live_session.replace_token(),
+           )
+       source_nodes: List[SourceNodeWithScore] = []
+       token_array: List[str] = []
+       chunks: Optional[AsyncIterator[Optional[str]]] = None
+       finished = False
+       try:
+           response: StreamingAgentChatResponse = await run_in_chat_thread(
+               live_session.chat_bot.chat_stream, user_query=user_query
+           )
+           source_nodes = [
+               SourceNodeWithScore(
+                   node_id=sn.node_id,
+                   url=sn.metadata["url"],
+                   score=sn.score
+               )
+               for sn in response.source_nodes
+           ]
+           yield {"type": "sources", "resources": list({sn.url for sn in source_nodes})}
+          
+           async def tokens() -> AsyncIterator[str]:
+               async for token in iterate_in_thread(response.response_gen):
+                   token_array.append(token)
+                   yield token
+          
+           # websockets have their own keep-alive pings, so no heartbeats are needed
+           chunks = coalesce(
+               tokens(),
+               window_seconds=config.streaming_cfg.CoalesceMs / 1000,
+               max_chars=config.streaming_cfg.CoalesceChars,
+               heartbeat_seconds=None,
+           )
+           async for chunk in chunks:
+               yield {"type": "delta", "text": chunk}
+           finished = True
+       finally:
+           if chunks is not None:
+               await chunks.aclose()
+           if not finished:
+               live_session.cancel_turn()
+               metrics.increment("streams_abandoned")
+           if finished or token_array:
+               live_session.write_behind(
+                   self._db_handler.create_message,
+                   chat_session_id=chat_session_id,
+                   text="".join(token_array),
+                   role=MessageCreatorRole.ASSISTANT,
+                   sources_nodes=source_nodes,
+                   truncated=not finished,
+               )
+      
+       yield {"type": "done", "usage": {"completion_tokens": len(token_array)}}
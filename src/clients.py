@@ -0,0 +1,152 @@
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from llama_index.llms.openai import OpenAI
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from src import config
+from src.concurrency.cancellation import (
+   CANCELLATION_HEADER, AsyncCancellableTransport, CancellableTransport, CancellationToken
+)
+from src.concurrency.priority import AsyncPriorityTransport, PriorityTransport, get_model_call_limiter
+from src.logger import CustomLogger
+
+
+logger = CustomLogger(__name__)
+
+
+"""
+Process-wide OpenAI clients. Bots are rebuilt on every chat turn, so they take their
+LLM and embeddings model from here instead of creating their own; all of them share
+one pooled, keep-alive HTTP client, and one async client for their async calls.
+"""
+
+
+_http_client: Optional[httpx.Client] = None
+_async_http_client: Optional[httpx.AsyncClient] = None
+_llms: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], OpenAI] = {}
+_embed_models: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], OpenAIEmbedding] = {}
+_lock = threading.Lock()
+
+
+def _settings_key(model_name: str, settings: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, Any], ...]]:
+   return model_name, tuple(sorted(settings.items()))
+
+
+def get_http_client() -> httpx.Client:
+   """Pooled HTTP client of every OpenAI request, scheduled by priority."""
+   global _http_client
+   with _lock:
+       if _http_client is None:
+           client_cfg = config.openai_client_cfg
+           transport = httpx.HTTPTransport(
+               limits=httpx.Limits(
+                   max_connections=client_cfg.MaxConnections,
+                   max_keepalive_connections=client_cfg.MaxKeepaliveConnections,
+                   keepalive_expiry=client_cfg.KeepaliveExpirySeconds,
+               ),
+               http2=client_cfg.HTTP2,
+           )
+           _http_client = httpx.Client(
+               transport=CancellableTransport(
+                   PriorityTransport(get_model_call_limiter(), transport=transport)
+               ),
+               timeout=httpx.Timeout(
+                   client_cfg.ReadTimeoutSeconds, connect=client_cfg.ConnectTimeoutSeconds
+               ),
+           )
+           logger.info(message="created shared openai http client", fields=client_cfg.model_dump())
+   return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+   """
+   Async counterpart of `get_http_client`, with its own pool, under the same limiter and
+   cancellation. Its connections belong to the event loop of the app.
+   """
+   global _async_http_client
+   with _lock:
+       if _async_http_client is None:
+           client_cfg = config.openai_client_cfg
+           transport = httpx.AsyncHTTPTransport(
+               limits=httpx.Limits(
+                   max_connections=client_cfg.MaxConnections,
+                   max_keepalive_connections=client_cfg.MaxKeepaliveConnections,
+                   keepalive_expiry=client_cfg.KeepaliveExpirySeconds,
+               ),
+               http2=client_cfg.HTTP2,
+           )
+           _async_http_client = httpx.AsyncClient(
+               transport=AsyncCancellableTransport(
+                   AsyncPriorityTransport(get_model_call_limiter(), transport=transport)
+               ),
+               timeout=httpx.Timeout(
+                   client_cfg.ReadTimeoutSeconds, connect=client_cfg.ConnectTimeoutSeconds
+               ),
+           )
+   return _async_http_client
+
+
+def get_llm(model_name: str, **settings: Any) -> OpenAI:
+   """Shared LLM for `model_name` and `settings`, e.g. `temperature`."""
+   key = _settings_key(model_name, settings)
+   llm = _llms.get(key)
+   if llm is None:
+       http_client = get_http_client()
+       async_http_client = get_async_http_client()
+       with _lock:
+           llm = _llms.get(key)
+           if llm is None:
+               llm = _llms[key] = OpenAI(
+                   model=model_name,
+                   http_client=http_client,
+                   async_http_client=async_http_client,
+                   timeout=config.openai_client_cfg.ReadTimeoutSeconds,
+                   max_retries=config.openai_client_cfg.MaxRetries,
+                   **settings,
+               )
+   return llm
+
+
+def get_embed_model(model_name: str, **settings: Any) -> OpenAIEmbedding:
+   """Shared embeddings model for `model_name` and `settings`, e.g. `embed_batch_size`."""
+   key = _settings_key(model_name, settings)
+   embed_model = _embed_models.get(key)
+   if embed_model is None:
+       http_client = get_http_client()
+       async_http_client = get_async_http_client()
+       with _lock:
+           embed_model = _embed_models.get(key)
+           if embed_model is None:
+               embed_model = _embed_models[key] = OpenAIEmbedding(
+                   model=model_name,
+                   http_client=http_client,
+                   async_http_client=async_http_client,
+                   timeout=config.openai_client_cfg.ReadTimeoutSeconds,
+                   max_retries=config.openai_client_cfg.MaxRetries,
+                   **settings,
+               )
+   return embed_model
+
+
+def with_cancellation(llm: OpenAI, token: CancellationToken) -> OpenAI:
+   """Copy of the shared `llm` whose requests are stopped when `token` is cancelled."""
+   additional_kwargs = dict(llm.additional_kwargs)
+   additional_kwargs["extra_headers"] = {
+       **additional_kwargs.get("extra_headers", {}), CANCELLATION_HEADER: token.id
+   }
+   return llm.model_copy(update={"additional_kwargs": additional_kwargs})
+
+
+async def close_clients() -> None:
+   global _http_client, _async_http_client
+   with _lock:
+       http_client, _http_client = _http_client, None
+       async_http_client, _async_http_client = _async_http_client, None
+       _llms.clear()
+       _embed_models.clear()
+   if http_client is not None:
+       http_client.close()
+   if async_http_client is not None:
+       await async_http_client.aclose()
@@ -0,0 +1,5 @@
+from src.concurrency.admission import AdmissionController, AdmissionRejected, AdmissionTicket
+from src.concurrency.cancellation import CancellationToken, RequestCancelled
+from src.concurrency.priority import Priority, current_priority, priority_scope, run_cpu_bound
+from src.concurrency.single_flight import SingleFlight, SubscriberLease, TokenBroadcast
+from src.concurrency.threads import iterate_in_thread, run_in_chat_thread, shutdown_chat_executor
\ No newline at end of file
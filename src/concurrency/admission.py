@@ -0,0 +1,133 @@
+import math
+import time
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from src.metrics import metrics
+
+
+class AdmissionRejected(Exception):
+   """Raised when a request can not be admitted; `retry_after` is in seconds."""
+   def __init__(self, reason: str, retry_after: int) -> None:
+       super().__init__(f"request rejected: {reason}")
+       self.reason = reason
+       self.retry_after = retry_after
+
+
+class AdmissionTicket:
+   def __init__(self, bot_id: str) -> None:
+       self.bot_id = bot_id
+       self.admitted_at = time.monotonic()
+       self.released = False
+
+
+class AdmissionController:
+   """
+   Caps the chats running at once, globally and per bot. Requests over the caps wait
+   in a bounded FIFO queue for at most `queue_timeout_seconds`; when the queue is
+   full or the wait times out they are rejected with `AdmissionRejected`.
+
+   A queued request whose bot is at its cap does not hold back requests for other
+   bots queued behind it.
+   """
+   def __init__(
+       self,
+       max_concurrent: int = 32,
+       max_concurrent_per_bot: int = 8,
+       max_queue: int = 64,
+       queue_timeout_seconds: float = 10,
+   ) -> None:
+       self._max_concurrent = max_concurrent
+       self._max_concurrent_per_bot = max_concurrent_per_bot
+       self._max_queue = max_queue
+       self._queue_timeout_seconds = queue_timeout_seconds
+       self._in_flight = 0
+       self._in_flight_per_bot: Dict[str, int] = {}
+       self._queue: Deque[Tuple[str, asyncio.Future]] = deque()
+       # moving average of how long a request holds its slot, for `Retry-After`
+       self._mean_service_seconds = 1.0
+
+   def _has_capacity(self, bot_id: str) -> bool:
+       return (
+           self._in_flight < self._max_concurrent
+           and self._in_flight_per_bot.get(bot_id, 0) < self._max_concurrent_per_bot
+       )
+
+   def _admit(self, bot_id: str) -> AdmissionTicket:
+       self._in_flight += 1
+       self._in_flight_per_bot[bot_id] = self._in_flight_per_bot.get(bot_id, 0) + 1
+       self._update_gauges()
+       return AdmissionTicket(bot_id)
+
+   def _update_gauges(self) -> None:
+       metrics.set_gauge("admission_in_flight", self._in_flight)
+       metrics.set_gauge("admission_queue_depth", len(self._queue))
+
+   def _retry_after(self) -> int:
+       waves = (len(self._queue) + 1) / self._max_concurrent
+       return max(1, math.ceil(waves * self._mean_service_seconds))
+
+   def _reject(self, reason: str, bot_id: str) -> AdmissionRejected:
+       metrics.increment("admission_rejected", reason=reason, bot_id=bot_id)
+       return AdmissionRejected(reason=reason, retry_after=self._retry_after())
+
+   async def acquire(self, bot_id: str) -> AdmissionTicket:
+       if not self._queue and self._has_capacity(bot_id):
+           metrics.observe("admission_wait_seconds", 0.0)
+           return self._admit(bot_id)
+
+       if len(self._queue) >= self._max_queue:
+           raise self._reject("queue_full", bot_id)
+
+       waiter = asyncio.get_running_loop().create_future()
+       entry = (bot_id, waiter)
+       self._queue.append(entry)
+       self._update_gauges()
+       # queued requests may fit already, e.g. when only other bots are at their caps
+       self._dispatch()
+       start = time.monotonic()
+       try:
+           ticket = await asyncio.wait_for(asyncio.shield(waiter), self._queue_timeout_seconds)
+       except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+           if entry in self._queue:
+               self._queue.remove(entry)
+               self._update_gauges()
+           elif waiter.done() and not waiter.cancelled():
+               # admitted just as the wait ended, give the slot back
+               self.release(waiter.result())
+           if isinstance(e, asyncio.TimeoutError):
+               raise self._reject("queue_timeout", bot_id)
+           raise
+       metrics.observe("admission_wait_seconds", time.monotonic() - start)
+       return ticket
+
+   def _dispatch(self) -> None:
+       for entry in list(self._queue):
+           if self._in_flight >= self._max_concurrent:
+               break
+           bot_id, waiter = entry
+           if self._has_capacity(bot_id):
+               self._queue.remove(entry)
+               waiter.set_result(self._admit(bot_id))
+       self._update_gauges()
+
+   def release(self, ticket: AdmissionTicket) -> None:
+       if ticket.released:
+           return
+       ticket.released = True
+       self._in_flight -= 1
+       self._in_flight_per_bot[ticket.bot_id] -= 1
+       if not self._in_flight_per_bot[ticket.bot_id]:
+           del self._in_flight_per_bot[ticket.bot_id]
+       service_seconds = time.monotonic() - ticket.admitted_at
+       self._mean_service_seconds = 0.9 * self._mean_service_seconds + 0.1 * service_seconds
+       self._dispatch()
+
+   async def hold(self, ticket: AdmissionTicket, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+       """Keeps the slot until the stream is exhausted or the client goes away."""
+       try:
+           async for chunk in stream:
+               yield chunk
+       finally:
+           self.release(ticket)
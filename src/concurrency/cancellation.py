@@ -0,0 +1,119 @@
+import threading
+import uuid
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+import httpx
+
+
+# header carrying the id of the token that can cancel a request, stripped before sending
+CANCELLATION_HEADER = "X-Cancellation-Token"
+
+
+class RequestCancelled(Exception):
+   """Raised in the thread sending or reading a request whose token was cancelled."""
+
+
+class CancellationToken:
+   """
+   Cancels the OpenAI requests of a chat turn, including their response streams.
+   The LLM calls of the turn send the token id in `CANCELLATION_HEADER`, so the
+   token reaches the agent's own threads, which do not inherit context variables.
+   """
+   _tokens: Dict[str, "CancellationToken"] = {}
+   _lock = threading.Lock()
+
+   def __init__(self) -> None:
+       self.id = str(uuid.uuid4())
+       self._cancelled = threading.Event()
+       with CancellationToken._lock:
+           CancellationToken._tokens[self.id] = self
+
+   @classmethod
+   def get(cls, token_id: str) -> Optional["CancellationToken"]:
+       with cls._lock:
+           return cls._tokens.get(token_id)
+
+   @property
+   def cancelled(self) -> bool:
+       return self._cancelled.is_set()
+
+   def cancel(self) -> None:
+       self._cancelled.set()
+
+   def close(self) -> None:
+       """Forgets the token once its turn is over."""
+       with CancellationToken._lock:
+           CancellationToken._tokens.pop(self.id, None)
+
+   def raise_if_cancelled(self) -> None:
+       if self.cancelled:
+           raise RequestCancelled(f"cancelled by token {self.id}")
+
+
+class _CancellableByteStream(httpx.SyncByteStream):
+   def __init__(self, stream: httpx.SyncByteStream, token: CancellationToken) -> None:
+       self._stream = stream
+       self._token = token
+
+   def __iter__(self) -> Iterator[bytes]:
+       for chunk in self._stream:
+           # stops reading, and the connection closes, as soon as the token is cancelled
+           self._token.raise_if_cancelled()
+           yield chunk
+
+   def close(self) -> None:
+       self._stream.close()
+
+
+class CancellableTransport(httpx.BaseTransport):
+   """httpx transport that stops requests, and their streams, whose token is cancelled."""
+   def __init__(self, transport: httpx.BaseTransport) -> None:
+       self._transport = transport
+
+   def handle_request(self, request: httpx.Request) -> httpx.Response:
+       token_id = request.headers.pop(CANCELLATION_HEADER, None)
+       token = CancellationToken.get(token_id) if token_id else None
+       if token is None:
+           return self._transport.handle_request(request)
+
+       token.raise_if_cancelled()
+       response = self._transport.handle_request(request)
+       response.stream = _CancellableByteStream(response.stream, token)
+       return response
+
+   def close(self) -> None:
+       self._transport.close()
+
+
+class _AsyncCancellableByteStream(httpx.AsyncByteStream):
+   def __init__(self, stream: httpx.AsyncByteStream, token: CancellationToken) -> None:
+       self._stream = stream
+       self._token = token
+
+   async def __aiter__(self) -> AsyncIterator[bytes]:
+       async for chunk in self._stream:
+           self._token.raise_if_cancelled()
+           yield chunk
+
+   async def aclose(self) -> None:
+       await self._stream.aclose()
+
+
+class AsyncCancellableTransport(httpx.AsyncBaseTransport):
+   """`CancellableTransport` of async clients."""
+   def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+       self._transport = transport
+
+   async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+       token_id = request.headers.pop(CANCELLATION_HEADER, None)
+       token = CancellationToken.get(token_id) if token_id else None
+       if token is None:
+           return await self._transport.handle_async_request(request)
+
+       token.raise_if_cancelled()
+       response = await self._transport.handle_async_request(request)
+       response.stream = _AsyncCancellableByteStream(response.stream, token)
+       return response
+
+   async def aclose(self) -> None:
+       await self._transport.aclose()
@@ -0,0 +1,292 @@
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from enum import Enum
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, Optional, TypeVar
+
+import httpx
+
+from src import config
+from src.metrics import metrics
+
+
+T = TypeVar("T")
+
+
+class Priority(str, Enum):
+   INTERACTIVE = "interactive"
+   BACKGROUND = "background"
+
+
+# anything not explicitly marked as background, e.g. a chat, is interactive
+_current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+   "priority", default=Priority.INTERACTIVE
+)
+
+
+def current_priority() -> Priority:
+   return _current_priority.get()
+
+
+@contextmanager
+def priority_scope(priority: Priority) -> Iterator[None]:
+   """Runs the block, and the tasks and threads it starts with the context, at `priority`."""
+   token = _current_priority.set(priority)
+   try:
+       yield
+   finally:
+       _current_priority.reset(token)
+
+
+class _AsyncWaiter:
+   """Queued `PriorityLimiter.aacquire`, granted its slot from whichever thread frees one."""
+   def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+       self.loop = loop
+       self.future: asyncio.Future = loop.create_future()
+       self.granted = False
+
+
+class PriorityLimiter:
+   """
+   Thread-safe limit on concurrent work where queued interactive work always goes
+   before queued background work, except that background work gets at least
+   `background_min_share` of the slots granted while both kinds are waiting.
+   Threads and coroutines wait in the same queues, see `aacquire`.
+   """
+   def __init__(
+       self,
+       name: str,
+       max_concurrent: int,
+       background_min_share: float = 0.2,
+       share_window: int = 50,
+   ) -> None:
+       self._name = name
+       self._max_concurrent = max_concurrent
+       self._background_min_share = background_min_share
+       self._in_use = 0
+       self._queues: Dict[Priority, Deque[object]] = {priority: deque() for priority in Priority}
+       # priorities of the recent grants made while both queues were waiting
+       self._contended_grants: Deque[Priority] = deque(maxlen=share_window)
+       self._condition = threading.Condition()
+
+   def _next_in_line(self) -> Optional[object]:
+       interactive = self._queues[Priority.INTERACTIVE]
+       background = self._queues[Priority.BACKGROUND]
+       if not background:
+           return interactive[0] if interactive else None
+       if not interactive:
+           return background[0]
+
+       # background work is owed a slot once its minimum share of the grants so far,
+       # this one included, adds up to a whole grant it did not get, so contention
+       # starts interactive-first instead of handing an empty window to background work
+       grants = self._contended_grants
+       owed = int(self._background_min_share * (len(grants) + 1) + 1e-9)
+       if grants.count(Priority.BACKGROUND) < owed:
+           return background[0]
+       return interactive[0]
+
+   def acquire(self, priority: Priority) -> None:
+       waiter = object()
+       start = time.perf_counter()
+       with self._condition:
+           self._queues[priority].append(waiter)
+           metrics.set_gauge(f"{self._name}_queue_depth", len(self._queues[priority]), priority=priority.value)
+           while self._in_use >= self._max_concurrent or self._next_in_line() is not waiter:
+               self._condition.wait()
+
+           self._grant(priority)
+           self._grant_async_waiters()
+       metrics.observe(f"{self._name}_wait_seconds", time.perf_counter() - start, priority=priority.value)
+
+   async def aacquire(self, priority: Priority) -> None:
+       """As `acquire`, without blocking the event loop while waiting."""
+       waiter = _AsyncWaiter(asyncio.get_running_loop())
+       start = time.perf_counter()
+       with self._condition:
+           self._queues[priority].append(waiter)
+           metrics.set_gauge(f"{self._name}_queue_depth", len(self._queues[priority]), priority=priority.value)
+           self._grant_async_waiters()
+       try:
+           await waiter.future
+       except BaseException:
+           with self._condition:
+               if not waiter.granted:
+                   self._queues[priority].remove(waiter)
+                   metrics.set_gauge(f"{self._name}_queue_depth", len(self._queues[priority]), priority=priority.value)
+                   # a waiter behind this one may be next in line now
+                   self._condition.notify_all()
+                   self._grant_async_waiters()
+           if waiter.granted and not waiter.future.cancelled():
+               # granted before the cancellation reached the wait
+               self.release()
+           raise
+       metrics.observe(f"{self._name}_wait_seconds", time.perf_counter() - start, priority=priority.value)
+
+   def _grant(self, priority: Priority) -> None:
+       # called with the condition held, for the waiter next in line
+       if self._queues[Priority.INTERACTIVE] and self._queues[Priority.BACKGROUND]:
+           self._contended_grants.append(priority)
+       self._queues[priority].popleft()
+       self._in_use += 1
+       metrics.set_gauge(f"{self._name}_queue_depth", len(self._queues[priority]), priority=priority.value)
+       # the next waiter may fit too
+       self._condition.notify_all()
+
+   def _grant_async_waiters(self) -> None:
+       # called with the condition held; waiting threads grant themselves
+       while self._in_use < self._max_concurrent:
+           waiter = self._next_in_line()
+           if not isinstance(waiter, _AsyncWaiter):
+               return
+           priority = next(
+               priority for priority, queue in self._queues.items() if queue and queue[0] is waiter
+           )
+           waiter.granted = True
+           self._grant(priority)
+           waiter.loop.call_soon_threadsafe(self._wake, waiter)
+
+   def _wake(self, waiter: _AsyncWaiter) -> None:
+       if waiter.future.cancelled():
+           # the waiting task was cancelled after the grant, nobody holds the slot
+           self.release()
+       else:
+           waiter.future.set_result(None)
+
+   def release(self) -> None:
+       with self._condition:
+           self._in_use -= 1
+           self._condition.notify_all()
+           self._grant_async_waiters()
+
+
+class _ReleasingByteStream(httpx.SyncByteStream):
+   def __init__(self, stream: httpx.SyncByteStream, release: Callable[[], None]) -> None:
+       self._stream = stream
+       self._release = release
+
+   def __iter__(self) -> Iterator[bytes]:
+       yield from self._stream
+
+   def close(self) -> None:
+       try:
+           self._stream.close()
+       finally:
+           self._release()
+
+
+class PriorityTransport(httpx.BaseTransport):
+   """
+   httpx transport holding a `PriorityLimiter` slot, at the caller's priority, from
+   sending a request until its response is closed, i.e. for the whole of a stream.
+   """
+   def __init__(self, limiter: PriorityLimiter, transport: Optional[httpx.BaseTransport] = None) -> None:
+       self._limiter = limiter
+       self._transport = transport or httpx.HTTPTransport()
+
+   def handle_request(self, request: httpx.Request) -> httpx.Response:
+       self._limiter.acquire(current_priority())
+       released = threading.Event()
+
+       def release() -> None:
+           if not released.is_set():
+               released.set()
+               self._limiter.release()
+
+       try:
+           response = self._transport.handle_request(request)
+       except BaseException:
+           release()
+           raise
+       response.stream = _ReleasingByteStream(response.stream, release)
+       return response
+
+   def close(self) -> None:
+       self._transport.close()
+
+
+class _AsyncReleasingByteStream(httpx.AsyncByteStream):
+   def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]) -> None:
+       self._stream = stream
+       self._release = release
+
+   async def __aiter__(self) -> AsyncIterator[bytes]:
+       async for chunk in self._stream:
+           yield chunk
+
+   async def aclose(self) -> None:
+       try:
+           await self._stream.aclose()
+       finally:
+           self._release()
+
+
+class AsyncPriorityTransport(httpx.AsyncBaseTransport):
+   """`PriorityTransport` of async clients, waiting for its slot without blocking the loop."""
+   def __init__(
+       self, limiter: PriorityLimiter, transport: Optional[httpx.AsyncBaseTransport] = None
+   ) -> None:
+       self._limiter = limiter
+       self._transport = transport or httpx.AsyncHTTPTransport()
+
+   async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+       await self._limiter.aacquire(current_priority())
+       released = threading.Event()
+
+       def release() -> None:
+           if not released.is_set():
+               released.set()
+               self._limiter.release()
+
+       try:
+           response = await self._transport.handle_async_request(request)
+       except BaseException:
+           release()
+           raise
+       response.stream = _AsyncReleasingByteStream(response.stream, release)
+       return response
+
+   async def aclose(self) -> None:
+       await self._transport.aclose()
+
+
+_model_call_limiter: Optional[PriorityLimiter] = None
+_background_cpu_slots: Optional[threading.BoundedSemaphore] = None
+_lock = threading.Lock()
+
+
+def get_model_call_limiter() -> PriorityLimiter:
+   """Process-wide limiter of OpenAI requests, see `src.clients`."""
+   global _model_call_limiter
+   with _lock:
+       if _model_call_limiter is None:
+           _model_call_limiter = PriorityLimiter(
+               name="model_calls",
+               max_concurrent=config.scheduler_cfg.MaxConcurrentModelCalls,
+               background_min_share=config.scheduler_cfg.BackgroundMinShare,
+           )
+   return _model_call_limiter
+
+
+def _run_background_cpu_work(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+   global _background_cpu_slots
+   with _lock:
+       if _background_cpu_slots is None:
+           _background_cpu_slots = threading.BoundedSemaphore(
+               config.scheduler_cfg.BackgroundCPUWorkers
+           )
+   with _background_cpu_slots:
+       return fn(*args, **kwargs)
+
+
+async def run_cpu_bound(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+   """
+   Runs blocking work in a worker thread, off the event loop. Background work runs on
+   at most `BackgroundCPUWorkers` threads at a time so it can not crowd out chats.
+   """
+   if current_priority() == Priority.BACKGROUND:
+       return await asyncio.to_thread(_run_background_cpu_work, fn, *args, **kwargs)
+   return await asyncio.to_thread(fn, *args, **kwargs)
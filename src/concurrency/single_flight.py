@@ -0,0 +1,199 @@
+import asyncio
+from typing import (
+   Any, AsyncIterator, Awaitable, Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+)
+
+from src.concurrency.cancellation import CancellationToken
+from src.metrics import metrics
+
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+   """
+   Runs at most one flight per key: callers joining a key that is already in flight
+   share it instead of starting their own. A flight is anything with `done` and
+   `add_done_callback`, e.g. an `asyncio.Task` or a `TokenBroadcast`; its key is
+   released once it is done, so later callers start a fresh flight.
+   """
+   def __init__(self, name: str) -> None:
+       self._name = name
+       self._flights: Dict[Hashable, T] = {}
+
+   def join(self, key: Hashable, launch: Callable[[], T]) -> Tuple[T, bool]:
+       """Returns the flight of `key`, launching it if needed, and whether this call launched it."""
+       flight = self._flights.get(key)
+       if flight is not None and not flight.done():
+           metrics.increment("single_flight_joined", flight=self._name)
+           return flight, False
+
+       flight = launch()
+       self._flights[key] = flight
+       flight.add_done_callback(lambda _: self._release(key, flight))
+       metrics.increment("single_flight_launched", flight=self._name)
+       return flight, True
+
+   def _release(self, key: Hashable, flight: T) -> None:
+       if self._flights.get(key) is flight:
+           del self._flights[key]
+
+   async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+       """
+       Awaits the result of `fn` shared by every concurrent caller with the same key.
+       The computation runs in its own task, so a cancelled caller does not cancel it
+       for the others.
+       """
+       task, _ = self.join(key, lambda: asyncio.ensure_future(fn()))
+       return await asyncio.shield(task)
+
+
+class TokenBroadcast:
+   """
+   Fans a token stream out to any number of subscribers. Every subscriber gets the
+   whole stream from the first token, however late it subscribes. The producer runs
+   in its own task, so it outlives any one subscriber; once every subscriber has
+   gone away it is cancelled, along with the LLM requests of `cancellation_token`.
+   """
+   # moving average of the tokens of finished streams, to estimate what a cancellation saves
+   _mean_stream_tokens = 0.0
+
+   def __init__(
+       self,
+       produce: Callable[["TokenBroadcast"], Awaitable[None]],
+       cancellation_token: Optional[CancellationToken] = None,
+   ) -> None:
+       self.source_nodes: List[Any] = []
+       self._tokens: List[str] = []
+       self._started = False
+       self._finished = False
+       self._error: Optional[BaseException] = None
+       self._subscribers = 0
+       self._cancelled = False
+       self._cancellation_token = cancellation_token
+       self._changed = asyncio.Condition()
+       self._task = asyncio.ensure_future(self._run(produce))
+
+   async def _run(self, produce: Callable[["TokenBroadcast"], Awaitable[None]]) -> None:
+       try:
+           await produce(self)
+       except BaseException as e:
+           self._error = e
+       else:
+           TokenBroadcast._mean_stream_tokens = (
+               0.9 * TokenBroadcast._mean_stream_tokens + 0.1 * len(self._tokens)
+           )
+       finally:
+           if self._cancellation_token is not None:
+               self._cancellation_token.close()
+           async with self._changed:
+               self._finished = True
+               self._changed.notify_all()
+
+   def add_done_callback(self, callback: Callable[[Any], None]) -> None:
+       self._task.add_done_callback(callback)
+
+   def done(self) -> bool:
+       return self._finished or self._cancelled
+
+   @property
+   def finished(self) -> bool:
+       return self._finished
+
+   def add_subscriber(self) -> None:
+       self._subscribers += 1
+
+   def remove_subscriber(self) -> None:
+       self._subscribers -= 1
+       if self._subscribers == 0 and not self._finished:
+           self.cancel()
+
+   def cancel(self) -> None:
+       """Stops the producer and its LLM requests."""
+       self._cancelled = True
+       if self._cancellation_token is not None:
+           self._cancellation_token.cancel()
+       self._task.cancel()
+       metrics.increment("stream_generations_cancelled")
+       metrics.increment(
+           "stream_tokens_saved_estimate",
+           max(TokenBroadcast._mean_stream_tokens - len(self._tokens), 0.0),
+       )
+
+   @property
+   def text(self) -> str:
+       return "".join(self._tokens)
+
+   @property
+   def tokens(self) -> List[str]:
+       return list(self._tokens)
+
+   async def start(self, source_nodes: List[Any]) -> None:
+       """Called by the producer once the sources are known, before the first token."""
+       async with self._changed:
+           self.source_nodes = source_nodes
+           self._started = True
+           self._changed.notify_all()
+
+   async def publish(self, token: str) -> None:
+       async with self._changed:
+           self._tokens.append(token)
+           self._changed.notify_all()
+
+   async def wait_started(self) -> None:
+       """Waits for the sources; raises the producer's error if it failed before that."""
+       async with self._changed:
+           await self._changed.wait_for(lambda: self._started or self._finished)
+       if not self._started and self._error is not None:
+           raise self._error
+
+   async def subscribe(self) -> AsyncIterator[str]:
+       await self.wait_started()
+       position = 0
+       while True:
+           async with self._changed:
+               await self._changed.wait_for(
+                   lambda: position < len(self._tokens) or self._finished
+               )
+               new_tokens = self._tokens[position:]
+               finished = self._finished
+           for token in new_tokens:
+               yield token
+           position += len(new_tokens)
+           if finished and position >= len(self._tokens):
+               if self._error is not None:
+                   raise self._error
+               return
+
+
+class SubscriberLease:
+   """
+   A subscription to a `TokenBroadcast`, taken before the stream reading it is handed
+   out and released exactly once: by the stream when it ends, or by the response
+   serving it when the response is over, e.g. the client left before the stream was
+   first read. Only a stream that never started is abandoned, `on_abandoned` then
+   runs as well; a started stream records its own end.
+   """
+   def __init__(
+       self, broadcast: TokenBroadcast, on_abandoned: Optional[Callable[[], None]] = None
+   ) -> None:
+       broadcast.add_subscriber()
+       self._broadcast = broadcast
+       self._on_abandoned = on_abandoned
+       self._released = False
+       self._started = False
+
+   def mark_started(self) -> None:
+       self._started = True
+
+   def release(self) -> None:
+       if not self._released:
+           self._released = True
+           self._broadcast.remove_subscriber()
+
+   def abandon(self) -> None:
+       """Releases the lease once its response is over, a no-op after `release`."""
+       if not self._released:
+           self.release()
+           if not self._started and self._on_abandoned is not None:
+               self._on_abandoned()
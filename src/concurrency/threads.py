@@ -0,0 +1,64 @@
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator, Optional, TypeVar
+
+from src import config
+
+
+T = TypeVar("T")
+
+_END = object()
+
+_chat_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def get_chat_executor() -> ThreadPoolExecutor:
+   """
+   Threads of the blocking LLM calls and token streams of chats. An admitted chat holds
+   at most one of them at a time, so with one per `MaxConcurrentChats` chats never wait
+   for a thread, and never take the default executor from the rest of the app.
+   """
+   global _chat_executor
+   with _lock:
+       if _chat_executor is None:
+           _chat_executor = ThreadPoolExecutor(
+               max_workers=max(1, config.admission_cfg.MaxConcurrentChats),
+               thread_name_prefix="chat",
+           )
+   return _chat_executor
+
+
+async def run_in_chat_thread(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+   """As `asyncio.to_thread`, on the chat executor."""
+   loop = asyncio.get_running_loop()
+   # the context carries the priority of the chat into the thread
+   context = contextvars.copy_context()
+   return await loop.run_in_executor(
+       get_chat_executor(), functools.partial(context.run, fn, *args, **kwargs)
+   )
+
+
+async def iterate_in_thread(iterator: Iterator[T]) -> AsyncIterator[T]:
+   """
+   Iterates a blocking iterator, e.g. the `response_gen` of a streaming chat response,
+   on the chat executor so the event loop keeps serving other requests between items.
+   """
+   iterator = iter(iterator)
+   while True:
+       item = await run_in_chat_thread(next, iterator, _END)
+       if item is _END:
+           return
+       yield item
+
+
+def shutdown_chat_executor() -> None:
+   """Stops the threads of the chat executor once their current call returns."""
+   global _chat_executor
+   with _lock:
+       if _chat_executor is not None:
+           _chat_executor.shutdown(wait=False, cancel_futures=True)
+           _chat_executor = None
@@ -1,12 +1,12 @@
 import os
 import json
-from typing import Optional
+from typing import Optional, Union
 
 from pydantic import Field, BaseModel
 from dotenv import load_dotenv
 
 from src.logger import CustomLogger
-from src.config_constants import MONGO_DB, CHROMA_DB
+from src.config_constants import MONGO_DB, CHROMA_DB, QUANTIZED, IVF
 
 
 logger = CustomLogger(__name__)
@@ -20,6 +20,10 @@ class APPCfg(BaseModel):
         description="DB to be used for storing ragbot metadata, docstore, and index store"
     )
     GithubAccessToken: Optional[str] = Field(description="for accessing github api")
+    Workers: int = Field(default=1, description="Number of server worker processes")
+    GracefulShutdownSeconds: Optional[float] = Field(
+        default=30, description="Time given to in-flight requests on shutdown, unlimited if null"
+    )
 
 
 class OpenAICfg(BaseModel):
@@ -29,15 +33,53 @@ class OpenAICfg(BaseModel):
     )
 
 
+class OpenAIClientCfg(BaseModel):
+    MaxConnections: int = Field(default=100, description="Pooled connections to the OpenAI API")
+    MaxKeepaliveConnections: int = Field(default=20, description="Idle connections kept open")
+    KeepaliveExpirySeconds: float = Field(default=30, description="Idle time before a connection is closed")
+    HTTP2: bool = Field(default=False, description="Use HTTP/2, needs the `h2` package")
+    ConnectTimeoutSeconds: float = Field(default=5, description="Timeout for opening a connection")
+    ReadTimeoutSeconds: float = Field(default=60, description="Timeout of a request")
+    MaxRetries: int = Field(default=3, description="Retries of failed or rate limited requests")
+
+
 class MongoDBCollections(BaseModel):
     RagBots: str = Field(description="Collection to store ragbot metadata")
     ChatSessions: str = Field(description="Collection to store chat sessions")
 
 
+class WriteBehindCfg(BaseModel):
+    Enabled: bool = Field(default=False, description="Buffer message writes into bulk writes")
+    MaxBatchSize: int = Field(default=100, description="Buffered writes that trigger a bulk write")
+    FlushIntervalMs: float = Field(default=200, description="Longest a buffered write waits to be written")
+    MaxAttempts: int = Field(default=3, description="Attempts of a failing write before it is dropped")
+    ReadYourWrites: bool = Field(
+        default=True, description="Chat sessions read from the database include their buffered messages"
+    )
+
+
+class BotCacheCfg(BaseModel):
+    Enabled: bool = Field(default=True, description="Cache bots read from the database in process")
+    TTLSeconds: float = Field(default=300, description="Seconds a cached bot stays valid")
+    MaxEntries: int = Field(default=10000, description="Least recently used bots are evicted beyond this")
+    Invalidation: Optional[str] = Field(
+        default=None,
+        description="How updates from other processes are seen: `poll`, `change_stream`, or unset for the TTL only",
+    )
+    PollIntervalSeconds: float = Field(default=5, description="Interval between polls of the cached bots' versions")
+
+
 class MongoDBCfg(BaseModel):
     URI: str = Field(description="MongoDB URI connection string")
     DBName: str = Field(description="Name of the MongoDB database")
     Collections: MongoDBCollections = Field(description="Collections in the MongoDB")
+    WriteBehind: WriteBehindCfg = Field(default_factory=WriteBehindCfg)
+    BotCache: BotCacheCfg = Field(default_factory=BotCacheCfg)
+    CreateIndexes: bool = Field(default=True, description="Create the indexes of the handler's queries at startup")
+    TrustedReads: bool = Field(
+        default=True, description="Build chat sessions read from the database without validating them again"
+    )
+    MaxPageSize: int = Field(default=100, description="Largest page returned by the listing endpoints")
 
 
 class LlamaDocstoreCfg(BaseModel):
@@ -52,10 +94,32 @@ class LlamaIndexStoreCfg(BaseModel):
 
 class LlamaVectorStoreCfg(BaseModel):
     DirPath: str = Field(description="Directory path for storing vectors")
-    DbName: str = Field(description="Name of the database for storing vectors")
+    DbName: Optional[str] = Field(
+        default=None, description="Name of the database for storing vectors"
+    )
     CollectionName: str = Field(description="Name of the collection for storing vectors")
 
 
+class LlamaQuantizedVectorStoreCfg(LlamaVectorStoreCfg):
+    Quantization: str = Field(
+        default="int8", description="Compression of the in-memory vectors: `int8` or `pq`"
+    )
+    RescoreFactor: int = Field(
+        default=4,
+        description="Candidates re-scored with full-precision vectors, as a multiple of top-k",
+    )
+    PQSubvectors: int = Field(
+        default=96, description="Number of sub-vectors (code bytes per vector) for `pq`"
+    )
+
+
+class LlamaIVFVectorStoreCfg(LlamaVectorStoreCfg):
+    NList: int = Field(default=1024, description="Number of k-means coarse partitions")
+    NProbe: int = Field(
+        default=16, description="Default number of partitions scanned per query"
+    )
+
+
 class LlamaIndexCfg(BaseModel):
     MongoURI: Optional[str] = Field(
         description="MongoDB URI connection string for docstore and indexstore"
@@ -64,19 +128,165 @@ class LlamaIndexCfg(BaseModel):
     VectorStoreType: str = Field(description="Type of vector store to be used")
     DocStore: LlamaDocstoreCfg = Field(description="Configuration for docstore")
     IndexStore: LlamaIndexStoreCfg = Field(description="Configuration for index store")
-    VectorStore: LlamaVectorStoreCfg = Field(description="Configuration for vector store")
+    VectorStore: Union[
+        LlamaQuantizedVectorStoreCfg, LlamaIVFVectorStoreCfg, LlamaVectorStoreCfg
+    ] = Field(
+        description="Configuration for vector store"
+    )
+
+
+class RetrievalCfg(BaseModel):
+    Mode: str = Field(
+        default="dense",
+        description="`dense`, or `hybrid` for BM25 + dense retrieval fused with reciprocal rank fusion",
+    )
+    SimilarityTopK: int = Field(default=2, description="Nodes returned per retrieval")
+    LexicalTopK: int = Field(default=10, description="BM25 candidates fused in hybrid mode")
+    RRFK: int = Field(default=60, description="Rank constant of reciprocal rank fusion")
+
+
+class PostProcessingCfg(BaseModel):
+    SimilarityCutoff: Optional[float] = Field(
+        default=None, description="Drop retrieved nodes scoring below this value"
+    )
+    RelativeScoreCutoff: Optional[float] = Field(
+        default=None, description="Drop retrieved nodes scoring below this fraction of the best score"
+    )
+    DedupThreshold: Optional[float] = Field(
+        default=0.9, description="Word 3-gram Jaccard similarity above which a node is a near-duplicate"
+    )
+    LexicalRerankWeight: float = Field(
+        default=0.0, description="Weight of query term overlap when reranking, 0 disables reranking"
+    )
+    ContextTokenBudget: Optional[int] = Field(
+        default=None, description="Maximum tokens of retrieved context sent to the synthesizer"
+    )
+
+
+class AnswerCacheCfg(BaseModel):
+    Enabled: bool = Field(default=False, description="Serve repeated questions from the answer cache")
+    TTLSeconds: float = Field(default=3600, description="Seconds a cached answer stays valid")
+    MaxEntries: int = Field(default=10000, description="Least recently used answers are evicted beyond this")
+    SimilarityThreshold: Optional[float] = Field(
+        default=None,
+        description="Cosine similarity of query embeddings for a near match, unset for exact match only",
+    )
+    KeyOnHistory: bool = Field(
+        default=True,
+        description="Only reuse answers given after the same earlier messages of a chat session",
+    )
+
+
+class QueryEmbeddingCfg(BaseModel):
+    CacheSize: int = Field(default=10000, description="Query embeddings memoised per process")
+    BatchWindowMs: float = Field(
+        default=5, description="Queries arriving within this window are embedded in one request"
+    )
+    MaxBatchSize: int = Field(default=64, description="Maximum queries per embeddings request")
+
+
+class IndexCacheCfg(BaseModel):
+    MaxEntries: int = Field(default=256, description="Indexes kept loaded per process")
+
+
+class AdmissionCfg(BaseModel):
+    MaxConcurrentChats: int = Field(default=32, description="Chats answered at once by the process")
+    MaxConcurrentChatsPerBot: int = Field(default=8, description="Chats answered at once per bot")
+    MaxQueuedChats: int = Field(
+        default=64, description="Chats waiting for a slot; more are rejected with 429"
+    )
+    QueueTimeoutSeconds: float = Field(
+        default=10, description="Longest wait for a slot before a chat is rejected with 429"
+    )
+
+
+class SchedulerCfg(BaseModel):
+    MaxConcurrentModelCalls: int = Field(
+        default=16, description="OpenAI requests in flight at once; chats go before ingestion"
+    )
+    BackgroundMinShare: float = Field(
+        default=0.2, description="Minimum share of contended OpenAI request slots given to ingestion"
+    )
+    BackgroundCPUWorkers: int = Field(
+        default=1, description="Threads running ingestion parsing and indexing at once"
+    )
+
+
+class StreamingCfg(BaseModel):
+    Format: str = Field(
+        default="raw",
+        description="`raw`: a data frame per token, `json`: typed JSON events with coalesced tokens",
+    )
+    CoalesceMs: float = Field(default=50, description="Longest a token waits to be sent in `json` format")
+    CoalesceChars: int = Field(default=256, description="Characters that flush a `json` delta at once")
+    HeartbeatSeconds: float = Field(default=15, description="Idle time before a `json` stream sends a ping")
+
+
+class StartupCfg(BaseModel):
+    WarmupStores: bool = Field(
+        default=False,
+        description="Connect the docstore, index store and vector store before serving, "
+        "instead of on the first chat",
+    )
+    PrewarmBots: int = Field(
+        default=0, description="Most active bots whose indexes are loaded at startup, 0 disables"
+    )
+    PrewarmLookbackHours: float = Field(
+        default=24, description="Bots are ranked by their chat sessions updated in this window"
+    )
+    PrewarmConcurrency: int = Field(default=4, description="Bots loaded at once while prewarming")
+    PrewarmTimeoutSeconds: float = Field(
+        default=120, description="The app reports ready after this long even if prewarming is not done"
+    )
+
+
+class PlacementCfg(BaseModel):
+    Enabled: bool = Field(
+        default=False,
+        description="Place bots on worker processes by consistent hashing behind a local dispatcher",
+    )
+    SocketDir: str = Field(
+        default="/tmp/rag-bot-engine", description="Directory of the Unix sockets of the workers"
+    )
+    Replicas: int = Field(default=100, description="Points of every worker on the hash ring")
+    HealthCheckSeconds: float = Field(
+        default=2, description="Interval of worker health checks, workers failing one leave the ring"
+    )
+
+
+class IngestCfg(BaseModel):
+    ResourceConcurrency: int = Field(
+        default=4, description="Resources read, parsed and embedded at once by `python -m src.ingest`"
+    )
+    MaxConcurrentModelCalls: int = Field(
+        default=32, description="OpenAI requests in flight at once during offline ingestion"
+    )
 
 
 app_cfg: APPCfg
 openai_cfg: OpenAICfg
+openai_client_cfg: OpenAIClientCfg
 mongo_db_cfg: MongoDBCfg
 llama_index_cfg: LlamaIndexCfg
+retrieval_cfg: RetrievalCfg
+postprocessing_cfg: PostProcessingCfg
+answer_cache_cfg: AnswerCacheCfg
+query_embedding_cfg: QueryEmbeddingCfg
+index_cache_cfg: IndexCacheCfg
+admission_cfg: AdmissionCfg
+scheduler_cfg: SchedulerCfg
+streaming_cfg: StreamingCfg
+startup_cfg: StartupCfg
+placement_cfg: PlacementCfg
+ingest_cfg: IngestCfg
 
 
 CONFIG_FILEPATH_ENV_VAR = "CONFIG_FILEPATH"
+ENV_FILEPATH_ENV_VAR = "ENV_FILEPATH"
 
 
 def load_config(app_version: str, config_json_path: str, env_path: str):
+    env_path = os.getenv(ENV_FILEPATH_ENV_VAR, env_path)
     load_dotenv(dotenv_path=env_path)
     logger.info(f"loaded env vars from `{env_path}`")
 
@@ -85,7 +295,10 @@ def load_config(app_version: str, config_json_path: str, env_path: str):
     with open(config_json_path, "r") as f:
         config = json.load(f)
 
-    global app_cfg, openai_cfg, mongo_db_cfg, llama_index_cfg
+    global app_cfg, openai_cfg, mongo_db_cfg, llama_index_cfg, retrieval_cfg, postprocessing_cfg
+    global answer_cache_cfg, query_embedding_cfg, admission_cfg, scheduler_cfg
+    global openai_client_cfg, streaming_cfg, startup_cfg, index_cache_cfg, placement_cfg
+    global ingest_cfg
 
     app_cfg = APPCfg(
         Host=config["Host"],
@@ -93,6 +306,8 @@ def load_config(app_version: str, config_json_path: str, env_path: str):
         Version=app_version,
         DbStore=config["DbStore"],
         GithubAccessToken=os.getenv("GITHUB_ACCESS_TOKEN", None),
+        Workers=config.get("Workers", 1),
+        GracefulShutdownSeconds=config.get("GracefulShutdownSeconds", 30),
     )
     app_cfg_dict = app_cfg.model_dump()
     app_cfg_dict["GithubAccessToken"] = "********"
@@ -106,6 +321,9 @@ def load_config(app_version: str, config_json_path: str, env_path: str):
         message="loaded openai config", fields=openai_cfg.model_dump()
     )
 
+    openai_client_cfg = OpenAIClientCfg(**config["OpenAI"].get("Client", {}))
+    logger.info(message="loaded openai client config", fields=openai_client_cfg.model_dump())
+
     if app_cfg.DbStore == MONGO_DB:
         mongo_db_cfg = MongoDBCfg(
             URI=os.environ.get("MONGO_DB_URI", None),
@@ -114,6 +332,11 @@ def load_config(app_version: str, config_json_path: str, env_path: str):
                 RagBots=config["MongoDB"]["Collections"]["RagBots"],
                 ChatSessions=config["MongoDB"]["Collections"]["ChatSessions"],
             ),
+            WriteBehind=WriteBehindCfg(**config["MongoDB"].get("WriteBehind", {})),
+            BotCache=BotCacheCfg(**config["MongoDB"].get("BotCache", {})),
+            CreateIndexes=config["MongoDB"].get("CreateIndexes", True),
+            TrustedReads=config["MongoDB"].get("TrustedReads", True),
+            MaxPageSize=config["MongoDB"].get("MaxPageSize", 100),
         )
 
         mongo_db_cfg_dict = mongo_db_cfg.model_dump()
@@ -143,6 +366,23 @@ def load_config(app_version: str, config_json_path: str, env_path: str):
             DbName=config["LlamaIndex"]["VectorStore"]["ChromaDB"]["DBName"],
             CollectionName=config["LlamaIndex"]["VectorStore"]["ChromaDB"]["CollectionName"]
         )
+    elif config["LlamaIndex"]["VectorStoreType"] == QUANTIZED:
+        quantized_cfg = config["LlamaIndex"]["VectorStore"][QUANTIZED]
+        vector_store_cfg = LlamaQuantizedVectorStoreCfg(
+            DirPath=quantized_cfg["DirPath"],
+            CollectionName=quantized_cfg["CollectionName"],
+            Quantization=quantized_cfg.get("Quantization", "int8"),
+            RescoreFactor=quantized_cfg.get("RescoreFactor", 4),
+            PQSubvectors=quantized_cfg.get("PQSubvectors", 96),
+        )
+    elif config["LlamaIndex"]["VectorStoreType"] == IVF:
+        ivf_cfg = config["LlamaIndex"]["VectorStore"][IVF]
+        vector_store_cfg = LlamaIVFVectorStoreCfg(
+            DirPath=ivf_cfg["DirPath"],
+            CollectionName=ivf_cfg["CollectionName"],
+            NList=ivf_cfg.get("NList", 1024),
+            NProbe=ivf_cfg.get("NProbe", 16),
+        )
 
     llama_index_cfg = LlamaIndexCfg(
         MongoURI=os.environ.get("MONGO_DB_URI", None),
@@ -160,5 +400,38 @@ def load_config(app_version: str, config_json_path: str, env_path: str):
         fields=llama_index_cfg_dict
     )
 
+    retrieval_cfg = RetrievalCfg(**config.get("Retrieval", {}))
+    logger.info(message="loaded retrieval config", fields=retrieval_cfg.model_dump())
+
+    postprocessing_cfg = PostProcessingCfg(**config.get("PostProcessing", {}))
+    logger.info(message="loaded post processing config", fields=postprocessing_cfg.model_dump())
+
+    answer_cache_cfg = AnswerCacheCfg(**config.get("AnswerCache", {}))
+    logger.info(message="loaded answer cache config", fields=answer_cache_cfg.model_dump())
+
+    query_embedding_cfg = QueryEmbeddingCfg(**config.get("QueryEmbedding", {}))
+    logger.info(message="loaded query embedding config", fields=query_embedding_cfg.model_dump())
+
+    index_cache_cfg = IndexCacheCfg(**config.get("IndexCache", {}))
+    logger.info(message="loaded index cache config", fields=index_cache_cfg.model_dump())
+
+    admission_cfg = AdmissionCfg(**config.get("Admission", {}))
+    logger.info(message="loaded admission config", fields=admission_cfg.model_dump())
+
+    scheduler_cfg = SchedulerCfg(**config.get("Scheduler", {}))
+    logger.info(message="loaded scheduler config", fields=scheduler_cfg.model_dump())
+
+    streaming_cfg = StreamingCfg(**config.get("Streaming", {}))
+    logger.info(message="loaded streaming config", fields=streaming_cfg.model_dump())
+
+    startup_cfg = StartupCfg(**config.get("Startup", {}))
+    logger.info(message="loaded startup config", fields=startup_cfg.model_dump())
+
+    placement_cfg = PlacementCfg(**config.get("Placement", {}))
+    logger.info(message="loaded placement config", fields=placement_cfg.model_dump())
+
+    ingest_cfg = IngestCfg(**config.get("Ingest", {}))
+    logger.info(message="loaded ingest config", fields=ingest_cfg.model_dump())
+
     return config
 
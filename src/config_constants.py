@@ -1,2 +1,10 @@
 MONGO_DB = "MongoDB"
-CHROMA_DB = "ChromaDB"
\ No newline at end of file
+CHROMA_DB = "ChromaDB"
+QUANTIZED = "Quantized"
+IVF = "IVF"
+
+DENSE_RETRIEVAL = "dense"
+HYBRID_RETRIEVAL = "hybrid"
+
+# metadata key of the index id of every ingested node
+DOC_INDEX_ID_METADATA_KEY = "index_id"
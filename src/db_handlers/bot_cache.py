@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from src.db_handlers.schemas import RagBot
+from src.metrics import metrics
+
+
+class BotCache:
+   """
+   In-process cache of `RagBot` objects keyed by bot id, each stored with the version
+   of the document it was read from. Entries expire after `ttl_seconds` and the least
+   recently used entries are evicted beyond `max_entries`.
+
+   Cached bots are shared between callers and must not be modified.
+   """
+   def __init__(self, ttl_seconds: float = 300, max_entries: int = 10000) -> None:
+       self._ttl_seconds = ttl_seconds
+       self._max_entries = max_entries
+       self._entries: "OrderedDict[str, Tuple[RagBot, int, float]]" = OrderedDict()
+       self._lock = threading.Lock()
+
+   def get(self, bot_id: str) -> Optional[RagBot]:
+       with self._lock:
+           entry = self._entries.get(bot_id)
+           if entry is not None and time.monotonic() - entry[2] > self._ttl_seconds:
+               del self._entries[bot_id]
+               entry = None
+           if entry is not None:
+               self._entries.move_to_end(bot_id)
+       metrics.increment("bot_cache_hits" if entry is not None else "bot_cache_misses")
+       return entry[0] if entry is not None else None
+
+   def put(self, bot: RagBot, version: int = 0) -> None:
+       with self._lock:
+           self._entries[bot.bot_id] = (bot, version, time.monotonic())
+           self._entries.move_to_end(bot.bot_id)
+           while len(self._entries) > self._max_entries:
+               self._entries.popitem(last=False)
+           metrics.set_gauge("bot_cache_entries", len(self._entries))
+
+   def invalidate(self, bot_id: str) -> None:
+       with self._lock:
+           if self._entries.pop(bot_id, None) is not None:
+               metrics.increment("bot_cache_invalidations")
+           metrics.set_gauge("bot_cache_entries", len(self._entries))
+
+   def versions(self) -> Dict[str, int]:
+       """Version of every cached bot, compared with the database by the poller."""
+       with self._lock:
+           return {bot_id: entry[1] for bot_id, entry in self._entries.items()}
+
+   def clear(self) -> None:
+       with self._lock:
+           self._entries.clear()
+           metrics.set_gauge("bot_cache_entries", 0)
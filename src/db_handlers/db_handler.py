@@ -1,11 +1,13 @@
 from abc import ABC, abstractmethod
-from typing import List, Union, Dict
+from typing import List, Optional, Tuple, Union, Dict
 
 
 from src.db_handlers.schemas import (
    BotIndex,
    RagBot,
+   RagBotPage,
    ChatSession,
+   ChatSessionPage,
    User,
    FeedbackLabel,
    Message,
@@ -14,6 +16,7 @@ from src.db_handlers.schemas import (
    SourceNodeWithScore,
 )
 from src.db_handlers.utils import create_unique_id
+from src.db_handlers.write_behind import MESSAGE, BufferedWrite, WriteBehindBuffer
 
 
 class DBHandler(ABC):
@@ -23,6 +26,8 @@ class DBHandler(ABC):
   
    _instance = None
    _calling_from_handler: bool = False
+   # set by handlers that buffer message writes
+   _write_buffer: Optional[WriteBehindBuffer] = None
   
    @classmethod
    def get_instance(cls, *args, **kwargs):
@@ -50,6 +55,26 @@ class DBHandler(ABC):
        """
        raise NotImplementedError
   
+   def flush(self):
+       """
+       Write the buffered writes, if any.
+       """
+       if self._write_buffer is not None:
+           self._write_buffer.flush()
+  
+   def close(self):
+       """
+       Write the buffered writes and stop buffering; later writes go straight to the database.
+       """
+       write_buffer, self._write_buffer = self._write_buffer, None
+       if write_buffer is not None:
+           write_buffer.close()
+  
+   def _with_buffered_messages(self, chat_session: Optional[ChatSession]) -> Optional[ChatSession]:
+       if chat_session is None or self._write_buffer is None:
+           return chat_session
+       return self._write_buffer.overlay(chat_session)
+  
    @staticmethod
    def new_chat_session_id() -> str:
        """
@@ -85,6 +110,16 @@ class DBHandler(ABC):
    def get_all_bots(self) -> List[RagBot]:
        raise NotImplementedError
   
+   @abstractmethod
+   def list_bots(
+       self, limit: int, after: Optional[str] = None, email: Optional[str] = None
+   ) -> RagBotPage:
+       """
+       Get a page of bots, newest first, optionally only the bots of a user.
+       `after` is the `next_after` cursor of the previous page.
+       """
+       raise NotImplementedError
+  
    @abstractmethod
    def update_bot_status(self, bot_id: str, status: bool):
        raise NotImplementedError
@@ -108,12 +143,18 @@ class DBHandler(ABC):
        raise NotImplementedError
   
    def create_session(
-       self, bot_id: str,  user: User, chat_session_id: str = None, chat_session_name: str = None
+       self,
+       bot_id: str,
+       user: User,
+       chat_session_id: str = None,
+       chat_session_name: str = None,
+       check_bot: bool = True,
    ) -> ChatSession:
        """
-       Create a new chat session.
+       Create a new chat session, unless it already exists.
+       Callers that have just loaded the bot can skip the bot lookup with `check_bot=False`.
        """
-       if not self._bot_exists(bot_id = bot_id):
+       if check_bot and not self._bot_exists(bot_id = bot_id):
            raise ValueError(f"Bot with id: {bot_id} does not exist.")
        if chat_session_id == None:
            chat_session_id = self.new_chat_session_id()
@@ -134,9 +175,10 @@ class DBHandler(ABC):
        raise NotImplementedError
   
    @abstractmethod
-   def _insert_chat_session_feedback(self, chat_session_id: str, feedback: UserFeedback):
+   def _insert_chat_session_feedback(self, bot_id: str, chat_session_id: str, feedback: UserFeedback):
        """
-       Insert feedback for a chat session.
+       Insert feedback for a chat session, in a single conditional update.
+       Raises `ValueError` when the bot has no such chat session.
        """
        raise NotImplementedError
   
@@ -151,10 +193,7 @@ class DBHandler(ABC):
        """
        Append user feedback to a chat session.
        """
-       if not self._chat_session_exists(bot_id=bot_id, chat_session_id=chat_session_id):
-               raise ValueError(f"Either the bot with id: {bot_id} does not exist "
-                               f"or the chat session with id: {chat_session_id} does not exist.")
-      
+       # written right away, not behind, so a missing session is reported to the caller
        feedback = UserFeedback(user=user, feedback_text=text, feedback_label=label)
        return self._insert_chat_session_feedback(bot_id=bot_id, chat_session_id=chat_session_id, feedback=feedback)
   
@@ -180,9 +219,39 @@ class DBHandler(ABC):
        raise NotImplementedError
   
    @abstractmethod
-   def _insert_message_feedback(self, chat_session_id: str, message_id: str, feedback: UserFeedback):
+   def list_chat_sessions(
+       self, bot_id: str, limit: int, after: Optional[str] = None, user: Optional[User] = None
+   ) -> ChatSessionPage:
+       """
+       Get a page of the headers of the sessions of a bot, newest first, optionally
+       only the sessions of a user. `after` is the `next_after` cursor of the previous page.
+       """
+       raise NotImplementedError
+  
+   @abstractmethod
+   def most_active_bots(self, since: str, limit: int) -> List[str]:
        """
-       Insert feedback for a message.
+       Ids of the bots with the most chat sessions updated at or after `since`, most
+       active first.
+       """
+       raise NotImplementedError
+  
+   @abstractmethod
+   def _insert_message_feedback(
+       self, bot_id: str, chat_session_id: str, message_id: str, feedback: UserFeedback
+   ):
+       """
+       Insert feedback for a message, in a single conditional update.
+       """
+       raise NotImplementedError
+  
+   @abstractmethod
+   def _insert_message_feedbacks(
+       self, bot_id: str, chat_session_id: str, feedbacks: List[Tuple[str, UserFeedback]]
+   ) -> Dict[str, bool]:
+       """
+       Insert feedback for several messages of a chat session, in a single update.
+       Returns whether each message id exists.
        """
        raise NotImplementedError
   
@@ -203,6 +272,36 @@ class DBHandler(ABC):
            bot_id, chat_session_id=chat_session_id, message_id=message_id, feedback=feedback
        )
   
+   def insert_message_feedbacks(
+       self,
+       bot_id: str,
+       chat_session_id: str,
+       user: User,
+       feedbacks: List[Tuple[str, str, FeedbackLabel]],
+   ) -> Dict[str, bool]:
+       """
+       Add feedback to several messages of a chat session. `feedbacks` holds
+       `(message_id, text, label)` items; returns whether each message id exists.
+       """
+       user_feedbacks = [
+           (message_id, UserFeedback(user=user, feedback_text=text, feedback_label=label))
+           for message_id, text, label in feedbacks
+       ]
+       return self._insert_message_feedbacks(
+           bot_id=bot_id, chat_session_id=chat_session_id, feedbacks=user_feedbacks
+       )
+  
+   @abstractmethod
+   def _write_batch(
+       self, writes: List[BufferedWrite]
+   ) -> Tuple[List[BufferedWrite], List[BufferedWrite]]:
+       """
+       Apply buffered writes in order, in as few round trips as possible. Writes must be
+       idempotent, as a batch failing part way is retried whole. Returns the writes that
+       failed, and the writes after them that were not tried; both can be retried.
+       """
+       raise NotImplementedError
+  
    @abstractmethod
    def _create_message(self, chat_session_id: str, message: Message):
        """
@@ -215,9 +314,20 @@ class DBHandler(ABC):
        chat_session_id: str,
        text: str,
        role: MessageCreatorRole,
-       sources_nodes: List[SourceNodeWithScore] = None
+       sources_nodes: List[SourceNodeWithScore] = None,
+       truncated: bool = False,
    ):
-       message_obj = Message.from_role(role=role, text=text, source_nodes=sources_nodes)
+       message_obj = Message.from_role(
+           role=role, text=text, source_nodes=sources_nodes, truncated=truncated
+       )
+       if self._write_buffer is not None:
+           self._write_buffer.add(BufferedWrite(
+               kind=MESSAGE,
+               chat_session_id=chat_session_id,
+               document=message_obj.model_dump(),
+               message=message_obj,
+           ))
+           return
        self._create_message(chat_session_id=chat_session_id, message=message_obj)
 
 
@@ -1,24 +1,51 @@
-from typing import List, Union
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from pydantic import ValidationError
 
 from src import config
+from src.db_handlers.bot_cache import BotCache
 from src.db_handlers.db_handler import DBHandler
 from src.db_handlers.schemas import (
    BotIndex,
    RagBot,
+   RagBotPage,
    ChatSession,
+   ChatSessionHeader,
+   ChatSessionPage,
    User,
    Message,
    UserFeedback,
 )
+from src.db_handlers.utils import decode_cursor, encode_cursor
+from src.db_handlers.write_behind import (
+   MESSAGE,
+   BufferedWrite,
+   WriteBehindBuffer,
+)
 from src.logger import CustomLogger
 
 
 logger = CustomLogger(name=__name__)
 
 
+# listings page through documents newest first; `_id` breaks ties between equal timestamps
+PAGE_SORT = [('created_at', DESCENDING), ('_id', DESCENDING)]
+
+# excluded from listed sessions, whose size grows with every message
+SESSION_HEADER_PROJECTION = {'messages': False, 'feedbacks': False}
+
+# bot cache invalidation across processes
+POLL_INVALIDATION = "poll"
+CHANGE_STREAM_INVALIDATION = "change_stream"
+
+# incremented by every update of a bot, so cached copies can be checked
+BOT_VERSION_KEY = 'version'
+
+
 class MongoHandler(DBHandler):
    """
    Singleton class: MongoDB implementation of the DBHandler.
@@ -33,6 +60,33 @@ class MongoHandler(DBHandler):
        self.rag_bot_coll = self._db[config.mongo_db_cfg.Collections.RagBots]
        self.chat_session_coll = self._db[config.mongo_db_cfg.Collections.ChatSessions]
       
+       if config.mongo_db_cfg.CreateIndexes:
+           self._create_indexes()
+      
+       self._bot_cache = None
+       self._stop_watching = threading.Event()
+       bot_cache_cfg = config.mongo_db_cfg.BotCache
+       if bot_cache_cfg.Enabled:
+           self._bot_cache = BotCache(
+               ttl_seconds=bot_cache_cfg.TTLSeconds, max_entries=bot_cache_cfg.MaxEntries
+           )
+           watch = {
+               POLL_INVALIDATION: self._poll_bot_versions,
+               CHANGE_STREAM_INVALIDATION: self._watch_bot_changes,
+           }.get(bot_cache_cfg.Invalidation)
+           if watch is not None:
+               threading.Thread(target=watch, name="bot-cache-invalidation", daemon=True).start()
+      
+       write_behind_cfg = config.mongo_db_cfg.WriteBehind
+       if write_behind_cfg.Enabled:
+           self._write_buffer = WriteBehindBuffer(
+               write=self._write_batch,
+               max_batch_size=write_behind_cfg.MaxBatchSize,
+               flush_interval_seconds=write_behind_cfg.FlushIntervalMs / 1000,
+               max_attempts=write_behind_cfg.MaxAttempts,
+               read_your_writes=write_behind_cfg.ReadYourWrites,
+           )
+      
        logger.info(
            message="Connected to MongoDB",
            fields={
@@ -42,6 +96,56 @@ class MongoHandler(DBHandler):
            },
        )
       
+   def _create_indexes(self):
+       """
+       Indexes for every query shape of the handler; creating existing indexes is a no-op.
+       Lookups by `_id` use the default index.
+       """
+       self.rag_bot_coll.create_indexes([
+           # get_user_bots, list_bots by user
+           IndexModel(
+               [('user.email', ASCENDING), *PAGE_SORT], name='user_email_created_at'
+           ),
+           # list_bots
+           IndexModel(PAGE_SORT, name='created_at'),
+       ])
+       self.chat_session_coll.create_indexes([
+           # get_all_chat_session, list_chat_sessions
+           IndexModel([('bot_id', ASCENDING), *PAGE_SORT], name='bot_id_created_at'),
+           # get_user_sessions, list_chat_sessions by user
+           IndexModel(
+               [('bot_id', ASCENDING), ('user.email', ASCENDING), *PAGE_SORT],
+               name='bot_id_user_email_created_at',
+           ),
+           # most_active_bots
+           IndexModel([('updated_at', DESCENDING)], name='updated_at'),
+       ])
+       logger.info(message="MongoDB indexes created")
+  
+   @staticmethod
+   def _find_page(
+       collection: Collection,
+       query: Dict[str, Any],
+       limit: int,
+       after: Optional[str] = None,
+       projection: Optional[Dict[str, bool]] = None,
+   ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+       """
+       Documents of one page, and the cursor of the next page. Seeks past the cursor
+       on the index instead of skipping, so a page costs the same wherever it is.
+       """
+       if after is not None:
+           created_at, doc_id = decode_cursor(after)
+           query = {'$and': [query, {'$or': [
+               {'created_at': {'$lt': created_at}},
+               {'created_at': created_at, '_id': {'$lt': doc_id}},
+           ]}]}
+       docs = list(collection.find(query, projection).sort(PAGE_SORT).limit(limit + 1))
+       if len(docs) <= limit:
+           return docs, None
+       docs = docs[:limit]
+       return docs, encode_cursor(docs[-1]['created_at'], docs[-1]['_id'])
+  
    def create_bot(self, bot: RagBot):
        bot_doc = bot.model_dump()
        bot_doc['_id'] = bot_doc.get('bot_id')
@@ -55,17 +159,72 @@ class MongoHandler(DBHandler):
            logger.exception(message="A bot with the same ID already exists.")
       
   
+   def close(self):
+       self._stop_watching.set()
+       super().close()
+  
+   def _invalidate_bot(self, bot_id: str):
+       if self._bot_cache is not None:
+           self._bot_cache.invalidate(bot_id)
+  
+   def _poll_bot_versions(self):
+       """
+       Drops cached bots whose version changed, or that were deleted, in another process.
+       """
+       interval = config.mongo_db_cfg.BotCache.PollIntervalSeconds
+       while not self._stop_watching.wait(interval):
+           cached_versions = self._bot_cache.versions()
+           if not cached_versions:
+               continue
+           try:
+               bot_docs = self.rag_bot_coll.find(
+                   {'_id': {'$in': list(cached_versions)}}, {BOT_VERSION_KEY: True}
+               )
+               current_versions = {doc['_id']: doc.get(BOT_VERSION_KEY, 0) for doc in bot_docs}
+           except Exception as e:
+               logger.exception(message="failed to poll bot versions", fields={'error': str(e)})
+               continue
+           for bot_id, version in cached_versions.items():
+               if current_versions.get(bot_id) != version:
+                   self._bot_cache.invalidate(bot_id)
+  
+   def _watch_bot_changes(self):
+       """
+       Drops cached bots as soon as they change, using a change stream of the bots collection.
+       Change streams need a replica set; without one, falls back to polling.
+       """
+       try:
+           with self.rag_bot_coll.watch() as stream:
+               while not self._stop_watching.is_set():
+                   change = stream.try_next()
+                   if change is None:
+                       self._stop_watching.wait(0.5)
+                       continue
+                   bot_id = change.get('documentKey', {}).get('_id')
+                   if bot_id is not None:
+                       self._bot_cache.invalidate(bot_id)
+                   elif change.get('operationType') in ('drop', 'rename', 'invalidate'):
+                       self._bot_cache.clear()
+       except OperationFailure as e:
+           logger.error(
+               message="bot change stream unavailable, polling bot versions instead",
+               fields={'error': str(e)},
+           )
+           self._poll_bot_versions()
+      
    def update_bot_name(self, bot_id: str, new_name: str) -> bool:
        result = self.rag_bot_coll.update_one(
            {'_id': bot_id},
-           {'$set': {'name': new_name}})
+           {'$set': {'name': new_name}, '$inc': {BOT_VERSION_KEY: 1}})
+       self._invalidate_bot(bot_id)
       
        return result.modified_count > 0
   
    def update_bot_description(self, bot_id: str, new_description: str) -> bool:
        result = self.rag_bot_coll.update_one(
            {'_id': bot_id},
-           {'$set': {'description': new_description}})
+           {'$set': {'description': new_description}, '$inc': {BOT_VERSION_KEY: 1}})
+       self._invalidate_bot(bot_id)
       
        return result.modified_count > 0
   
@@ -92,10 +251,18 @@ class MongoHandler(DBHandler):
        return bot_list
   
    def get_bot(self, bot_id: str) -> RagBot:
+       if self._bot_cache is not None:
+           cached_bot = self._bot_cache.get(bot_id)
+           if cached_bot is not None:
+               return cached_bot
        try:
            bot = self.rag_bot_coll.find_one({'_id': bot_id})
            bot.pop('_id')
-           return RagBot(**bot)
+           version = bot.pop(BOT_VERSION_KEY, 0)
+           rag_bot = RagBot(**bot)
+           if self._bot_cache is not None:
+               self._bot_cache.put(rag_bot, version=version)
+           return rag_bot
        except ValidationError as e:
            logger.exception(
                message= "error in fethcing bot",
@@ -120,10 +287,35 @@ class MongoHandler(DBHandler):
                )
        return bot_list
   
+   def list_bots(
+       self, limit: int, after: Optional[str] = None, email: Optional[str] = None
+   ) -> RagBotPage:
+       query = {'user.email': email} if email is not None else {}
+       bot_docs, next_after = self._find_page(
+           self.rag_bot_coll,
+           query,
+           limit=max(1, min(limit, config.mongo_db_cfg.MaxPageSize)),
+           after=after,
+       )
+       bot_list = []
+       for bot in bot_docs:
+           try:
+               bot['bot_id'] = bot.pop('_id')
+               bot_list.append(RagBot(**bot))
+           except ValidationError as e:
+               logger.exception(
+                   message="parsing error",
+                   fields={
+                       'error': e.json()
+                   }
+               )
+       return RagBotPage(items=bot_list, next_after=next_after)
+  
    def update_bot_status(self, bot_id: str, status: bool) -> bool:
        result = self.rag_bot_coll.update_one(
            {'_id': bot_id},
-           {'$set': {'ready': status}})
+           {'$set': {'ready': status}, '$inc': {BOT_VERSION_KEY: 1}})
+       self._invalidate_bot(bot_id)
       
        return result.modified_count > 0
   
@@ -132,8 +324,9 @@ class MongoHandler(DBHandler):
        try:
            result = self.rag_bot_coll.update_one(
                {'_id': bot_id},
-               {'$set': {'indexes': indexes_dicts}}
+               {'$set': {'indexes': indexes_dicts}, '$inc': {BOT_VERSION_KEY: 1}}
            )
+           self._invalidate_bot(bot_id)
            return result.modified_count > 0
       
        except Exception as e:
@@ -147,22 +340,21 @@ class MongoHandler(DBHandler):
            return False
   
    def _create_chat_session(self, chat_session: ChatSession) -> bool:
+       """
+       Upsert that only inserts, so concurrent first turns of a session create it once.
+       """
        chat_session_dict = chat_session.model_dump()
-       chat_session_dict['_id'] = chat_session_dict['chat_session_id']
-       if not self._bot_exists(chat_session_dict['bot_id']):
-           logger.exception(
-               message="bot doesn't exist",
-               fields={
-                   'bot_id': chat_session.bot_id,
-               }
-           )
-           return False
-      
        try:
-           output = self.chat_session_coll.insert_one(chat_session_dict)
-           return bool(output.inserted_id)
+           result = self.chat_session_coll.update_one(
+               {'_id': chat_session.chat_session_id},
+               {'$setOnInsert': chat_session_dict},
+               upsert=True,
+           )
        except DuplicateKeyError:
-           logger.exception(
+           # lost the race between two upserts; the other one created the session
+           result = None
+       if result is None or result.upserted_id is None:
+           logger.info(
                message="session already exists",
                fields={
                    'bot_id': chat_session.bot_id,
@@ -170,6 +362,7 @@ class MongoHandler(DBHandler):
                }
            )
            return False
+       return True
   
    def update_chat_session_name(
        self, bot_id, chat_session_id: str, updated_name: str
@@ -196,7 +389,6 @@ class MongoHandler(DBHandler):
                {"bot_id": bot_id, '_id': chat_session_id},
                {'$push': {'feedbacks': feedback.model_dump()}}
            )
-           return result.modified_count > 0
        except Exception as e:
            logger.exception(
                message=f"failed to insert session feedback in chat session",
@@ -205,11 +397,29 @@ class MongoHandler(DBHandler):
                    'error': str(e),
                })
            return False
+       # the filter is the existence check
+       if result.matched_count == 0:
+           raise ValueError(f"Either the bot with id: {bot_id} does not exist "
+                           f"or the chat session with id: {chat_session_id} does not exist.")
+       return result.modified_count > 0
+  
+   @staticmethod
+   def _to_chat_session(session_doc: Dict[str, Any]) -> ChatSession:
+       """
+       Sessions are documents this handler wrote, so they are built without validation
+       when `TrustedReads` is set; documents missing fields are validated as usual.
+       """
+       if config.mongo_db_cfg.TrustedReads:
+           try:
+               return ChatSession.from_trusted(session_doc)
+           except (KeyError, ValueError):
+               pass
+       return ChatSession(**session_doc)
   
    def get_chat_session(self, chat_session_id: str) -> Union[ChatSession, None]:
        session_doc = self.chat_session_coll.find_one({'_id': chat_session_id})
        if session_doc:
-           return ChatSession(**session_doc)
+           return self._with_buffered_messages(self._to_chat_session(session_doc))
        else:
            return None
   
@@ -219,7 +429,7 @@ class MongoHandler(DBHandler):
            chat_sessions=[]
            for session in session_docs:
                session.pop('_id')
-               chat_sessions.append(ChatSession(**session))
+               chat_sessions.append(self._to_chat_session(session))
            return chat_sessions
        else:
            return None
@@ -235,11 +445,47 @@ class MongoHandler(DBHandler):
        sessions_list = []
        for session in sessions_docs:
            try:
-               sessions_list.append(ChatSession(**session))
+               sessions_list.append(self._to_chat_session(session))
            except ValidationError as e:
                logger.exception(f"Failed to parse ChatSession data: {e.json()}")
        return sessions_list
   
+   def list_chat_sessions(
+       self, bot_id: str, limit: int, after: Optional[str] = None, user: Optional[User] = None
+   ) -> ChatSessionPage:
+       query = {'bot_id': bot_id}
+       if user is not None:
+           query['user.email'] = user.email
+       session_docs, next_after = self._find_page(
+           self.chat_session_coll,
+           query,
+           limit=max(1, min(limit, config.mongo_db_cfg.MaxPageSize)),
+           after=after,
+           projection=SESSION_HEADER_PROJECTION,
+       )
+       sessions_list = []
+       for session in session_docs:
+           try:
+               session.pop('_id')
+               sessions_list.append(ChatSessionHeader(**session))
+           except ValidationError as e:
+               logger.exception(
+                   message="parsing error",
+                   fields={
+                       'error': e.json()
+                   }
+               )
+       return ChatSessionPage(items=sessions_list, next_after=next_after)
+  
+   def most_active_bots(self, since: str, limit: int) -> List[str]:
+       pipeline = [
+           {'$match': {'updated_at': {'$gte': since}}},
+           {'$group': {'_id': '$bot_id', 'num_sessions': {'$sum': 1}}},
+           {'$sort': {'num_sessions': DESCENDING, '_id': ASCENDING}},
+           {'$limit': limit},
+       ]
+       return [doc['_id'] for doc in self.chat_session_coll.aggregate(pipeline)]
+  
    def _insert_message_feedback(
        self, bot_id: str, chat_session_id: str, message_id: str, feedback: UserFeedback
    ) -> bool:
@@ -247,17 +493,15 @@ class MongoHandler(DBHandler):
        Add feedback to a message.
        """
        try:
-           if not self._chat_message_exists(
-               bot_id=bot_id, chat_session_id=chat_session_id, message_id=message_id
-           ):
-               raise ValueError(f"Either the bot with id: {bot_id} does not exist, "
-                   f"or the chat session with id: {chat_session_id} does not exist, "
-                   f"or the message with id: {message_id} does not exist.")
-          
            result = self.chat_session_coll.update_one(
-               {'_id': chat_session_id, 'messages.message_id': message_id},
+               {'_id': chat_session_id, 'bot_id': bot_id, 'messages.message_id': message_id},
                {'$push': {'messages.$.feedbacks': feedback.model_dump()}}
            )
+           # the filter is the existence check
+           if result.matched_count == 0:
+               raise ValueError(f"Either the bot with id: {bot_id} does not exist, "
+                   f"or the chat session with id: {chat_session_id} does not exist, "
+                   f"or the message with id: {message_id} does not exist.")
            return result.modified_count > 0
        except Exception as e:
            logger.exception(
@@ -270,6 +514,92 @@ class MongoHandler(DBHandler):
            )
            return False
   
+   def _insert_message_feedbacks(
+       self, bot_id: str, chat_session_id: str, feedbacks: List[Tuple[str, UserFeedback]]
+   ) -> Dict[str, bool]:
+       """
+       Push every feedback with one `find_one_and_update`, using an array filter per
+       message. The returned message ids tell which messages exist.
+       """
+       feedbacks_by_message = defaultdict(list)
+       for message_id, feedback in feedbacks:
+           feedbacks_by_message[message_id].append(feedback.model_dump())
+       if not feedbacks_by_message:
+           return {}
+      
+       push, array_filters = {}, []
+       for i, (message_id, message_feedbacks) in enumerate(feedbacks_by_message.items()):
+           push[f'messages.$[m{i}].feedbacks'] = {'$each': message_feedbacks}
+           array_filters.append({f'm{i}.message_id': message_id})
+       try:
+           session_doc = self.chat_session_coll.find_one_and_update(
+               {'_id': chat_session_id, 'bot_id': bot_id},
+               {'$push': push},
+               array_filters=array_filters,
+               projection={'messages.message_id': True},
+               return_document=ReturnDocument.AFTER,
+           )
+       except Exception as e:
+           logger.exception(
+               message=f"failed to insert feedbacks",
+               fields={
+                   'chat_session_id': chat_session_id,
+                   'error': str(e),
+               }
+           )
+           return {message_id: False for message_id in feedbacks_by_message}
+      
+       existing_ids = set()
+       if session_doc is not None:
+           existing_ids = {message['message_id'] for message in session_doc.get('messages', [])}
+       return {message_id: message_id in existing_ids for message_id in feedbacks_by_message}
+  
+   @staticmethod
+   def _to_update(write: BufferedWrite) -> UpdateOne:
+       if write.kind == MESSAGE:
+           # a retried batch may hold messages that were already pushed; they match nothing
+           return UpdateOne(
+               {'_id': write.chat_session_id, 'messages.message_id': {'$ne': write.document['message_id']}},
+               {
+                   '$push': {'messages': write.document},
+                   '$set': {'updated_at': write.document['created_at']},
+               }
+           )
+       raise ValueError(f"unknown buffered write kind: {write.kind}")
+  
+   def _write_batch(
+       self, writes: List[BufferedWrite]
+   ) -> Tuple[List[BufferedWrite], List[BufferedWrite]]:
+       """
+       Apply buffered writes with one ordered `bulk_write`.
+       """
+       if not writes:
+           return [], []
+       try:
+           result = self.chat_session_coll.bulk_write(
+               [self._to_update(write) for write in writes], ordered=True
+           )
+       except BulkWriteError as e:
+           # an ordered bulk write stops at the first error; the writes before it were
+           # applied and the ones after it were not tried
+           failed_index = e.details['writeErrors'][0]['index']
+           logger.exception(
+               message="failed to apply a buffered write",
+               fields={
+                   'chat_session_id': writes[failed_index].chat_session_id,
+                   'kind': writes[failed_index].kind,
+                   'error': str(e.details['writeErrors'][0].get('errmsg')),
+               }
+           )
+           return [writes[failed_index]], writes[failed_index + 1:]
+      
+       if result.matched_count < len(writes):
+           logger.error(
+               message="buffered writes matched no chat session, or were already applied",
+               fields={'num_unmatched': len(writes) - result.matched_count},
+           )
+       return [], []
+  
    def _create_message(self, chat_session_id: str, message: Message) -> bool:
        """
        Create a new message.
@@ -278,7 +608,10 @@ class MongoHandler(DBHandler):
        try:
            result = self.chat_session_coll.update_one(
                {'_id': chat_session_id},
-               {'$push': {'messages': message_dict}}
+               {
+                   '$push': {'messages': message_dict},
+                   '$set': {'updated_at': message.created_at},
+               }
            )
            return result.modified_count > 0
        except Exception as e:
@@ -292,6 +625,8 @@ class MongoHandler(DBHandler):
            return False
   
    def _bot_exists(self, bot_id: str) -> bool:
+       if self._bot_cache is not None and self._bot_cache.get(bot_id) is not None:
+           return True
        result = self.rag_bot_coll.find_one({'_id': bot_id})
        return bool(result)
   
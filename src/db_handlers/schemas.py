@@ -1,7 +1,7 @@
 from enum import Enum
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 
-from pydantic import model_validator, Field, BaseModel
+from pydantic import model_validator, field_serializer, Field, BaseModel, TypeAdapter
 
 from src import config
 from src.db_handlers.utils import get_current_timestamp, create_unique_id
@@ -43,6 +43,36 @@ class GithubResource(CrawlResource):
     file_types_to_include: List[str] = Field(default=['.md', '.txt', '.ipynb'])
 
 
+class LocalDirectoryResource(CrawlResource):
+    """Directory on the ingesting machine, `url` is its path or a `file://` url."""
+    file_patterns_to_include: List[str] = Field(
+        default=['*.md', '*.txt', '*.ipynb'],
+        title="glob patterns of the paths, relative to the directory, to read",
+    )
+    file_patterns_to_exclude: List[str] = Field(
+        default_factory=list, title="glob patterns of the paths to skip even if included"
+    )
+
+
+class NodePostProcessingConfig(BaseModel):
+    """Per bot overrides of the `PostProcessing` config; unset values use the config."""
+    similarity_cutoff: Optional[float] = Field(
+        default=None, title="drop retrieved nodes scoring below this value"
+    )
+    relative_score_cutoff: Optional[float] = Field(
+        default=None, title="drop retrieved nodes scoring below this fraction of the best score"
+    )
+    dedup_threshold: Optional[float] = Field(
+        default=None, title="similarity above which a retrieved node is a near-duplicate"
+    )
+    lexical_rerank_weight: Optional[float] = Field(
+        default=None, title="weight of query term overlap when reranking, 0 disables it"
+    )
+    context_token_budget: Optional[int] = Field(
+        default=None, title="maximum tokens of retrieved context sent to the llm"
+    )
+
+
 class BotConfig(BaseModel):
     name: str = Field(title="name of the bot")
     description: Optional[str] = Field(default=None, title="description of the bot")
@@ -50,7 +80,15 @@ class BotConfig(BaseModel):
     embeddings_model_name: str = Field(title="name of the embeddings model to use")
     github_resources: List[GithubResource] = Field(default_factory=list)
     confluence_resources: List[ConfluenceResource] = Field(default_factory=list)
+    local_directory_resources: List[LocalDirectoryResource] = Field(default_factory=list)
     user: User = Field(title="user creating the bot")
+    node_postprocessing: Optional[NodePostProcessingConfig] = Field(
+        default=None, title="post processing of the retrieved nodes"
+    )
+    nprobe: Optional[int] = Field(
+        default=None,
+        title="partitions of the IVF vector store scanned per query, defaults to `NProbe` of the config",
+    )
 
     @model_validator(mode="before")
     def validate(cls, values: Dict[str, Any]):
@@ -84,6 +122,13 @@ class RagBot(BaseModel):
         default_factory=list, title="a mapping of resource to index id"
     )
     ready: bool = Field(default=False, title="flag to indicate if the bot is ready")
+    node_postprocessing: Optional[NodePostProcessingConfig] = Field(
+        default=None, title="post processing of the retrieved nodes"
+    )
+    nprobe: Optional[int] = Field(
+        default=None,
+        title="partitions of the IVF vector store scanned per query, defaults to `NProbe` of the config",
+    )
 
     @model_validator(mode="before")
     def validate(cls, values: Dict[str, Any]):
@@ -101,14 +146,20 @@ class RagBot(BaseModel):
 
     @classmethod
     def from_bot_config(cls, bot_config: BotConfig) -> 'RagBot':
-        crawl_resources = bot_config.github_resources + bot_config.confluence_resources
+        crawl_resources = (
+            bot_config.github_resources
+            + bot_config.confluence_resources
+            + bot_config.local_directory_resources
+        )
         return cls(
             name=bot_config.name,
             description=bot_config.description,
             llm_model=bot_config.llm_model_name,
             embeddings_model=bot_config.embeddings_model_name,
             user=bot_config.user,
-            crawl_resources=crawl_resources
+            crawl_resources=crawl_resources,
+            node_postprocessing=bot_config.node_postprocessing,
+            nprobe=bot_config.nprobe,
         )
     
     @property
@@ -153,6 +204,9 @@ class Message(BaseModel):
     source_nodes: Optional[List[SourceNodeWithScore]] = Field(
         default=None, title="nodes which are sent to the llm as context"
     )
+    truncated: bool = Field(
+        default=False, title="flag to indicate the answer was cut off when the client went away"
+    )
 
     @model_validator(mode="before")
     def validate(cls, values: Dict[str, Any]):
@@ -170,11 +224,13 @@ class Message(BaseModel):
         role: MessageCreatorRole,
         text: str,
         source_nodes: Optional[List[SourceNodeWithScore]] = None,
+        truncated: bool = False,
     ) -> 'Message':
         return cls(
             text=text,
             role=role,
-            source_nodes=source_nodes
+            source_nodes=source_nodes,
+            truncated=truncated,
         )
     
     @property
@@ -182,6 +238,85 @@ class Message(BaseModel):
         return self.message_id
     
 
+_MESSAGE_LIST_ADAPTER = TypeAdapter(List[Message])
+
+
+class LazyMessageList(list):
+    """
+    Messages of a chat session read back from the database. They are kept as raw
+    documents and built into `Message` objects on first access; serialising the list
+    returns the documents of the messages that were never accessed as they are.
+
+    Messages are built with regular validation: the compiled validator is faster
+    than `model_construct`, or any other construction in Python, because of the nested
+    source nodes. What is cheaper is not building them: slices stay lazy, and the chat
+    history of the agent only reads the role and text of the raw documents.
+    """
+    def _get(self, index: int) -> Message:
+        item = list.__getitem__(self, index)
+        if isinstance(item, dict):
+            item = Message.model_validate(item)
+            list.__setitem__(self, index, item)
+        return item
+
+    def _get_all(self) -> None:
+        raw = [(i, item) for i, item in enumerate(list.__iter__(self)) if isinstance(item, dict)]
+        if raw:
+            # a single call of the validator for every message still to build
+            messages = _MESSAGE_LIST_ADAPTER.validate_python([item for _, item in raw])
+            for (i, _), message in zip(raw, messages):
+                list.__setitem__(self, i, message)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyMessageList(list.__getitem__(self, index))
+        return self._get(index)
+
+    def __iter__(self):
+        self._get_all()
+        return list.__iter__(self)
+
+    def __reversed__(self):
+        self._get_all()
+        return list.__reversed__(self)
+
+    def __contains__(self, item) -> bool:
+        return any(message == item for message in self)
+
+    def pop(self, index: int = -1) -> Message:
+        self._get(index)
+        return list.pop(self, index)
+
+    def copy(self) -> List[Message]:
+        return list(self)
+
+    def message_ids(self) -> List[str]:
+        return [
+            item['message_id'] if isinstance(item, dict) else item.message_id
+            for item in list.__iter__(self)
+        ]
+
+    def roles_and_texts(self) -> List[Tuple[MessageCreatorRole, str]]:
+        return [
+            (MessageCreatorRole(item['role']), item['text']) if isinstance(item, dict)
+            else (item.role, item.text)
+            for item in list.__iter__(self)
+        ]
+
+    def dump(self, mode: str = 'python') -> List[Dict[str, Any]]:
+        return [
+            item if isinstance(item, dict) else item.model_dump(mode=mode)
+            for item in list.__iter__(self)
+        ]
+    
+
+def roles_and_texts(messages: Optional[List[Message]]) -> List[Tuple[MessageCreatorRole, str]]:
+    """Role and text of each message, without building the messages of a `LazyMessageList`."""
+    if isinstance(messages, LazyMessageList):
+        return messages.roles_and_texts()
+    return [(message.role, message.text) for message in messages or []]
+
+
 class ChatSession(BaseModel):
     chat_session_id: str = Field(title="unique id of the chat session")
     name: str = Field(title="name of the chat session")
@@ -207,7 +342,51 @@ class ChatSession(BaseModel):
         
         return values
     
+    @field_serializer('messages', mode='wrap')
+    def serialize_messages(self, messages, handler, info):
+        if isinstance(messages, LazyMessageList):
+            return messages.dump(mode=info.mode)
+        return handler(messages)
+
+    @classmethod
+    def from_trusted(cls, doc: Dict[str, Any]) -> 'ChatSession':
+        """
+        Builds a chat session read back from the database without validating it again.
+        Its messages are only built when they are accessed.
+        """
+        return cls.model_construct(
+            chat_session_id=doc['chat_session_id'],
+            name=doc['name'],
+            bot_id=doc['bot_id'],
+            messages=LazyMessageList(doc.get('messages', [])),
+            created_at=doc['created_at'],
+            updated_at=doc['updated_at'],
+            user=User.model_construct(**doc['user']),
+            feedbacks=[UserFeedback.model_validate(feedback) for feedback in doc.get('feedbacks', [])],
+        )
+
     @property
     def id(self) -> str:
         return self.chat_session_id
 
+
+class ChatSessionHeader(BaseModel):
+    """Chat session without its messages and feedbacks, used when listing sessions."""
+    chat_session_id: str = Field(title="unique id of the chat session")
+    name: str = Field(title="name of the chat session")
+    bot_id: str = Field(title="id of the bot")
+    created_at: str = Field(title="timestamp when the chat session was created")
+    updated_at: str = Field(title="timestamp when the chat session was last updated")
+    user: User = Field(title="user creating the chat session")
+
+
+class RagBotPage(BaseModel):
+    items: List[RagBot] = Field(default_factory=list, title="bots of the page, newest first")
+    next_after: Optional[str] = Field(default=None, title="cursor of the next page, if any")
+
+
+class ChatSessionPage(BaseModel):
+    items: List[ChatSessionHeader] = Field(
+        default_factory=list, title="chat sessions of the page, newest first"
+    )
+    next_after: Optional[str] = Field(default=None, title="cursor of the next page, if any")
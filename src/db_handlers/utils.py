@@ -1,11 +1,31 @@
+import json
 import uuid
-from datetime import datetime
+import base64
+from datetime import datetime, timedelta
+from typing import Tuple
 
 
 def get_current_timestamp() -> str:
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
+def get_past_timestamp(hours: float) -> str:
+    return (datetime.now() - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+
+
 def create_unique_id() -> str:
     return str(uuid.uuid4())
 
+
+def encode_cursor(created_at: str, doc_id: str) -> str:
+    """Opaque cursor pointing after the document with the given creation time and id."""
+    payload = json.dumps([created_at, doc_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+    return created_at, doc_id
@@ -0,0 +1,185 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.db_handlers.schemas import ChatSession, LazyMessageList, Message
+from src.logger import CustomLogger
+from src.metrics import metrics
+
+
+logger = CustomLogger(name=__name__)
+
+
+MESSAGE = "message"
+
+
+@dataclass
+class BufferedWrite:
+   kind: str
+   chat_session_id: str
+   # message document pushed by the write
+   document: Dict[str, Any]
+   attempts: int = 0
+   # buffered messages are also kept as models for the read overlay
+   message: Optional[Message] = field(default=None, repr=False)
+
+
+class WriteBehindBuffer:
+   """
+   Buffers message writes and hands them, in order, to `write` in batches
+   of at most `max_batch_size`. A batch is written once it is full, or
+   `flush_interval_seconds` after its first write, by a background thread.
+
+   `write` returns the writes that failed and the writes it did not try; both are
+   retried at the head of the next batch, and only tried writes count towards their
+   `max_attempts`. A batch whose `write` raises is retried whole, so writes must be
+   idempotent. `close` writes everything that is
+   still buffered, so a graceful shutdown loses nothing.
+
+   With `read_your_writes`, messages stay visible through `overlay` until they are written.
+   """
+   def __init__(
+       self,
+       write: Callable[[List[BufferedWrite]], Tuple[List[BufferedWrite], List[BufferedWrite]]],
+       max_batch_size: int = 100,
+       flush_interval_seconds: float = 0.2,
+       max_attempts: int = 3,
+       read_your_writes: bool = True,
+   ) -> None:
+       self._write = write
+       self._max_batch_size = max_batch_size
+       self._flush_interval_seconds = flush_interval_seconds
+       self._max_attempts = max_attempts
+       self._read_your_writes = read_your_writes
+       self._pending: List[BufferedWrite] = []
+       self._first_pending_at: Optional[float] = None
+       self._unwritten_messages: Dict[str, List[Message]] = {}
+       self._condition = threading.Condition()
+       # one batch is written at a time, so writes reach the database in order
+       self._flush_lock = threading.Lock()
+       self._closed = False
+       self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+       self._thread.start()
+
+   def add(self, write: BufferedWrite) -> None:
+       with self._condition:
+           if self._closed:
+               raise RuntimeError("write-behind buffer is closed")
+           self._pending.append(write)
+           if self._first_pending_at is None:
+               self._first_pending_at = time.monotonic()
+           if self._read_your_writes and write.message is not None:
+               self._unwritten_messages.setdefault(write.chat_session_id, []).append(write.message)
+           metrics.set_gauge("write_behind_pending", len(self._pending))
+           if len(self._pending) >= self._max_batch_size:
+               self._condition.notify()
+
+   def overlay(self, chat_session: ChatSession) -> ChatSession:
+       """Appends the buffered messages of the session that the database does not have yet."""
+       with self._condition:
+           unwritten = list(self._unwritten_messages.get(chat_session.chat_session_id, []))
+       if unwritten:
+           messages = chat_session.messages
+           # ids of lazily loaded messages are read without building the messages
+           written_ids = set(
+               messages.message_ids() if isinstance(messages, LazyMessageList)
+               else (message.message_id for message in messages)
+           )
+           chat_session.messages.extend(
+               message for message in unwritten if message.message_id not in written_ids
+           )
+       return chat_session
+
+   def _take_batch(self) -> List[BufferedWrite]:
+       batch = self._pending[:self._max_batch_size]
+       self._pending = self._pending[self._max_batch_size:]
+       self._first_pending_at = time.monotonic() if self._pending else None
+       metrics.set_gauge("write_behind_pending", len(self._pending))
+       return batch
+
+   def _forget(self, written: List[BufferedWrite]) -> None:
+       for write in written:
+           if write.message is None:
+               continue
+           messages = self._unwritten_messages.get(write.chat_session_id, [])
+           if write.message in messages:
+               messages.remove(write.message)
+           if not messages:
+               self._unwritten_messages.pop(write.chat_session_id, None)
+
+   def _flush_batch(self, batch: List[BufferedWrite]) -> None:
+       start = time.perf_counter()
+       try:
+           failed, untried = self._write(batch)
+       except Exception as e:
+           logger.exception(
+               message="failed to write buffered writes",
+               fields={"num_writes": len(batch), "error": str(e)},
+           )
+           failed, untried = batch, []
+       metrics.observe("write_behind_flush_seconds", time.perf_counter() - start)
+       metrics.observe("write_behind_batch_size", len(batch))
+
+       retries, dropped = [], []
+       for write in failed:
+           write.attempts += 1
+           (retries if write.attempts < self._max_attempts else dropped).append(write)
+       retries.extend(untried)
+       if dropped:
+           metrics.increment("write_behind_dropped", len(dropped))
+           logger.error(
+               message="dropped buffered writes after repeated failures",
+               fields={"num_writes": len(dropped)},
+           )
+       with self._condition:
+           failed_ids = {id(write) for write in retries}
+           self._forget([write for write in batch if id(write) not in failed_ids])
+           if retries:
+               self._pending[:0] = retries
+               if self._first_pending_at is None:
+                   self._first_pending_at = time.monotonic()
+               metrics.set_gauge("write_behind_pending", len(self._pending))
+
+   def flush(self) -> None:
+       """Writes every buffered write; failed writes stay buffered for a later attempt."""
+       with self._flush_lock:
+           with self._condition:
+               batches = []
+               while self._pending:
+                   batches.append(self._take_batch())
+           for batch in batches:
+               self._flush_batch(batch)
+
+   def _run(self) -> None:
+       while True:
+           with self._condition:
+               while not self._closed:
+                   if len(self._pending) >= self._max_batch_size:
+                       break
+                   if self._first_pending_at is None:
+                       self._condition.wait()
+                       continue
+                   remaining = self._first_pending_at + self._flush_interval_seconds - time.monotonic()
+                   if remaining <= 0:
+                       break
+                   self._condition.wait(remaining)
+               if self._closed:
+                   return
+           with self._flush_lock:
+               with self._condition:
+                   batch = self._take_batch()
+               if batch:
+                   self._flush_batch(batch)
+
+   def close(self) -> None:
+       with self._condition:
+           self._closed = True
+           self._condition.notify()
+       self._thread.join()
+       # writes failing now are retried right away, as there is no later flush
+       for _ in range(self._max_attempts):
+           self.flush()
+           with self._condition:
+               if not self._pending:
+                   return
@@ -0,0 +1,232 @@
+import os
+import mmap
+import json
+import hashlib
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from llama_index.core import Document
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+
+from src.db_handlers.schemas import LocalDirectoryResource
+from src.doc_readers.doc_reader import DocReader
+from src.doc_readers.utils import get_document_id_from_filepath
+from src.logger import CustomLogger
+
+
+logger = CustomLogger(__name__)
+
+
+FILE_URL_PREFIX = "file://"
+CONTENT_HASH_METADATA_KEY = "content_hash"
+LAST_MODIFIED_METADATA_KEY = "last_modified_ns"
+
+
+def local_files_key(index_id: str) -> str:
+   """Docstore hash key of the ids of the documents of a local directory index."""
+   return f"{index_id}/local_files"
+
+
+def _file_state(last_modified_ns: int, content_hash: str) -> str:
+   return f"{last_modified_ns}:{content_hash}"
+
+
+class LocalFileDocument(Document):
+   """
+   A file of a local directory. Its hash is the state of the file, modification time
+   and content hash, so the document hash stored in the docstore at ingestion is what a
+   refresh compares the files against.
+   """
+
+   @property
+   def hash(self) -> str:
+       return _file_state(
+           self.metadata[LAST_MODIFIED_METADATA_KEY], self.metadata[CONTENT_HASH_METADATA_KEY]
+       )
+
+
+@dataclass
+class LocalDirectoryChanges:
+   # new and changed files, to embed
+   documents: List[LocalFileDocument] = field(default_factory=list)
+   # ids of the changed documents that already have nodes in the index
+   replaced_doc_ids: List[str] = field(default_factory=list)
+   # files with a new modification time and the same content, by document id
+   touched: Dict[str, str] = field(default_factory=dict)
+   # documents of files that were removed
+   deleted_doc_ids: List[str] = field(default_factory=list)
+   # documents of all the files of the directory
+   doc_ids: List[str] = field(default_factory=list)
+
+
+def _read_file(path: str) -> Tuple[str, str]:
+   """
+   Decodes and hashes the file through a read-only memory map. The hash reads the
+   mapped pages in place, only the decoded text is a copy.
+   """
+   with open(path, "rb") as f:
+       if os.fstat(f.fileno()).st_size == 0:
+           # empty files can not be mapped
+           return "", hashlib.sha256(b"").hexdigest()
+       with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+           return str(mapped, "utf-8"), hashlib.sha256(mapped).hexdigest()
+
+
+class LocalDirectoryReader(DocReader):
+   def get_directory(self, resource: LocalDirectoryResource) -> str:
+       directory = resource.url
+       if directory.startswith(FILE_URL_PREFIX):
+           directory = directory[len(FILE_URL_PREFIX):]
+       directory = os.path.abspath(os.path.expanduser(directory))
+       if not os.path.isdir(directory):
+           raise ValueError(f"{resource.url} is not a directory")
+       return directory
+
+   def list_files(self, resource: LocalDirectoryResource) -> List[str]:
+       """Paths of the files of the directory selected by the include and exclude patterns."""
+       directory = self.get_directory(resource)
+       paths = []
+       for dir_path, dir_names, file_names in os.walk(directory):
+           dir_names.sort()
+           for file_name in sorted(file_names):
+               paths.append(os.path.join(dir_path, file_name))
+
+       # patterns match the path relative to the directory, as for github resources
+       base_path = directory.rstrip(os.sep) + os.sep
+       paths = self._include_files_matching_pattern(
+           paths, resource.file_patterns_to_include, base_path=base_path
+       )
+       return self._ignore_files_matching_pattern(
+           paths, resource.file_patterns_to_exclude, base_path=base_path
+       )
+
+   def _read_document(
+       self,
+       path: str,
+       directory: str,
+       doc_id: str,
+       last_modified_ns: int,
+       verbose: bool,
+   ) -> Optional[LocalFileDocument]:
+       try:
+           text, content_hash = _read_file(path)
+       except FileNotFoundError:
+           # deleted while walking the directory
+           return None
+       except UnicodeDecodeError:
+           if verbose:
+               logger.warning(message="could not decode file as utf-8", fields={"path": path})
+           return None
+
+       url = Path(path).as_uri()
+       document = LocalFileDocument(
+           text=text,
+           doc_id=doc_id,
+           extra_info={
+               "file_path": os.path.relpath(path, directory),
+               "file_name": os.path.basename(path),
+               "url": url,
+               CONTENT_HASH_METADATA_KEY: content_hash,
+               LAST_MODIFIED_METADATA_KEY: last_modified_ns,
+           },
+       )
+       # change detection metadata is not part of the text to embed or answer from
+       document.excluded_embed_metadata_keys = [
+           CONTENT_HASH_METADATA_KEY, LAST_MODIFIED_METADATA_KEY
+       ]
+       document.excluded_llm_metadata_keys = [
+           CONTENT_HASH_METADATA_KEY, LAST_MODIFIED_METADATA_KEY
+       ]
+       return document
+
+   def read_documents(
+       self,
+       resource: LocalDirectoryResource,
+       chatbot_id: str,
+       verbose: bool = False,
+   ) -> List[LocalFileDocument]:
+       """
+       Reads the selected files of the directory as documents, with the modification
+       time and content hash of each file in their metadata.
+       """
+       directory = self.get_directory(resource)
+       paths = self.list_files(resource)
+       documents = []
+       for path in paths:
+           try:
+               stat = os.stat(path)
+           except FileNotFoundError:
+               # deleted while walking the directory
+               continue
+           doc_id = get_document_id_from_filepath(filepath=Path(path).as_uri(), chatbot_id=chatbot_id)
+           document = self._read_document(path, directory, doc_id, stat.st_mtime_ns, verbose)
+           if document is not None:
+               documents.append(document)
+
+       logger.info(
+           message="read local directory",
+           fields={
+               "directory": directory,
+               "num_files": len(paths),
+               "num_read": len(documents),
+           },
+       )
+       return documents
+
+   def read_changes(
+       self,
+       resource: LocalDirectoryResource,
+       chatbot_id: str,
+       docstore: BaseDocumentStore,
+       index_id: str,
+       verbose: bool = False,
+   ) -> LocalDirectoryChanges:
+       """
+       Compares the files of the directory with their states stored in the docstore when
+       the index was built or last refreshed. A file with the stored modification time is
+       not opened, one with a new modification time is hashed and only read as a document
+       when its content changed.
+       """
+       directory = self.get_directory(resource)
+       paths = self.list_files(resource)
+       stored_doc_ids = docstore.get_document_hash(local_files_key(index_id))
+       previous_doc_ids = set(json.loads(stored_doc_ids)) if stored_doc_ids else set()
+
+       changes = LocalDirectoryChanges()
+       for path in paths:
+           try:
+               stat = os.stat(path)
+           except FileNotFoundError:
+               continue
+           doc_id = get_document_id_from_filepath(filepath=Path(path).as_uri(), chatbot_id=chatbot_id)
+           stored_state = docstore.get_document_hash(doc_id)
+           if stored_state is not None:
+               last_modified_ns, _, content_hash = stored_state.partition(":")
+               if last_modified_ns == str(stat.st_mtime_ns):
+                   changes.doc_ids.append(doc_id)
+                   continue
+
+           document = self._read_document(path, directory, doc_id, stat.st_mtime_ns, verbose)
+           if document is None:
+               continue
+           changes.doc_ids.append(doc_id)
+           if stored_state is not None and content_hash == document.metadata[CONTENT_HASH_METADATA_KEY]:
+               changes.touched[doc_id] = document.hash
+               continue
+           changes.documents.append(document)
+           if stored_state is not None:
+               changes.replaced_doc_ids.append(doc_id)
+
+       changes.deleted_doc_ids = sorted(previous_doc_ids.difference(changes.doc_ids))
+       logger.info(
+           message="compared local directory with its index",
+           fields={
+               "directory": directory,
+               "num_files": len(paths),
+               "num_changed": len(changes.documents),
+               "num_touched": len(changes.touched),
+               "num_deleted": len(changes.deleted_doc_ids),
+           },
+       )
+       return changes
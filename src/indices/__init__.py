@@ -0,0 +1 @@
+from src.indices.bm25_index import BM25Index, BM25IndexStore
\ No newline at end of file
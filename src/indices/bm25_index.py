@@ -0,0 +1,404 @@
+import re
+import math
+import base64
+import threading
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.storage.kvstore.types import BaseKVStore
+
+from src.logger import CustomLogger
+
+
+logger = CustomLogger(__name__)
+
+
+WORD_REGEX = re.compile(r"[A-Za-z0-9_]+")
+SUBWORD_REGEX = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+STOPWORDS = frozenset(
+   "a an and are as at be but by for from has have how i if in into is it its of on "
+   "or that the their then there these this to was were what when where which who "
+   "why will with you your".split()
+)
+
+# documents per persisted doc-table chunk, about 3MB of node ids at most
+DOC_CHUNK_SIZE = 50000
+# encoded postings per persisted part, well below the 16MB MongoDB document limit;
+# a longer postings list is split across parts
+POSTINGS_PART_BYTES = 4 * 1024 * 1024
+# each persist appends a segment of the postings added since the previous one, past
+# this many segments the next persist rewrites them as one
+MAX_POSTINGS_SEGMENTS = 32
+MAX_TERM_FREQUENCY = 65535
+# base64 of a uint32 ordinal and a uint16 frequency, and the bytes of an entry
+# besides its term and postings
+ENCODED_POSTING_BYTES = 8
+ENTRY_OVERHEAD_BYTES = 32
+
+
+def tokenize(text: str) -> List[str]:
+   """
+   Lower-cased word tokens. Identifiers are kept whole and also split into their
+   snake_case / camelCase parts, so `getUserById` matches both itself and `user`.
+   """
+   tokens = []
+   for word in WORD_REGEX.findall(text):
+       lower = word.lower()
+       if lower not in STOPWORDS:
+           tokens.append(lower)
+       parts = [
+           part.lower() for chunk in word.split("_") for part in SUBWORD_REGEX.findall(chunk)
+       ]
+       if len(parts) > 1:
+           tokens.extend(part for part in parts if part not in STOPWORDS)
+   return tokens
+
+
+def _encode(values: array) -> str:
+   return base64.b64encode(values.tobytes()).decode()
+
+
+def _decode(typecode: str, encoded: str) -> array:
+   values = array(typecode)
+   values.frombytes(base64.b64decode(encoded))
+   return values
+
+
+class BM25Index:
+   """
+   Compact in-process inverted index with BM25 scoring for one llama-index index.
+
+   Documents (nodes) are numbered by insertion order. Each term maps to two parallel
+   arrays: the document ordinals containing it (uint32) and the term frequencies
+   (uint16). Scoring works on numpy views of those arrays without copying. Deleted
+   nodes are tombstoned and dropped from the postings on compaction.
+   """
+   def __init__(self, index_id: str, k1: float = 1.2, b: float = 0.75):
+       self.index_id = index_id
+       self.k1 = k1
+       self.b = b
+
+       self._node_ids: List[str] = []
+       self._ref_doc_ids: List[Optional[str]] = []
+       self._lengths = array("I")
+       self._deleted = bytearray()
+       self._postings: Dict[str, Tuple[array, array]] = {}
+       self._total_length = 0
+       self._num_alive = 0
+
+       self._ordinal_by_node_id: Dict[str, int] = {}
+       self._ordinals_by_ref_doc_id: Dict[str, List[int]] = {}
+       # postings persisted of each term changed since the last persist
+       self._dirty_terms: Dict[str, int] = {}
+       self._dirty_doc_chunks: Set[int] = set()
+       # (segment, number of parts) of the persisted postings
+       self._postings_segments: List[Tuple[int, int]] = []
+       self._rewrite_postings = False
+       self._lock = threading.RLock()
+
+   def __len__(self) -> int:
+       return self._num_alive
+
+   def _add_document(self, node_id: str, ref_doc_id: Optional[str], length: int) -> int:
+       previous = self._ordinal_by_node_id.get(node_id)
+       if previous is not None:
+           self._delete_ordinals([previous])
+
+       ordinal = len(self._node_ids)
+       self._node_ids.append(node_id)
+       self._ref_doc_ids.append(ref_doc_id)
+       self._lengths.append(length)
+       self._deleted.append(0)
+       self._ordinal_by_node_id[node_id] = ordinal
+       if ref_doc_id is not None:
+           self._ordinals_by_ref_doc_id.setdefault(ref_doc_id, []).append(ordinal)
+       self._total_length += length
+       self._num_alive += 1
+       self._dirty_doc_chunks.add(ordinal // DOC_CHUNK_SIZE)
+       return ordinal
+
+   def insert_nodes(self, nodes: Iterable[BaseNode]) -> None:
+       with self._lock:
+           for node in nodes:
+               tokens = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+               ordinal = self._add_document(node.node_id, node.ref_doc_id, len(tokens))
+               for term, frequency in Counter(tokens).items():
+                   postings = self._postings.get(term)
+                   if postings is None:
+                       postings = (array("I"), array("H"))
+                       self._postings[term] = postings
+                   self._dirty_terms.setdefault(term, len(postings[0]))
+                   postings[0].append(ordinal)
+                   postings[1].append(min(frequency, MAX_TERM_FREQUENCY))
+
+   def _delete_ordinals(self, ordinals: Iterable[int]) -> None:
+       for ordinal in ordinals:
+           if self._deleted[ordinal]:
+               continue
+           self._deleted[ordinal] = 1
+           self._total_length -= self._lengths[ordinal]
+           self._num_alive -= 1
+           self._dirty_doc_chunks.add(ordinal // DOC_CHUNK_SIZE)
+           if self._ordinal_by_node_id.get(self._node_ids[ordinal]) == ordinal:
+               self._ordinal_by_node_id.pop(self._node_ids[ordinal])
+
+   def delete_ref_doc(self, ref_doc_id: str) -> None:
+       with self._lock:
+           self._delete_ordinals(self._ordinals_by_ref_doc_id.pop(ref_doc_id, []))
+
+   def delete_nodes(self, node_ids: Iterable[str]) -> None:
+       with self._lock:
+           self._delete_ordinals(
+               [self._ordinal_by_node_id[n] for n in node_ids if n in self._ordinal_by_node_id]
+           )
+
+   def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+       """Top `top_k` (node_id, bm25 score) pairs for `query`."""
+       terms = set(tokenize(query))
+       with self._lock:
+           if not terms or self._num_alive == 0:
+               return []
+
+           num_docs = len(self._node_ids)
+           lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+           avg_length = max(self._total_length / self._num_alive, 1.0)
+           scores = np.zeros(num_docs, dtype=np.float32)
+           for term in terms:
+               postings = self._postings.get(term)
+               if postings is None:
+                   continue
+               ordinals = np.frombuffer(postings[0], dtype=np.uint32)
+               frequencies = np.frombuffer(postings[1], dtype=np.uint16).astype(np.float32)
+               idf = math.log(1.0 + (num_docs - len(ordinals) + 0.5) / (len(ordinals) + 0.5))
+               norm = self.k1 * (1.0 - self.b + self.b * lengths[ordinals] / avg_length)
+               # ordinals are unique within a postings list, so fancy `+=` is safe
+               scores[ordinals] += idf * frequencies * (self.k1 + 1.0) / (frequencies + norm)
+
+           scores[np.frombuffer(self._deleted, dtype=np.bool_)] = 0.0
+           candidates = np.flatnonzero(scores > 0)
+           if len(candidates) > top_k:
+               candidates = candidates[np.argpartition(-scores[candidates], top_k)[:top_k]]
+           candidates = candidates[np.argsort(-scores[candidates])]
+           return [(self._node_ids[i], float(scores[i])) for i in candidates]
+
+   def _compact(self) -> None:
+       """Renumber documents without the tombstoned ones and rewrite the postings."""
+       deleted = np.frombuffer(self._deleted, dtype=np.bool_).copy()
+       remap = np.full(len(deleted), -1, dtype=np.int64)
+       remap[~deleted] = np.arange(int((~deleted).sum()))
+
+       for term in list(self._postings):
+           ordinals, frequencies = self._postings[term]
+           ordinals_np = np.frombuffer(ordinals, dtype=np.uint32)
+           keep = ~deleted[ordinals_np]
+           if not keep.any():
+               del self._postings[term]
+               continue
+           self._postings[term] = (
+               array("I", remap[ordinals_np[keep]].astype(np.uint32).tobytes()),
+               array("H", np.frombuffer(frequencies, dtype=np.uint16)[keep].tobytes()),
+           )
+
+       alive = np.flatnonzero(~deleted)
+       node_ids, ref_doc_ids = self._node_ids, self._ref_doc_ids
+       lengths = np.frombuffer(self._lengths, dtype=np.uint32)[alive].copy()
+       self._node_ids = [node_ids[i] for i in alive]
+       self._ref_doc_ids = [ref_doc_ids[i] for i in alive]
+       self._lengths = array("I", lengths.tobytes())
+       self._deleted = bytearray(len(alive))
+       self._rebuild_lookups()
+
+       self._rewrite_postings = True
+       self._dirty_doc_chunks = set(range(self.num_doc_chunks))
+
+   def _rebuild_lookups(self) -> None:
+       self._ordinal_by_node_id = {}
+       self._ordinals_by_ref_doc_id = {}
+       for ordinal, node_id in enumerate(self._node_ids):
+           if self._deleted[ordinal]:
+               continue
+           self._ordinal_by_node_id[node_id] = ordinal
+           ref_doc_id = self._ref_doc_ids[ordinal]
+           if ref_doc_id is not None:
+               self._ordinals_by_ref_doc_id.setdefault(ref_doc_id, []).append(ordinal)
+
+   @property
+   def num_doc_chunks(self) -> int:
+       return (len(self._node_ids) + DOC_CHUNK_SIZE - 1) // DOC_CHUNK_SIZE
+
+
+class BM25IndexStore:
+   """
+   Persists `BM25Index`es in a KV store collection and keeps loaded ones in memory.
+
+   With the MongoDB docstore the indexes live in the docstore database, in the
+   `<docstore namespace>/bm25` collection. Each index is stored as a metadata
+   entry, its document table in fixed-size chunks and its postings in segments of
+   size-capped parts. Postings only grow between compactions, so `persist` rewrites
+   the document chunks that changed and appends the postings added since the last
+   persist as a new segment: an incremental update writes about its own size.
+   """
+   def __init__(self, kvstore: BaseKVStore, collection: str = "bm25"):
+       self._kvstore = kvstore
+       self._collection = collection
+       self._indexes: Dict[str, BM25Index] = {}
+       self._lock = threading.Lock()
+
+   @classmethod
+   def from_mongo_uri(cls, uri: str, db_name: str, namespace: str) -> "BM25IndexStore":
+       from llama_index.storage.kvstore.mongodb import MongoDBKVStore
+
+       kvstore = MongoDBKVStore.from_uri(uri=uri, db_name=db_name)
+       return cls(kvstore=kvstore, collection=f"{namespace}/bm25")
+
+   def build(self, index_id: str, nodes: Iterable[BaseNode]) -> BM25Index:
+       """Build a new index from `nodes`, persist it and keep it in memory."""
+       bm25_index = BM25Index(index_id=index_id)
+       bm25_index.insert_nodes(nodes)
+       self.persist(bm25_index)
+       return bm25_index
+
+   def get(self, index_id: str) -> Optional[BM25Index]:
+       with self._lock:
+           bm25_index = self._indexes.get(index_id)
+           if bm25_index is None:
+               bm25_index = self._load(index_id)
+               if bm25_index is not None:
+                   self._indexes[index_id] = bm25_index
+           return bm25_index
+
+   def _load(self, index_id: str) -> Optional[BM25Index]:
+       meta = self._kvstore.get(index_id, collection=self._collection)
+       if meta is None:
+           return None
+
+       bm25_index = BM25Index(index_id=index_id, k1=meta["k1"], b=meta["b"])
+       for chunk in range(meta["num_doc_chunks"]):
+           docs = self._kvstore.get(f"{index_id}/docs/{chunk}", collection=self._collection)
+           bm25_index._node_ids.extend(docs["node_ids"])
+           bm25_index._ref_doc_ids.extend(docs["ref_doc_ids"])
+           bm25_index._lengths.extend(_decode("I", docs["lengths"]))
+           bm25_index._deleted.extend(base64.b64decode(docs["deleted"]))
+
+       for segment, num_parts in meta["postings_segments"]:
+           for part in range(num_parts):
+               postings = self._kvstore.get(
+                   f"{index_id}/postings/{segment}/{part}", collection=self._collection
+               )
+               for term, ordinals, frequencies in postings["postings"]:
+                   existing = bm25_index._postings.get(term)
+                   if existing is None:
+                       existing = (array("I"), array("H"))
+                       bm25_index._postings[term] = existing
+                   existing[0].extend(_decode("I", ordinals))
+                   existing[1].extend(_decode("H", frequencies))
+       bm25_index._postings_segments = [tuple(segment) for segment in meta["postings_segments"]]
+
+       bm25_index._total_length = meta["total_length"]
+       bm25_index._num_alive = meta["num_alive"]
+       bm25_index._rebuild_lookups()
+       logger.info(
+           message="loaded bm25 index",
+           fields={"index_id": index_id, "num_docs": bm25_index._num_alive},
+       )
+       return bm25_index
+
+   def persist(self, bm25_index: BM25Index) -> None:
+       with bm25_index._lock:
+           num_deleted = len(bm25_index._node_ids) - bm25_index._num_alive
+           stale_chunks = range(0)
+           if num_deleted and num_deleted >= 0.25 * len(bm25_index._node_ids):
+               num_chunks_before = bm25_index.num_doc_chunks
+               bm25_index._compact()
+               stale_chunks = range(bm25_index.num_doc_chunks, num_chunks_before)
+
+           kv_pairs = []
+           for chunk in sorted(bm25_index._dirty_doc_chunks):
+               start, end = chunk * DOC_CHUNK_SIZE, (chunk + 1) * DOC_CHUNK_SIZE
+               kv_pairs.append((f"{bm25_index.index_id}/docs/{chunk}", {
+                   "node_ids": bm25_index._node_ids[start:end],
+                   "ref_doc_ids": bm25_index._ref_doc_ids[start:end],
+                   "lengths": _encode(bm25_index._lengths[start:end]),
+                   "deleted": base64.b64encode(bytes(bm25_index._deleted[start:end])).decode(),
+               }))
+
+           previous_segments = bm25_index._postings_segments
+           segments = list(previous_segments)
+           rewrite = (
+               bm25_index._rewrite_postings or len(segments) >= MAX_POSTINGS_SEGMENTS
+           )
+           if rewrite:
+               tails = {term: 0 for term in bm25_index._postings}
+           else:
+               tails = bm25_index._dirty_terms
+           if tails:
+               # a new segment id, so a rewrite never overwrites the parts it replaces
+               segment = max((s for s, _ in previous_segments), default=-1) + 1
+               parts = self._postings_parts(bm25_index, tails)
+               for part, postings in enumerate(parts):
+                   kv_pairs.append((
+                       f"{bm25_index.index_id}/postings/{segment}/{part}", {"postings": postings}
+                   ))
+               segments = [(segment, len(parts))] if rewrite else segments + [(segment, len(parts))]
+           elif rewrite:
+               segments = []
+
+           kv_pairs.append((bm25_index.index_id, {
+               "k1": bm25_index.k1,
+               "b": bm25_index.b,
+               "num_doc_chunks": bm25_index.num_doc_chunks,
+               "total_length": bm25_index._total_length,
+               "num_alive": bm25_index._num_alive,
+               "postings_segments": segments,
+           }))
+           self._kvstore.put_all(kv_pairs, collection=self._collection)
+           # only once the metadata no longer lists them
+           for chunk in stale_chunks:
+               self._kvstore.delete(f"{bm25_index.index_id}/docs/{chunk}", collection=self._collection)
+           if rewrite:
+               for segment, num_parts in previous_segments:
+                   for part in range(num_parts):
+                       self._kvstore.delete(
+                           f"{bm25_index.index_id}/postings/{segment}/{part}",
+                           collection=self._collection,
+                       )
+
+           bm25_index._postings_segments = segments
+           bm25_index._rewrite_postings = False
+           bm25_index._dirty_doc_chunks.clear()
+           bm25_index._dirty_terms = {}
+
+       with self._lock:
+           self._indexes[bm25_index.index_id] = bm25_index
+
+   @staticmethod
+   def _postings_parts(
+       bm25_index: BM25Index, tails: Dict[str, int]
+   ) -> List[List[Tuple[str, str, str]]]:
+       """
+       The postings of each term in `tails` from the given offset on, as (term,
+       ordinals, frequencies) entries grouped into parts of about
+       `POSTINGS_PART_BYTES`. A term with more postings than fit a part gets one
+       entry per slice, in order.
+       """
+       parts: List[List[Tuple[str, str, str]]] = []
+       part: List[Tuple[str, str, str]] = []
+       part_bytes = 0
+       for term, start in tails.items():
+           ordinals, frequencies = bm25_index._postings[term]
+           entry_bytes = len(term) + ENTRY_OVERHEAD_BYTES
+           while start < len(ordinals):
+               room = (POSTINGS_PART_BYTES - part_bytes - entry_bytes) // ENCODED_POSTING_BYTES
+               end = min(len(ordinals), start + max(room, 1))
+               part.append((term, _encode(ordinals[start:end]), _encode(frequencies[start:end])))
+               part_bytes += entry_bytes + (end - start) * ENCODED_POSTING_BYTES
+               start = end
+               if part_bytes >= POSTINGS_PART_BYTES:
+                   parts.append(part)
+                   part, part_bytes = [], 0
+       if part:
+           parts.append(part)
+       return parts
@@ -0,0 +1 @@
+from src.ingest.pipeline import ingest_bot_to_snapshot
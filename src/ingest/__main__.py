@@ -0,0 +1,101 @@
+"""
+Ingests a bot outside the API server: reads, parses and embeds the resources of a
+`BotConfig` JSON file, then writes the indexes to the configured stores and marks the bot
+ready, or writes them to a snapshot directory to import with `python -m src.snapshots`.
+
+Run from the repository root:
+
+   python -m src.ingest --bot-config bot.json
+   python -m src.ingest --bot-config bot.json --snapshot-dir snapshots/my-bot
+   python -m src.ingest --refresh-bot-id <bot_id>
+"""
+import json
+import argparse
+import asyncio
+
+from src import config
+from version import VERSION
+
+
+async def run(args: argparse.Namespace) -> None:
+   from src.db_handlers.schemas import BotConfig
+
+   if args.refresh_bot_id:
+       from src.chat_bot_manager import ChatBotManager
+
+       chatbot_manager = ChatBotManager()
+       try:
+           bot = await chatbot_manager.refresh_bot(
+               bot_id=args.refresh_bot_id,
+               concurrency=args.concurrency or config.ingest_cfg.ResourceConcurrency,
+           )
+           print(f"refreshed bot {bot.bot_id} with {len(bot.indexes)} indexes")
+       finally:
+           chatbot_manager.close()
+       return
+
+   with open(args.bot_config, "r") as f:
+       bot_config = BotConfig(**json.load(f))
+   concurrency = args.concurrency or config.ingest_cfg.ResourceConcurrency
+
+   if args.snapshot_dir:
+       from src.ingest import ingest_bot_to_snapshot
+
+       manifest = await ingest_bot_to_snapshot(
+           bot_config=bot_config, snapshot_dir=args.snapshot_dir, concurrency=concurrency
+       )
+       print(f"wrote {manifest.num_nodes} nodes of bot {manifest.bot.bot_id} to {args.snapshot_dir}")
+       return
+
+   from src.chat_bot_manager import ChatBotManager
+
+   chatbot_manager = ChatBotManager()
+   try:
+       bot = await chatbot_manager.ingest_bot(bot_config=bot_config, concurrency=concurrency)
+       print(f"ingested bot {bot.bot_id} with {len(bot.indexes)} indexes")
+   finally:
+       chatbot_manager.close()
+
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__)
+   source = parser.add_mutually_exclusive_group(required=True)
+   source.add_argument("--bot-config", type=str, help="BotConfig JSON file")
+   source.add_argument(
+       "--refresh-bot-id",
+       type=str,
+       default=None,
+       help="re-embed only the changed files of the local directories of an ingested bot",
+   )
+   parser.add_argument(
+       "--snapshot-dir",
+       type=str,
+       default=None,
+       help="write a snapshot here instead of to the configured stores",
+   )
+   parser.add_argument(
+       "--concurrency",
+       type=int,
+       default=None,
+       help="resources ingested at once, defaults to `ResourceConcurrency` of the config file",
+   )
+   parser.add_argument(
+       "--max-model-calls",
+       type=int,
+       default=None,
+       help="OpenAI requests in flight at once, defaults to `MaxConcurrentModelCalls` of the config file",
+   )
+   parser.add_argument("--config", type=str, default="configs/dev.config.json")
+   parser.add_argument("--env", type=str, default=".env")
+   args = parser.parse_args()
+
+   config.load_config(app_version=VERSION, config_json_path=args.config, env_path=args.env)
+   # no chats to leave request slots to, ingestion has the process to itself
+   config.scheduler_cfg.MaxConcurrentModelCalls = (
+       args.max_model_calls or config.ingest_cfg.MaxConcurrentModelCalls
+   )
+   asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,59 @@
+import asyncio
+import tempfile
+import functools
+
+from llama_index.core.storage import StorageContext
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.index_store.keyval_index_store import KVIndexStore
+from llama_index.core.storage.kvstore.simple_kvstore import SimpleKVStore
+
+from src.bots import create_chat_bot
+from src.db_handlers.schemas import BotConfig, BotIndex, RagBot
+from src.logger import CustomLogger
+from src.snapshots import SnapshotManifest, export_bot_snapshot
+from src.vector_stores import QuantizedVectorStore
+
+
+logger = CustomLogger(__name__)
+
+
+def _scratch_storage_context(persist_dir: str) -> StorageContext:
+   # in-memory stores, nothing of the bot outlives the export
+   storage_context = StorageContext.from_defaults(
+       docstore=KVDocumentStore(SimpleKVStore()),
+       index_store=KVIndexStore(SimpleKVStore()),
+       vector_store=QuantizedVectorStore(persist_dir=persist_dir),
+   )
+   # the bot persists its new indexes without a directory, which would write them to
+   # `./storage` of the working directory instead of the scratch one
+   storage_context.persist = functools.partial(storage_context.persist, persist_dir=persist_dir)
+   return storage_context
+
+
+async def ingest_bot_to_snapshot(
+   bot_config: BotConfig, snapshot_dir: str, concurrency: int = 1
+) -> SnapshotManifest:
+   """
+   Builds the indexes of a new bot in scratch stores and exports them to `snapshot_dir`,
+   without the database or the configured stores. The bot is created, ready, when the
+   snapshot is imported.
+   """
+   bot = RagBot.from_bot_config(bot_config=bot_config)
+   with tempfile.TemporaryDirectory(prefix="ingest-") as scratch_dir:
+       storage_context = _scratch_storage_context(scratch_dir)
+       chat_bot = create_chat_bot(bot=bot, storage_context=storage_context)
+       await chat_bot.acreate_or_load_indexes(concurrency=concurrency)
+
+       bot.indexes = [
+           BotIndex(resource=resource, index_id=index_id)
+           for resource, index_id in chat_bot.get_resources_to_index_map().items()
+       ]
+       bot.ready = True
+       manifest = await asyncio.to_thread(
+           export_bot_snapshot, bot, storage_context, snapshot_dir
+       )
+   logger.info(
+       message="ingested bot to snapshot",
+       fields={"bot_id": bot.bot_id, "snapshot_dir": snapshot_dir},
+   )
+   return manifest
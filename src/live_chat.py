@@ -0,0 +1,82 @@
+import asyncio
+from typing import Any, Callable, List, Optional
+
+from src.bots import ChatBot
+from src.concurrency import CancellationToken
+from src.db_handlers.schemas import RagBot, User
+from src.logger import CustomLogger
+from src.metrics import metrics
+
+
+logger = CustomLogger(__name__)
+
+
+class ChatUnavailable(Exception):
+   """Raised when a live chat can not be opened, e.g. the bot does not exist or is not ready."""
+
+
+class LiveChatSession:
+   """
+   State of a chat session bound to a WebSocket connection: the bot, and its agent
+   holding the chat history, stay in memory between turns, so a follow-up turn does
+   not reload the bot, the session or the indexes.
+
+   Messages are written behind the turns, in order, by `write_behind`; `close` waits
+   for the pending writes.
+   """
+   def __init__(
+       self,
+       bot: RagBot,
+       chat_bot: ChatBot,
+       chat_session_id: str,
+       user: User,
+       session_exists: bool,
+       cancellation_token: CancellationToken,
+   ) -> None:
+       self.bot = bot
+       self.chat_bot = chat_bot
+       self.chat_session_id = chat_session_id
+       self.user = user
+       self.session_exists = session_exists
+       # bound to the agent's LLM; once cancelled it is never re-armed, see `replace_token`
+       self.cancellation_token = cancellation_token
+       self._retired_tokens: List[CancellationToken] = []
+       self.turns = 0
+       self._last_write: Optional[asyncio.Future] = None
+
+   def write_behind(self, write: Callable[..., Any], **kwargs) -> None:
+       previous = self._last_write
+
+       async def run() -> None:
+           if previous is not None:
+               await asyncio.gather(previous, return_exceptions=True)
+           try:
+               await asyncio.to_thread(write, **kwargs)
+           except Exception as e:
+               metrics.increment("live_chat_write_errors")
+               logger.exception(
+                   message="failed to write live chat session",
+                   fields={"chat_session_id": self.chat_session_id, "error": str(e)},
+               )
+
+       self._last_write = asyncio.ensure_future(run())
+
+   def cancel_turn(self) -> None:
+       self.cancellation_token.cancel()
+
+   def replace_token(self) -> CancellationToken:
+       """
+       Gives the next turn a new token. The cancelled one stays registered until the
+       session closes, as the thread of its turn may still be sending requests.
+       """
+       self._retired_tokens.append(self.cancellation_token)
+       self.cancellation_token = CancellationToken()
+       return self.cancellation_token
+
+   async def close(self) -> None:
+       self.cancellation_token.cancel()
+       if self._last_write is not None:
+           await asyncio.gather(self._last_write, return_exceptions=True)
+       for token in self._retired_tokens + [self.cancellation_token]:
+           token.close()
+       metrics.add_to_gauge("live_chat_sessions", -1)
@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Tuple
+
+
+# recent samples kept per histogram for the percentile estimates
+HISTOGRAM_WINDOW = 1024
+
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, object]) -> MetricKey:
+   return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_key(key: MetricKey) -> str:
+   name, labels = key
+   if not labels:
+       return name
+   return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+class _Histogram:
+   def __init__(self):
+       self.count = 0
+       self.total = 0.0
+       self.max = 0.0
+       self.window: Deque[float] = deque(maxlen=HISTOGRAM_WINDOW)
+
+   def observe(self, value: float) -> None:
+       self.count += 1
+       self.total += value
+       self.max = max(self.max, value)
+       self.window.append(value)
+
+   def summary(self) -> Dict[str, float]:
+       recent = sorted(self.window)
+       percentile = lambda p: recent[min(len(recent) - 1, int(p * len(recent)))] if recent else 0.0
+       return {
+           "count": self.count,
+           "sum": self.total,
+           "mean": self.total / self.count if self.count else 0.0,
+           "max": self.max,
+           "p50": percentile(0.50),
+           "p95": percentile(0.95),
+           "p99": percentile(0.99),
+       }
+
+
+class MetricsRegistry:
+   """Thread-safe in-process counters, gauges and histograms, exposed on `/metrics`."""
+
+   def __init__(self):
+       self._lock = threading.Lock()
+       self._counters: Dict[MetricKey, float] = {}
+       self._gauges: Dict[MetricKey, float] = {}
+       self._histograms: Dict[MetricKey, _Histogram] = {}
+
+   def increment(self, name: str, value: float = 1, **labels: object) -> None:
+       key = _key(name, labels)
+       with self._lock:
+           self._counters[key] = self._counters.get(key, 0) + value
+
+   def set_gauge(self, name: str, value: float, **labels: object) -> None:
+       with self._lock:
+           self._gauges[_key(name, labels)] = value
+
+   def add_to_gauge(self, name: str, value: float, **labels: object) -> None:
+       key = _key(name, labels)
+       with self._lock:
+           self._gauges[key] = self._gauges.get(key, 0) + value
+
+   def observe(self, name: str, value: float, **labels: object) -> None:
+       key = _key(name, labels)
+       with self._lock:
+           histogram = self._histograms.get(key)
+           if histogram is None:
+               histogram = self._histograms[key] = _Histogram()
+           histogram.observe(value)
+
+   @contextmanager
+   def timer(self, name: str, **labels: object) -> Iterator[None]:
+       """Observe the wall time of the block, in seconds."""
+       start = time.perf_counter()
+       try:
+           yield
+       finally:
+           self.observe(name, time.perf_counter() - start, **labels)
+
+   def snapshot(self) -> Dict[str, Dict[str, object]]:
+       with self._lock:
+           return {
+               "counters": {_format_key(k): v for k, v in self._counters.items()},
+               "gauges": {_format_key(k): v for k, v in self._gauges.items()},
+               "histograms": {_format_key(k): h.summary() for k, h in self._histograms.items()},
+           }
+
+
+metrics = MetricsRegistry()
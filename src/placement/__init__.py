@@ -0,0 +1,2 @@
+from src.placement.hash_ring import HashRing
+from src.placement.workers import LocalPlacement, current_placement, worker_names, worker_socket_path
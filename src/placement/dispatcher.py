@@ -0,0 +1,321 @@
+import os
+import asyncio
+import itertools
+import multiprocessing
+from contextlib import asynccontextmanager
+from multiprocessing.process import BaseProcess
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from src.logger import CustomLogger
+from src.metrics import metrics
+from src.placement.hash_ring import HashRing
+from src.placement.workers import (
+   PLACEMENT_NUM_WORKERS_ENV_VAR,
+   PLACEMENT_REPLICAS_ENV_VAR,
+   PLACEMENT_WORKER_ENV_VAR,
+   worker_names,
+   worker_socket_path,
+)
+
+
+logger = CustomLogger(__name__)
+
+
+WORKER_HEADER = "X-Placement-Worker"
+# connection specific headers are not forwarded
+HOP_BY_HOP_HEADERS = {
+   "connection", "keep-alive", "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade",
+}
+
+
+def _run_worker(
+   app_factory: str,
+   socket_path: str,
+   worker: str,
+   num_workers: int,
+   replicas: int,
+   graceful_shutdown_seconds: Optional[float],
+) -> None:
+   os.environ[PLACEMENT_WORKER_ENV_VAR] = worker
+   os.environ[PLACEMENT_NUM_WORKERS_ENV_VAR] = str(num_workers)
+   os.environ[PLACEMENT_REPLICAS_ENV_VAR] = str(replicas)
+   if os.path.exists(socket_path):
+       os.unlink(socket_path)
+   uvicorn.run(
+       app_factory,
+       factory=True,
+       uds=socket_path,
+       timeout_graceful_shutdown=graceful_shutdown_seconds,
+       # the dispatcher logs every request already
+       access_log=False,
+   )
+
+
+class WorkerPool:
+   """
+   Runs a process per worker, each serving the app built by `app_factory` on its own
+   Unix socket in `socket_dir`, and places bots on the healthy workers with a
+   consistent hash ring. A worker joins the ring once `/readiness` passes, i.e. once
+   it has prewarmed its bots, and leaves it when `/healthcheck` fails, moving its bots
+   to the other workers; exited workers are restarted under the same name and get
+   their bots back once ready.
+   """
+   def __init__(
+       self,
+       app_factory: str,
+       socket_dir: str,
+       num_workers: int,
+       replicas: int = 100,
+       health_check_seconds: float = 2,
+       graceful_shutdown_seconds: Optional[float] = 30,
+   ) -> None:
+       self._app_factory = app_factory
+       self._socket_dir = socket_dir
+       self._num_workers = num_workers
+       self._replicas = replicas
+       self._health_check_seconds = health_check_seconds
+       self._graceful_shutdown_seconds = graceful_shutdown_seconds
+       self._workers = worker_names(num_workers)
+       self._ring = HashRing(replicas=replicas)
+       self._healthy: List[str] = []
+       self._round_robin = itertools.count()
+       self._processes: Dict[str, BaseProcess] = {}
+       self._clients: Dict[str, httpx.AsyncClient] = {}
+       self._context = multiprocessing.get_context("spawn")
+       self._monitor: Optional[asyncio.Task] = None
+
+   def socket_path(self, worker: str) -> str:
+       return worker_socket_path(self._socket_dir, worker)
+
+   def client(self, worker: str) -> httpx.AsyncClient:
+       return self._clients[worker]
+
+   def owner(self, bot_id: str) -> Optional[str]:
+       return self._ring.owner(bot_id)
+
+   def next_worker(self) -> Optional[str]:
+       healthy = self._healthy
+       if not healthy:
+           return None
+       return healthy[next(self._round_robin) % len(healthy)]
+
+   def _spawn(self, worker: str) -> None:
+       process = self._context.Process(
+           target=_run_worker,
+           args=(
+               self._app_factory,
+               self.socket_path(worker),
+               worker,
+               self._num_workers,
+               self._replicas,
+               self._graceful_shutdown_seconds,
+           ),
+           name=worker,
+       )
+       process.start()
+       self._processes[worker] = process
+       logger.info(message="started worker process", fields={"worker": worker, "pid": process.pid})
+
+   async def start(self) -> None:
+       os.makedirs(self._socket_dir, exist_ok=True)
+       for worker in self._workers:
+           self._clients[worker] = httpx.AsyncClient(
+               transport=httpx.AsyncHTTPTransport(uds=self.socket_path(worker)),
+               base_url="http://worker",
+               timeout=None,
+           )
+           self._spawn(worker)
+       self._monitor = asyncio.create_task(self._monitor_workers())
+
+   async def _check(self, worker: str, path: str) -> bool:
+       try:
+           response = await self._clients[worker].get(path, timeout=self._health_check_seconds)
+           return response.status_code == status.HTTP_200_OK
+       except httpx.HTTPError:
+           return False
+
+   def mark_unhealthy(self, worker: str) -> None:
+       if worker in self._ring:
+           self._ring.remove(worker)
+           self._healthy = self._ring.nodes
+           metrics.set_gauge("placement_healthy_workers", len(self._healthy))
+           logger.warning(message="worker left the ring", fields={"worker": worker})
+
+   async def _check_workers(self) -> None:
+       for worker in self._workers:
+           if not self._processes[worker].is_alive():
+               self.mark_unhealthy(worker)
+               logger.error(
+                   message="worker process exited, restarting it",
+                   fields={"worker": worker, "exitcode": self._processes[worker].exitcode},
+               )
+               metrics.increment("placement_worker_restarts")
+               self._spawn(worker)
+               continue
+           if worker not in self._ring:
+               # a (re)started worker only takes its bots once it has prewarmed them
+               if await self._check(worker, "/readiness"):
+                   self._ring.add(worker)
+                   self._healthy = self._ring.nodes
+                   metrics.set_gauge("placement_healthy_workers", len(self._healthy))
+                   logger.info(message="worker joined the ring", fields={"worker": worker})
+           elif not await self._check(worker, "/healthcheck"):
+               self.mark_unhealthy(worker)
+
+   async def _monitor_workers(self) -> None:
+       while True:
+           try:
+               await self._check_workers()
+           except Exception as e:
+               logger.exception(message="failed to check workers", fields={"error": str(e)})
+           await asyncio.sleep(self._health_check_seconds)
+
+   async def stop(self) -> None:
+       if self._monitor is not None:
+           self._monitor.cancel()
+           await asyncio.gather(self._monitor, return_exceptions=True)
+       # workers finish their requests in flight on SIGTERM
+       for process in self._processes.values():
+           process.terminate()
+       join_timeout = (self._graceful_shutdown_seconds or 0) + 5
+       for process in self._processes.values():
+           await asyncio.to_thread(process.join, join_timeout)
+           if process.is_alive():
+               process.kill()
+       for client in self._clients.values():
+           await client.aclose()
+       for worker in self._workers:
+           if os.path.exists(self.socket_path(worker)):
+               os.unlink(self.socket_path(worker))
+
+
+def _pick_worker(pool: WorkerPool, bot_id: Optional[str]) -> Optional[str]:
+   # requests of a bot go to its owner, so only the owner loads its indexes
+   if bot_id:
+       return pool.owner(bot_id)
+   return pool.next_worker()
+
+
+def create_dispatcher_app(pool: WorkerPool) -> FastAPI:
+   """
+   App of the dispatcher process: forwards every request, including WebSockets, to the
+   worker owning its `bot_id` query parameter, or to the next healthy worker.
+   """
+   @asynccontextmanager
+   async def lifespan(app: FastAPI):
+       await pool.start()
+       try:
+           yield
+       finally:
+           await pool.stop()
+
+   app = FastAPI(lifespan=lifespan, openapi_url=None, docs_url=None, redoc_url=None)
+
+   @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD"])
+   async def forward(request: Request, path: str):
+       worker = _pick_worker(pool, request.query_params.get("bot_id"))
+       if worker is None:
+           return JSONResponse(
+               {"detail": "no healthy worker"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+           )
+       client = pool.client(worker)
+       upstream_request = client.build_request(
+           request.method,
+           httpx.URL(path=request.url.path, query=request.url.query.encode("utf-8")),
+           headers=[
+               (name, value) for name, value in request.headers.raw
+               if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS | {"host"}
+           ],
+           content=request.stream(),
+       )
+       try:
+           upstream = await client.send(upstream_request, stream=True)
+       except httpx.TransportError as e:
+           pool.mark_unhealthy(worker)
+           logger.exception(
+               message="failed to forward request",
+               fields={"worker": worker, "path": request.url.path, "error": str(e)},
+           )
+           return JSONResponse(
+               {"detail": "worker unavailable"}, status_code=status.HTTP_502_BAD_GATEWAY
+           )
+       metrics.increment("placement_forwarded_requests", worker=worker)
+       headers = {
+           name: value for name, value in upstream.headers.items()
+           if name.lower() not in HOP_BY_HOP_HEADERS
+       }
+       headers[WORKER_HEADER] = worker
+       return StreamingResponse(
+           upstream.aiter_raw(),
+           status_code=upstream.status_code,
+           headers=headers,
+           background=BackgroundTask(upstream.aclose),
+       )
+
+   @app.websocket("/{path:path}")
+   async def forward_websocket(websocket: WebSocket, path: str):
+       from websockets.asyncio.client import unix_connect
+       from websockets.exceptions import ConnectionClosed
+
+       worker = _pick_worker(pool, websocket.query_params.get("bot_id"))
+       if worker is None:
+           await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+           return
+       uri = f"ws://worker{websocket.url.path}"
+       if websocket.url.query:
+           uri = f"{uri}?{websocket.url.query}"
+
+       try:
+           upstream = await unix_connect(pool.socket_path(worker), uri)
+       except (OSError, ConnectionClosed) as e:
+           pool.mark_unhealthy(worker)
+           logger.exception(
+               message="failed to forward websocket",
+               fields={"worker": worker, "path": websocket.url.path, "error": str(e)},
+           )
+           await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+           return
+       await websocket.accept()
+       metrics.increment("placement_forwarded_websockets", worker=worker)
+
+       async def client_to_worker():
+           while True:
+               message = await websocket.receive()
+               if message["type"] == "websocket.disconnect":
+                   return
+               data = message.get("text")
+               await upstream.send(data if data is not None else message.get("bytes", b""))
+
+       async def worker_to_client():
+           async for data in upstream:
+               if isinstance(data, str):
+                   await websocket.send_text(data)
+               else:
+                   await websocket.send_bytes(data)
+
+       tasks = [asyncio.create_task(client_to_worker()), asyncio.create_task(worker_to_client())]
+       try:
+           # whichever side closes first ends the connection
+           await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+       finally:
+           for task in tasks:
+               task.cancel()
+           await asyncio.gather(*tasks, return_exceptions=True)
+           await upstream.close()
+           close_code = upstream.close_code
+           # 1005 and 1006 only report a missing or abnormal close and cannot be sent
+           if close_code in (None, 1005, 1006):
+               close_code = status.WS_1000_NORMAL_CLOSURE
+           try:
+               await websocket.close(code=close_code)
+           except (RuntimeError, WebSocketDisconnect):
+               # the client is already gone
+               pass
+
+   return app
@@ -0,0 +1,74 @@
+import bisect
+import hashlib
+from typing import Dict, Iterable, List, Optional, Set
+
+
+def _hash(key: str) -> int:
+   return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+   """
+   Consistent hash ring placing every node at `replicas` points. A key belongs to the
+   node at the first point after its hash, so adding or removing a node only moves the
+   keys of that node.
+   """
+   def __init__(self, nodes: Iterable[str] = (), replicas: int = 100) -> None:
+       self._replicas = replicas
+       self._points: List[int] = []
+       self._owners: Dict[int, str] = {}
+       # nodes hashing to each point, more than one on a collision
+       self._claimants: Dict[int, Set[str]] = {}
+       self._nodes = set()
+       for node in nodes:
+           self.add(node)
+
+   @property
+   def nodes(self) -> List[str]:
+       return sorted(self._nodes)
+
+   def __len__(self) -> int:
+       return len(self._nodes)
+
+   def __contains__(self, node: str) -> bool:
+       return node in self._nodes
+
+   def add(self, node: str) -> None:
+       if node in self._nodes:
+           return
+       self._nodes.add(node)
+       for replica in range(self._replicas):
+           point = _hash(f"{node}#{replica}")
+           claimants = self._claimants.setdefault(point, set())
+           if not claimants:
+               bisect.insort(self._points, point)
+           claimants.add(node)
+           # the smallest claimant owns a collided point, whatever the join order
+           self._owners[point] = min(claimants)
+
+   def remove(self, node: str) -> None:
+       if node not in self._nodes:
+           return
+       self._nodes.discard(node)
+       emptied = False
+       for replica in range(self._replicas):
+           point = _hash(f"{node}#{replica}")
+           claimants = self._claimants.get(point)
+           if claimants is None or node not in claimants:
+               continue
+           claimants.discard(node)
+           if claimants:
+               # the point goes back to the other nodes hashing to it
+               self._owners[point] = min(claimants)
+           else:
+               del self._claimants[point]
+               del self._owners[point]
+               emptied = True
+       if emptied:
+           self._points = [point for point in self._points if point in self._owners]
+
+   def owner(self, key: str) -> Optional[str]:
+       if not self._points:
+           return None
+       i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+       return self._owners[self._points[i]]
@@ -0,0 +1,40 @@
+import os
+from typing import List, Optional
+
+from src.placement.hash_ring import HashRing
+
+
+PLACEMENT_WORKER_ENV_VAR = "PLACEMENT_WORKER"
+PLACEMENT_NUM_WORKERS_ENV_VAR = "PLACEMENT_NUM_WORKERS"
+PLACEMENT_REPLICAS_ENV_VAR = "PLACEMENT_REPLICAS"
+
+
+def worker_names(num_workers: int) -> List[str]:
+   # names are stable, so a restarted worker gets its bots back
+   return [f"worker-{i}" for i in range(num_workers)]
+
+
+def worker_socket_path(socket_dir: str, worker: str) -> str:
+   return os.path.join(socket_dir, f"{worker}.sock")
+
+
+class LocalPlacement:
+   """Placement as seen by a worker process: the bots it owns when every worker is up."""
+   def __init__(self, worker: str, num_workers: int, replicas: int = 100) -> None:
+       self.worker = worker
+       self._ring = HashRing(worker_names(num_workers), replicas=replicas)
+
+   def owns(self, bot_id: str) -> bool:
+       return self._ring.owner(bot_id) == self.worker
+
+
+def current_placement() -> Optional[LocalPlacement]:
+   """Placement of this process when it was started by the dispatcher, else `None`."""
+   worker = os.getenv(PLACEMENT_WORKER_ENV_VAR)
+   if worker is None:
+       return None
+   return LocalPlacement(
+       worker=worker,
+       num_workers=int(os.environ[PLACEMENT_NUM_WORKERS_ENV_VAR]),
+       replicas=int(os.getenv(PLACEMENT_REPLICAS_ENV_VAR, "100")),
+   )
@@ -0,0 +1,7 @@
+from src.snapshots.manifest import SnapshotError, SnapshotManifest
+from src.snapshots.bot_snapshot import (
+   export_bot_snapshot,
+   import_bot_snapshot,
+   load_snapshot_embeddings,
+   read_manifest,
+)
@@ -0,0 +1,54 @@
+"""
+Exports a bot's indexes to a snapshot directory, or imports one into the configured stores.
+
+Run from the repository root:
+
+   python -m src.snapshots export --bot-id <bot_id> --dir snapshots/<bot_id>
+   python -m src.snapshots import --dir snapshots/<bot_id>
+"""
+import argparse
+import asyncio
+
+from src import config
+from version import VERSION
+
+
+async def run(args: argparse.Namespace) -> None:
+   from src.chat_bot_manager import ChatBotManager
+
+   chatbot_manager = ChatBotManager()
+   try:
+       if args.command == "export":
+           manifest = await chatbot_manager.export_bot_snapshot(
+               bot_id=args.bot_id, snapshot_dir=args.dir
+           )
+           print(f"exported {manifest.num_nodes} nodes of bot {args.bot_id} to {args.dir}")
+       else:
+           bot = await chatbot_manager.import_bot_snapshot(
+               snapshot_dir=args.dir, verify=not args.no_verify
+           )
+           print(f"imported bot {bot.bot_id} from {args.dir}")
+   finally:
+       chatbot_manager.close()
+
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__)
+   parser.add_argument("command", choices=["export", "import"])
+   parser.add_argument("--dir", type=str, required=True, help="snapshot directory")
+   parser.add_argument("--bot-id", type=str, default=None, help="bot to export")
+   parser.add_argument(
+       "--no-verify", action="store_true", help="skip the checksums of the snapshot files"
+   )
+   parser.add_argument("--config", type=str, default="configs/dev.config.json")
+   parser.add_argument("--env", type=str, default=".env")
+   args = parser.parse_args()
+   if args.command == "export" and not args.bot_id:
+       parser.error("export needs --bot-id")
+
+   config.load_config(app_version=VERSION, config_json_path=args.config, env_path=args.env)
+   asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,286 @@
+"""
+A bot snapshot is a directory holding everything needed to serve the bot's indexes:
+
+- `embeddings.npy`: float32 embeddings of all nodes, one row per node, loaded memory-mapped.
+- `nodes.jsonl.gz`: one `{"index_id", "node"}` line per node, in the rows' order.
+- `index_structs.json`: index structs by index id, as kept by the index store.
+- `manifest.json`: the bot, the rows of every index and the checksums of the files
+  above. It is written last, so a directory without it is an incomplete export.
+"""
+import os
+import gzip
+import json
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage import StorageContext
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.core.storage.index_store.utils import index_struct_to_json, json_to_index_struct
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+from src.config_constants import DOC_INDEX_ID_METADATA_KEY
+from src.db_handlers.schemas import RagBot
+from src.db_handlers.utils import get_current_timestamp
+from src.indices import BM25IndexStore
+from src.logger import CustomLogger
+from src.snapshots.manifest import (
+   DATA_FILENAMES,
+   EMBEDDINGS_FILENAME,
+   INDEX_STRUCTS_FILENAME,
+   MANIFEST_FILENAME,
+   NODES_FILENAME,
+   SNAPSHOT_FORMAT_VERSION,
+   SnapshotError,
+   SnapshotFile,
+   SnapshotIndex,
+   SnapshotManifest,
+   file_sha256,
+)
+from src.vector_stores.utils import atomic_write_json
+
+
+logger = CustomLogger(__name__)
+
+
+def _index_node_ids(
+   storage_context: StorageContext, index_id: str, index_struct: Any, page_size: int
+) -> List[str]:
+   vector_store = storage_context.vector_store
+   if vector_store.class_name() != "ChromaVectorStore":
+       return list(index_struct.nodes_dict.values())
+
+   # text-storing stores leave `nodes_dict` empty, the nodes carry their index id instead
+   node_ids: List[str] = []
+   while True:
+       result = vector_store.client.get(
+           where={DOC_INDEX_ID_METADATA_KEY: index_id},
+           include=[],
+           limit=page_size,
+           offset=len(node_ids),
+       )
+       node_ids.extend(result["ids"])
+       if len(result["ids"]) < page_size:
+           return node_ids
+
+
+def _read_index_nodes(
+   storage_context: StorageContext, node_ids: List[str]
+) -> Tuple[List[BaseNode], np.ndarray]:
+   vector_store = storage_context.vector_store
+   if hasattr(vector_store, "get_embeddings"):
+       # local vector stores keep the node text in the docstore
+       nodes = storage_context.docstore.get_nodes(node_ids)
+       return nodes, vector_store.get_embeddings(node_ids)
+
+   if vector_store.class_name() == "ChromaVectorStore":
+       result = vector_store.client.get(
+           ids=node_ids, include=["embeddings", "metadatas", "documents"]
+       )
+       position_by_id = {node_id: i for i, node_id in enumerate(result["ids"])}
+       if len(position_by_id) != len(node_ids):
+           raise SnapshotError("some nodes are not in the vector store")
+       order = [position_by_id[node_id] for node_id in node_ids]
+       nodes = [
+           metadata_dict_to_node(result["metadatas"][i], text=result["documents"][i])
+           for i in order
+       ]
+       return nodes, np.asarray(result["embeddings"], dtype=np.float32)[order]
+
+   raise SnapshotError(f"snapshots of {vector_store.class_name()} are not supported")
+
+
+def export_bot_snapshot(
+   bot: RagBot, storage_context: StorageContext, snapshot_dir: str, batch_size: int = 2048
+) -> SnapshotManifest:
+   """
+   Writes the indexes of `bot` to `snapshot_dir`. Nodes are read `batch_size` at a time
+   and their embeddings go straight to the memory-mapped embeddings file.
+   """
+   if not bot.indexes:
+       raise SnapshotError(f"bot {bot.bot_id} has no indexes")
+   os.makedirs(snapshot_dir, exist_ok=True)
+   manifest_path = os.path.join(snapshot_dir, MANIFEST_FILENAME)
+   if os.path.exists(manifest_path):
+       os.remove(manifest_path)
+
+   index_structs: Dict[str, dict] = {}
+   node_ids_by_index: Dict[str, List[str]] = {}
+   for bot_index in bot.indexes:
+       index_struct = storage_context.index_store.get_index_struct(bot_index.index_id)
+       if index_struct is None:
+           raise SnapshotError(f"index {bot_index.index_id} is not in the index store")
+       node_ids = _index_node_ids(storage_context, bot_index.index_id, index_struct, batch_size)
+       if not node_ids:
+           raise SnapshotError(f"index {bot_index.index_id} has no nodes in the vector store")
+       index_structs[bot_index.index_id] = index_struct_to_json(index_struct)
+       node_ids_by_index[bot_index.index_id] = node_ids
+   num_nodes = sum(len(node_ids) for node_ids in node_ids_by_index.values())
+
+   embeddings_path = os.path.join(snapshot_dir, EMBEDDINGS_FILENAME)
+   tmp_embeddings_path = f"{embeddings_path}.tmp"
+   embeddings: Optional[np.memmap] = None
+   indexes: List[SnapshotIndex] = []
+   start = 0
+   with gzip.open(os.path.join(snapshot_dir, NODES_FILENAME), "wt", encoding="utf-8") as f:
+       for bot_index in bot.indexes:
+           node_ids = node_ids_by_index[bot_index.index_id]
+           for batch_start in range(0, len(node_ids), batch_size):
+               row = start + batch_start
+               nodes, batch_embeddings = _read_index_nodes(
+                   storage_context, node_ids[batch_start:batch_start + batch_size]
+               )
+               if embeddings is None:
+                   # the dimension is known from the first batch
+                   embeddings = np.lib.format.open_memmap(
+                       tmp_embeddings_path,
+                       mode="w+",
+                       dtype=np.float32,
+                       shape=(num_nodes, np.shape(batch_embeddings)[1]),
+                   )
+               embeddings[row:row + len(nodes)] = batch_embeddings
+               for node in nodes:
+                   # embeddings are only kept in the embeddings file
+                   node.embedding = None
+                   f.write(json.dumps({"index_id": bot_index.index_id, "node": doc_to_json(node)}))
+                   f.write("\n")
+
+           indexes.append(SnapshotIndex(
+               index_id=bot_index.index_id,
+               resource=bot_index.resource,
+               start=start,
+               count=len(node_ids),
+           ))
+           start += len(node_ids)
+
+   embedding_dim = embeddings.shape[1]
+   embeddings.flush()
+   del embeddings
+   os.replace(tmp_embeddings_path, embeddings_path)
+   atomic_write_json(os.path.join(snapshot_dir, INDEX_STRUCTS_FILENAME), index_structs)
+
+   manifest = SnapshotManifest(
+       format_version=SNAPSHOT_FORMAT_VERSION,
+       created_at=get_current_timestamp(),
+       bot=bot,
+       embedding_dim=embedding_dim,
+       num_nodes=start,
+       indexes=indexes,
+       files=[
+           SnapshotFile(
+               name=name,
+               size=os.path.getsize(os.path.join(snapshot_dir, name)),
+               sha256=file_sha256(os.path.join(snapshot_dir, name)),
+           )
+           for name in DATA_FILENAMES
+       ],
+   )
+   atomic_write_json(manifest_path, manifest.model_dump(mode="json"))
+   logger.info(
+       message="exported bot snapshot",
+       fields={"bot_id": bot.bot_id, "snapshot_dir": snapshot_dir, "num_nodes": start},
+   )
+   return manifest
+
+
+def read_manifest(snapshot_dir: str, verify: bool = True) -> SnapshotManifest:
+   """Reads the manifest and, with `verify`, checks the size and checksum of every file."""
+   manifest_path = os.path.join(snapshot_dir, MANIFEST_FILENAME)
+   if not os.path.exists(manifest_path):
+       raise SnapshotError(f"{snapshot_dir} has no manifest, the export is incomplete")
+   with open(manifest_path, "r") as f:
+       manifest = SnapshotManifest(**json.load(f))
+   if manifest.format_version != SNAPSHOT_FORMAT_VERSION:
+       raise SnapshotError(f"unsupported snapshot format version {manifest.format_version}")
+
+   if verify:
+       for snapshot_file in manifest.files:
+           path = os.path.join(snapshot_dir, snapshot_file.name)
+           if not os.path.exists(path) or os.path.getsize(path) != snapshot_file.size:
+               raise SnapshotError(f"{snapshot_file.name} is missing or truncated")
+           if file_sha256(path) != snapshot_file.sha256:
+               raise SnapshotError(f"checksum mismatch for {snapshot_file.name}")
+   return manifest
+
+
+def load_snapshot_embeddings(snapshot_dir: str) -> np.ndarray:
+   """Embeddings of the snapshot, memory-mapped rather than read."""
+   return np.load(os.path.join(snapshot_dir, EMBEDDINGS_FILENAME), mmap_mode="r")
+
+
+def iter_snapshot_nodes(snapshot_dir: str) -> Iterator[Tuple[str, BaseNode]]:
+   with gzip.open(os.path.join(snapshot_dir, NODES_FILENAME), "rt", encoding="utf-8") as f:
+       for line in f:
+           record = json.loads(line)
+           yield record["index_id"], json_to_doc(record["node"])
+
+
+def _add_batch(storage_context: StorageContext, nodes: Sequence[BaseNode], embeddings: np.ndarray):
+   vector_store = storage_context.vector_store
+   if hasattr(vector_store, "add_embeddings"):
+       # rows go straight from the memory map to the store
+       vector_store.add_embeddings(nodes, embeddings)
+       return
+   for node, embedding in zip(nodes, embeddings):
+       node.embedding = embedding.tolist()
+   vector_store.add(nodes)
+   for node in nodes:
+       node.embedding = None
+
+
+def import_bot_snapshot(
+   snapshot_dir: str,
+   storage_context: StorageContext,
+   bm25_store: Optional[BM25IndexStore] = None,
+   verify: bool = True,
+   batch_size: int = 2048,
+) -> SnapshotManifest:
+   """
+   Adds the nodes, embeddings and index structs of a snapshot to the stores, and
+   rebuilds the BM25 indexes when `bm25_store` is given. The bot itself is not stored.
+   """
+   manifest = read_manifest(snapshot_dir, verify=verify)
+   embeddings = load_snapshot_embeddings(snapshot_dir)
+   if embeddings.shape != (manifest.num_nodes, manifest.embedding_dim):
+       raise SnapshotError(f"embeddings of shape {embeddings.shape} do not match the manifest")
+
+   # as at ingestion, the docstore keeps nodes when the vector store does not or for BM25
+   store_nodes = not storage_context.vector_store.stores_text or bm25_store is not None
+   nodes_by_index: Dict[str, List[BaseNode]] = {}
+   batch: List[BaseNode] = []
+   row = 0
+   for index_id, node in iter_snapshot_nodes(snapshot_dir):
+       batch.append(node)
+       if bm25_store is not None:
+           nodes_by_index.setdefault(index_id, []).append(node)
+       if len(batch) == batch_size:
+           _add_batch(storage_context, batch, embeddings[row:row + len(batch)])
+           if store_nodes:
+               storage_context.docstore.add_documents(batch, allow_update=True)
+           row += len(batch)
+           batch = []
+   if batch:
+       _add_batch(storage_context, batch, embeddings[row:row + len(batch)])
+       if store_nodes:
+           storage_context.docstore.add_documents(batch, allow_update=True)
+       row += len(batch)
+   if row != manifest.num_nodes:
+       raise SnapshotError(f"snapshot has {row} nodes, the manifest lists {manifest.num_nodes}")
+
+   with open(os.path.join(snapshot_dir, INDEX_STRUCTS_FILENAME), "r") as f:
+       index_structs = json.load(f)
+   for index_struct in index_structs.values():
+       storage_context.index_store.add_index_struct(json_to_index_struct(index_struct))
+   for index_id, nodes in nodes_by_index.items():
+       bm25_store.build(index_id=index_id, nodes=nodes)
+   storage_context.persist()
+
+   logger.info(
+       message="imported bot snapshot",
+       fields={
+           "bot_id": manifest.bot.bot_id,
+           "snapshot_dir": snapshot_dir,
+           "num_nodes": manifest.num_nodes,
+       },
+   )
+   return manifest
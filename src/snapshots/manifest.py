@@ -0,0 +1,50 @@
+import hashlib
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from src.db_handlers.schemas import RagBot
+
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+MANIFEST_FILENAME = "manifest.json"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+NODES_FILENAME = "nodes.jsonl.gz"
+INDEX_STRUCTS_FILENAME = "index_structs.json"
+DATA_FILENAMES = [EMBEDDINGS_FILENAME, NODES_FILENAME, INDEX_STRUCTS_FILENAME]
+
+
+class SnapshotError(Exception):
+   pass
+
+
+class SnapshotFile(BaseModel):
+   name: str = Field(title="file name in the snapshot directory")
+   size: int = Field(title="size in bytes")
+   sha256: str = Field(title="hex sha256 of the file")
+
+
+class SnapshotIndex(BaseModel):
+   index_id: str = Field(title="id of the index")
+   resource: str = Field(title="url of the indexed resource")
+   start: int = Field(title="first row of the index in the embeddings and nodes files")
+   count: int = Field(title="number of nodes of the index")
+
+
+class SnapshotManifest(BaseModel):
+   format_version: int = Field(title="version of the snapshot layout")
+   created_at: str = Field(title="timestamp when the snapshot was exported")
+   bot: RagBot = Field(title="bot the snapshot was exported from")
+   embedding_dim: int = Field(title="dimension of the embeddings")
+   num_nodes: int = Field(title="number of nodes of all indexes")
+   indexes: List[SnapshotIndex] = Field(title="indexes, in the order of their rows")
+   files: List[SnapshotFile] = Field(title="data files with their checksums")
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+   digest = hashlib.sha256()
+   with open(path, "rb") as f:
+       for chunk in iter(lambda: f.read(chunk_size), b""):
+           digest.update(chunk)
+   return digest.hexdigest()
@@ -0,0 +1,139 @@
+import json
+import asyncio
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+
+"""
+Server-sent event framing of streamed answers.
+
+`raw` is the original format: one `data: <token>` frame per token, after a frame with
+the sources. `json` sends typed events whose data is JSON, so any text is safe:
+
+   event: sources   data: {"resources": [...]}
+   event: delta     data: {"text": "..."}      (tokens coalesced by time or size)
+   event: usage     data: {"completion_tokens": n}
+   event: done      data: {}
+   event: error     data: {"message": "..."}
+
+plus `: ping` comment lines while no token arrives for a while.
+"""
+
+
+RAW_FORMAT = "raw"
+JSON_FORMAT = "json"
+STREAM_FORMATS = (RAW_FORMAT, JSON_FORMAT)
+
+SOURCES_EVENT = "sources"
+DELTA_EVENT = "delta"
+USAGE_EVENT = "usage"
+DONE_EVENT = "done"
+ERROR_EVENT = "error"
+
+HEARTBEAT = ": ping\n\n"
+
+_END = object()
+
+
+class _Failure:
+   def __init__(self, error: Exception) -> None:
+       self.error = error
+
+
+def encode_event(event: str, data: Dict[str, Any]) -> str:
+   return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+async def coalesce(
+   tokens: AsyncIterator[str],
+   window_seconds: float,
+   max_chars: int,
+   heartbeat_seconds: Optional[float],
+) -> AsyncIterator[Optional[str]]:
+   """
+   Joins tokens into chunks, each flushed `window_seconds` after its first token or
+   once it reaches `max_chars`. Yields `None` when nothing arrived for `heartbeat_seconds`,
+   unless it is `None`.
+   """
+   loop = asyncio.get_running_loop()
+   queue: asyncio.Queue = asyncio.Queue()
+
+   async def pump() -> None:
+       try:
+           async for token in tokens:
+               queue.put_nowait(token)
+       except Exception as e:
+           queue.put_nowait(_Failure(e))
+       else:
+           queue.put_nowait(_END)
+
+   pump_task = asyncio.ensure_future(pump())
+   buffer: List[str] = []
+   buffered_chars = 0
+   flush_at: Optional[float] = None
+   try:
+       while True:
+           timeout = heartbeat_seconds if flush_at is None else max(flush_at - loop.time(), 0)
+           try:
+               item = await asyncio.wait_for(queue.get(), timeout)
+           except asyncio.TimeoutError:
+               if buffer:
+                   yield "".join(buffer)
+                   buffer, buffered_chars, flush_at = [], 0, None
+               else:
+                   yield None
+               continue
+
+           if item is _END or isinstance(item, _Failure):
+               if buffer:
+                   yield "".join(buffer)
+               if isinstance(item, _Failure):
+                   raise item.error
+               return
+
+           buffer.append(item)
+           buffered_chars += len(item)
+           if flush_at is None:
+               flush_at = loop.time() + window_seconds
+           if buffered_chars >= max_chars:
+               yield "".join(buffer)
+               buffer, buffered_chars, flush_at = [], 0, None
+   finally:
+       pump_task.cancel()
+
+
+async def raw_event_stream(resources: Iterable[str], tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+   yield f"data: {json.dumps({'resources': list(resources)})}\n\n"
+   async for token in tokens:
+       yield f"data: {token}\n\n"
+
+
+async def json_event_stream(
+   resources: Iterable[str],
+   tokens: AsyncIterator[str],
+   window_seconds: float = 0.05,
+   max_chars: int = 256,
+   heartbeat_seconds: float = 15,
+) -> AsyncIterator[str]:
+   yield encode_event(SOURCES_EVENT, {"resources": list(resources)})
+
+   num_tokens = 0
+
+   async def counted() -> AsyncIterator[str]:
+       nonlocal num_tokens
+       async for token in tokens:
+           num_tokens += 1
+           yield token
+
+   chunks = coalesce(counted(), window_seconds, max_chars, heartbeat_seconds)
+   try:
+       async for chunk in chunks:
+           yield HEARTBEAT if chunk is None else encode_event(DELTA_EVENT, {"text": chunk})
+   except Exception:
+       yield encode_event(ERROR_EVENT, {"message": "failed to generate the answer"})
+       raise
+   finally:
+       await chunks.aclose()
+
+   # streamed chunks of OpenAI completions are one token each
+   yield encode_event(USAGE_EVENT, {"completion_tokens": num_tokens})
+   yield encode_event(DONE_EVENT, {})
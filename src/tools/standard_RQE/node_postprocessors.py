@@ -0,0 +1,192 @@
+import time
+from abc import abstractmethod
+from typing import List, Optional, Set
+
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+
+from src import config
+from src.db_handlers.schemas import NodePostProcessingConfig
+from src.indices.bm25_index import tokenize
+from src.metrics import metrics
+
+
+class TimedNodePostprocessor(BaseNodePostprocessor):
+   """
+   Base class of the pipeline stages. Records per-stage latency and the number of
+   nodes going in and out, labelled with the stage and the bot.
+   """
+   bot_id: Optional[str] = Field(default=None, description="bot used to label metrics")
+
+   @abstractmethod
+   def _process(
+       self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle]
+   ) -> List[NodeWithScore]:
+       raise NotImplementedError
+
+   def _postprocess_nodes(
+       self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+   ) -> List[NodeWithScore]:
+       start = time.perf_counter()
+       processed = self._process(nodes, query_bundle)
+       labels = {"stage": self.class_name(), "bot_id": self.bot_id}
+       metrics.observe("node_postprocessor_seconds", time.perf_counter() - start, **labels)
+       metrics.increment("node_postprocessor_nodes_in", len(nodes), **labels)
+       metrics.increment("node_postprocessor_nodes_out", len(processed), **labels)
+       return processed
+
+
+class ScoreCutoffPostprocessor(TimedNodePostprocessor):
+   """
+   Drops nodes scoring below `similarity_cutoff`, and/or below `relative_cutoff`
+   times the best score. The relative cutoff also works with hybrid retrieval,
+   whose reciprocal rank fusion scores are not similarities.
+   """
+   similarity_cutoff: Optional[float] = None
+   relative_cutoff: Optional[float] = None
+
+   @classmethod
+   def class_name(cls) -> str:
+       return "ScoreCutoffPostprocessor"
+
+   def _process(self, nodes, query_bundle):
+       if not nodes:
+           return nodes
+       threshold = float("-inf")
+       if self.similarity_cutoff is not None:
+           threshold = self.similarity_cutoff
+       if self.relative_cutoff is not None:
+           best = max(node.score or 0.0 for node in nodes)
+           threshold = max(threshold, self.relative_cutoff * best)
+       return [node for node in nodes if (node.score or 0.0) >= threshold]
+
+
+def _shingles(text: str, size: int = 3) -> Set[str]:
+   words = text.lower().split()
+   if len(words) <= size:
+       return {" ".join(words)}
+   return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class NearDuplicatePostprocessor(TimedNodePostprocessor):
+   """
+   Drops nodes whose word 3-gram Jaccard similarity with a higher-ranked kept node
+   is at least `threshold`, e.g. the same README section indexed from two branches.
+   """
+   threshold: float = 0.9
+
+   @classmethod
+   def class_name(cls) -> str:
+       return "NearDuplicatePostprocessor"
+
+   def _process(self, nodes, query_bundle):
+       kept: List[NodeWithScore] = []
+       kept_shingles: List[Set[str]] = []
+       for node in nodes:
+           shingles = _shingles(node.node.get_content(metadata_mode=MetadataMode.NONE))
+           is_duplicate = any(
+               len(shingles & other) / max(len(shingles | other), 1) >= self.threshold
+               for other in kept_shingles
+           )
+           if not is_duplicate:
+               kept.append(node)
+               kept_shingles.append(shingles)
+       return kept
+
+
+class LexicalOverlapReranker(TimedNodePostprocessor):
+   """
+   Cheap local reranker: blends the retrieval score (normalised by the best score)
+   with the fraction of query terms present in the node, then re-sorts. Helps with
+   exact identifiers and error strings that embeddings blur.
+   """
+   weight: float = 0.3
+
+   @classmethod
+   def class_name(cls) -> str:
+       return "LexicalOverlapReranker"
+
+   def _process(self, nodes, query_bundle):
+       if not nodes or query_bundle is None:
+           return nodes
+       query_terms = set(tokenize(query_bundle.query_str))
+       if not query_terms:
+           return nodes
+
+       best = max(node.score or 0.0 for node in nodes) or 1.0
+       reranked = []
+       for node in nodes:
+           node_terms = set(tokenize(node.node.get_content(metadata_mode=MetadataMode.NONE)))
+           overlap = len(query_terms & node_terms) / len(query_terms)
+           score = (1.0 - self.weight) * (node.score or 0.0) / best + self.weight * overlap
+           reranked.append(NodeWithScore(node=node.node, score=score))
+       return sorted(reranked, key=lambda node: node.score, reverse=True)
+
+
+class TokenBudgetPostprocessor(TimedNodePostprocessor):
+   """
+   Packs nodes, best first, into at most `max_tokens` tokens of LLM context. Nodes
+   that do not fit are skipped, so a smaller lower-ranked node can still fill the gap.
+   """
+   max_tokens: int = 3000
+
+   @classmethod
+   def class_name(cls) -> str:
+       return "TokenBudgetPostprocessor"
+
+   def _process(self, nodes, query_bundle):
+       tokenizer = get_tokenizer()
+       packed = []
+       used_tokens = 0
+       for node in nodes:
+           num_tokens = len(tokenizer(node.node.get_content(metadata_mode=MetadataMode.LLM)))
+           if used_tokens + num_tokens <= self.max_tokens:
+               packed.append(node)
+               used_tokens += num_tokens
+       metrics.observe("context_tokens", used_tokens, bot_id=self.bot_id)
+       return packed
+
+
+def resolve_postprocessing_config(
+   bot_config: Optional[NodePostProcessingConfig] = None,
+) -> NodePostProcessingConfig:
+   """Bot-level settings, with every unset value taken from the `PostProcessing` config."""
+   defaults = NodePostProcessingConfig(
+       similarity_cutoff=config.postprocessing_cfg.SimilarityCutoff,
+       relative_score_cutoff=config.postprocessing_cfg.RelativeScoreCutoff,
+       dedup_threshold=config.postprocessing_cfg.DedupThreshold,
+       lexical_rerank_weight=config.postprocessing_cfg.LexicalRerankWeight,
+       context_token_budget=config.postprocessing_cfg.ContextTokenBudget,
+   )
+   if bot_config is None:
+       return defaults
+   overrides = bot_config.model_dump(exclude_none=True)
+   return defaults.model_copy(update=overrides)
+
+
+def build_node_postprocessors(
+   settings: NodePostProcessingConfig, bot_id: Optional[str] = None
+) -> List[BaseNodePostprocessor]:
+   """Pipeline run in order: score cutoff, de-duplication, rerank, token budget."""
+   postprocessors: List[BaseNodePostprocessor] = []
+   if settings.similarity_cutoff is not None or settings.relative_score_cutoff is not None:
+       postprocessors.append(ScoreCutoffPostprocessor(
+           bot_id=bot_id,
+           similarity_cutoff=settings.similarity_cutoff,
+           relative_cutoff=settings.relative_score_cutoff,
+       ))
+   if settings.dedup_threshold is not None:
+       postprocessors.append(
+           NearDuplicatePostprocessor(bot_id=bot_id, threshold=settings.dedup_threshold)
+       )
+   if settings.lexical_rerank_weight:
+       postprocessors.append(
+           LexicalOverlapReranker(bot_id=bot_id, weight=settings.lexical_rerank_weight)
+       )
+   if settings.context_token_budget is not None:
+       postprocessors.append(
+           TokenBudgetPostprocessor(bot_id=bot_id, max_tokens=settings.context_token_budget)
+       )
+   return postprocessors
@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks.base import CallbackManager
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+
+from src.indices import BM25Index
+
+
+DEFAULT_RRF_K = 60
+
+# dense retrieval runs here while the calling thread scores BM25
+_executor = ThreadPoolExecutor(thread_name_prefix="hybrid-retriever")
+
+
+def _fetch_nodes(
+   docstore: BaseDocumentStore, hits: List[Tuple[str, float]]
+) -> List[NodeWithScore]:
+   nodes = []
+   for node_id, score in hits:
+       node = docstore.get_node(node_id, raise_error=False)
+       if node is not None:
+           nodes.append(NodeWithScore(node=node, score=score))
+   return nodes
+
+
+class BM25Retriever(BaseRetriever):
+   """Lexical retriever over a `BM25Index`; node contents are read from the docstore."""
+   def __init__(
+       self,
+       bm25_index: BM25Index,
+       docstore: BaseDocumentStore,
+       similarity_top_k: int = 10,
+       callback_manager: Optional[CallbackManager] = None,
+   ) -> None:
+       super().__init__(callback_manager=callback_manager)
+       self._bm25_index = bm25_index
+       self._docstore = docstore
+       self._similarity_top_k = similarity_top_k
+
+   def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+       hits = self._bm25_index.search(query_bundle.query_str, self._similarity_top_k)
+       return _fetch_nodes(self._docstore, hits)
+
+
+class HybridFusionRetriever(BaseRetriever):
+   """
+   Runs dense retrieval and BM25 lexical retrieval concurrently and merges both
+   rankings with reciprocal rank fusion: score(node) = sum(1 / (rrf_k + rank)).
+   Returned scores are RRF scores, not cosine similarities.
+
+   Lexical hits that dense retrieval also found reuse its node objects, so only
+   lexical-only hits are read from the docstore.
+   """
+   def __init__(
+       self,
+       dense_retriever: BaseRetriever,
+       bm25_index: BM25Index,
+       docstore: BaseDocumentStore,
+       similarity_top_k: int = 2,
+       lexical_top_k: int = 10,
+       rrf_k: int = DEFAULT_RRF_K,
+       callback_manager: Optional[CallbackManager] = None,
+   ) -> None:
+       super().__init__(callback_manager=callback_manager)
+       self._dense_retriever = dense_retriever
+       self._bm25_index = bm25_index
+       self._docstore = docstore
+       self._similarity_top_k = similarity_top_k
+       self._lexical_top_k = lexical_top_k
+       self._rrf_k = rrf_k
+
+   def _fuse(
+       self, dense_nodes: List[NodeWithScore], lexical_hits: List[Tuple[str, float]]
+   ) -> List[NodeWithScore]:
+       fused_scores: Dict[str, float] = {}
+       for rank, node in enumerate(dense_nodes):
+           fused_scores[node.node.node_id] = 1.0 / (self._rrf_k + rank + 1)
+       for rank, (node_id, _) in enumerate(lexical_hits):
+           fused_scores[node_id] = fused_scores.get(node_id, 0.0) + 1.0 / (self._rrf_k + rank + 1)
+
+       ranked = sorted(fused_scores.items(), key=lambda item: item[1], reverse=True)
+       ranked = ranked[:self._similarity_top_k]
+
+       nodes_by_id = {node.node.node_id: node.node for node in dense_nodes}
+       missing = [(node_id, score) for node_id, score in ranked if node_id not in nodes_by_id]
+       for node in _fetch_nodes(self._docstore, missing):
+           nodes_by_id[node.node.node_id] = node.node
+
+       return [
+           NodeWithScore(node=nodes_by_id[node_id], score=score)
+           for node_id, score in ranked if node_id in nodes_by_id
+       ]
+
+   def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+       dense_future = _executor.submit(
+           contextvars.copy_context().run, self._dense_retriever.retrieve, query_bundle
+       )
+       lexical_hits = self._bm25_index.search(query_bundle.query_str, self._lexical_top_k)
+       return self._fuse(dense_future.result(), lexical_hits)
+
+   async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+       dense_nodes, lexical_hits = await asyncio.gather(
+           self._dense_retriever.aretrieve(query_bundle),
+           asyncio.to_thread(self._bm25_index.search, query_bundle.query_str, self._lexical_top_k),
+       )
+       return await asyncio.to_thread(self._fuse, dense_nodes, lexical_hits)
@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
 from pydantic import BaseModel
 
 
@@ -16,9 +16,12 @@ from llama_index.core.service_context import ServiceContext
 from llama_index.core.postprocessor.types import BaseNodePostprocessor
 from llama_index.core.vector_stores import MetadataFilters
 from llama_index.core.query_engine.retriever_query_engine import RetrieverQueryEngine
+from llama_index.core.storage.docstore.types import BaseDocumentStore
 
 
+from src.indices import BM25Index
 from src.tools.base_tool import BaseTool
+from src.tools.standard_RQE.retriever import DEFAULT_RRF_K, HybridFusionRetriever
 
 
 class StandardRetrieverQueryEngineTool(BaseTool):
@@ -33,16 +36,40 @@ class StandardRetrieverQueryEngineTool(BaseTool):
        streaming: bool = False,
        response_mode: ResponseMode = ResponseMode.COMPACT,
        filters: Optional[MetadataFilters] = None,
+       vector_store_kwargs: Optional[Dict[str, Any]] = None,
+       similarity_top_k: int = 2,
+       bm25_index: Optional[BM25Index] = None,
+       docstore: Optional[BaseDocumentStore] = None,
+       lexical_top_k: int = 10,
+       rrf_k: int = DEFAULT_RRF_K,
+       node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
        service_context: Optional[ServiceContext] = None,
        output_cls: Optional[BaseModel] = None,
        verbose: bool = False,
    ) -> QueryEngineTool:
-       retriever: BaseRetriever = index.as_retriever(filters=filters)
+       # `vector_store_kwargs` are passed to every vector store query, e.g. `nprobe`
+       retriever: BaseRetriever = index.as_retriever(
+           filters=filters,
+           similarity_top_k=similarity_top_k,
+           vector_store_kwargs=vector_store_kwargs or {},
+       )
       
        callback_manager = callback_manager_from_settings_or_context(
            Settings, service_context
        )
       
+       if bm25_index is not None:
+           # hybrid retrieval: BM25 over the same index, fused with the dense results
+           retriever = HybridFusionRetriever(
+               dense_retriever=retriever,
+               bm25_index=bm25_index,
+               docstore=docstore or index.docstore,
+               similarity_top_k=similarity_top_k,
+               lexical_top_k=lexical_top_k,
+               rrf_k=rrf_k,
+               callback_manager=callback_manager,
+           )
+      
        synthesizer: BaseSynthesizer = get_response_synthesizer(
            llm=llm,
            response_mode=response_mode,
@@ -52,12 +79,11 @@ class StandardRetrieverQueryEngineTool(BaseTool):
            verbose=verbose,
        )
       
-       node_postprocessors: Optional[List[BaseNodePostprocessor]] = []
-
+       # run in order on the retrieved nodes before they reach the synthesizer
        query_engine = RetrieverQueryEngine(
            retriever=retriever,
            response_synthesizer=synthesizer,
-           node_postprocessors=node_postprocessors,
+           node_postprocessors=node_postprocessors or [],
            callback_manager=callback_manager,
        )
       
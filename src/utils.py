@@ -2,7 +2,7 @@ from typing import List, Optional
 
 from llama_index.core.base.llms.types import ChatMessage, MessageRole
 
-from src.db_handlers.schemas import Message, MessageCreatorRole
+from src.db_handlers.schemas import Message, MessageCreatorRole, roles_and_texts
 
 
 def convert_db_messages_to_chatbot_messages(
@@ -12,17 +12,17 @@ def convert_db_messages_to_chatbot_messages(
         return None
 
     chatbot_messages = []
-    for db_message in db_messages:
+    for db_role, text in roles_and_texts(db_messages):
         role = None
-        if db_message.role == MessageCreatorRole.USER:
+        if db_role == MessageCreatorRole.USER:
             role = MessageRole.USER
-        elif db_message.role == MessageCreatorRole.ASSISTANT:
+        elif db_role == MessageCreatorRole.ASSISTANT:
             role = MessageRole.ASSISTANT
         else:
-            raise ValueError(f"Unknown role {db_message.role}")
+            raise ValueError(f"Unknown role {db_role}")
         
         chatbot_message = ChatMessage(
-            content=db_message.text,
+            content=text,
             role=role,
         )
         chatbot_messages.append(chatbot_message)
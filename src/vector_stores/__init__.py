@@ -0,0 +1,2 @@
+from src.vector_stores.quantized_vector_store import QuantizedVectorStore, QuantizationType
+from src.vector_stores.ivf_vector_store import IVFVectorStore
@@ -0,0 +1,396 @@
+import os
+import json
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+   BasePydanticVectorStore,
+   VectorStoreQuery,
+   VectorStoreQueryResult,
+)
+
+from src.logger import CustomLogger
+from src.vector_stores.utils import (
+   META_FILENAME,
+   RECORDS_FILENAME,
+   GrowableArray,
+   NodeRecordTable,
+   assign_to_centroids,
+   atomic_save_npy,
+   atomic_write_json,
+   kmeans,
+   normalize_rows,
+   top_k_indices,
+)
+
+
+logger = CustomLogger(__name__)
+
+
+CENTROIDS_FILENAME = "centroids.npy"
+PARTITIONS_DIRNAME = "partitions"
+
+# vectors sampled per centroid when training the coarse quantizer
+TRAINING_SAMPLES_PER_CENTROID = 64
+
+
+class _Partition:
+   """
+   Vectors of one inverted list: the persisted part is memory-mapped from disk the
+   first time it is read, and vectors added since the last persist are held in memory
+   until the next flush.
+   """
+   def __init__(self, dim: int):
+       self.persisted_paths: Optional[Tuple[str, str]] = None
+       self.persisted_vectors: Optional[np.ndarray] = None
+       self.persisted_rows: Optional[np.ndarray] = None
+       self.pending_vectors = GrowableArray(dtype=np.float32, row_shape=(dim,), capacity=64)
+       self.pending_rows = GrowableArray(dtype=np.int64, capacity=64)
+
+   def _map(self) -> None:
+       if self.persisted_paths is not None and self.persisted_rows is None:
+           vectors_path, rows_path = self.persisted_paths
+           self.persisted_vectors = np.load(vectors_path, mmap_mode="r")
+           self.persisted_rows = np.load(rows_path, mmap_mode="r")
+
+   def set_persisted(self, paths: Optional[Tuple[str, str]]) -> None:
+       """Replaces the persisted part with the files at `paths`, mapped when first read."""
+       self.persisted_paths = paths
+       self.persisted_vectors = None
+       self.persisted_rows = None
+
+   def __len__(self) -> int:
+       self._map()
+       persisted = 0 if self.persisted_rows is None else len(self.persisted_rows)
+       return persisted + len(self.pending_rows)
+
+   def chunks(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+       self._map()
+       chunks = []
+       if self.persisted_rows is not None and len(self.persisted_rows):
+           chunks.append((self.persisted_vectors, self.persisted_rows))
+       if len(self.pending_rows):
+           chunks.append((self.pending_vectors.view, self.pending_rows.view))
+       return chunks
+
+
+class IVFVectorStore(BasePydanticVectorStore):
+   """
+   Local inverted-file (IVF) vector store for bots with millions of nodes.
+
+   Vectors are L2-normalised and partitioned by a k-means coarse quantizer of
+   ``nlist`` centroids; each partition lives in its own pair of ``.npy`` files
+   (vectors and record rows) that are memory-mapped only when probed. A query
+   scores the centroids and scans just the ``nprobe`` closest partitions, which
+   can be overridden per query with the ``nprobe`` query kwarg (e.g. through
+   ``index.as_retriever(vector_store_kwargs={"nprobe": 16})``).
+
+   Until ``nlist * 64`` vectors have been added the store is a single flat
+   partition; the centroids are then trained once and every later ``add``
+   (e.g. during a refresh) is assigned incrementally to its nearest partition.
+   """
+
+   stores_text: bool = False
+   persist_dir: str
+   nlist: int = 1024
+   nprobe: int = 16
+   compact_ratio: float = 0.25
+
+   _lock: Any = PrivateAttr()
+   _records: NodeRecordTable = PrivateAttr()
+   _dim: Optional[int] = PrivateAttr()
+   _centroids: Optional[np.ndarray] = PrivateAttr()
+   _partitions: Dict[int, _Partition] = PrivateAttr()
+   _obsolete_partitions: Set[int] = PrivateAttr()
+
+   def __init__(
+       self, persist_dir: str, nlist: int = 1024, nprobe: int = 16, **kwargs: Any
+   ) -> None:
+       super().__init__(persist_dir=persist_dir, nlist=nlist, nprobe=nprobe, **kwargs)
+       self._lock = threading.RLock()
+       self._records = NodeRecordTable()
+       self._dim = None
+       self._centroids = None
+       self._partitions = {}
+       self._obsolete_partitions = set()
+
+       os.makedirs(os.path.join(self.persist_dir, PARTITIONS_DIRNAME), exist_ok=True)
+       self._load()
+
+   @classmethod
+   def class_name(cls) -> str:
+       return "IVFVectorStore"
+
+   @property
+   def client(self) -> Any:
+       return None
+
+   @property
+   def is_trained(self) -> bool:
+       return self._centroids is not None
+
+   def _path(self, filename: str) -> str:
+       return os.path.join(self.persist_dir, filename)
+
+   def _partition_paths(self, partition_id: int) -> Tuple[str, str]:
+       base = os.path.join(self.persist_dir, PARTITIONS_DIRNAME, str(partition_id))
+       return f"{base}.vectors.npy", f"{base}.rows.npy"
+
+   def _load(self) -> None:
+       meta_path = self._path(META_FILENAME)
+       if not os.path.exists(meta_path):
+           return
+
+       with open(meta_path, "r") as f:
+           meta = json.load(f)
+       self._dim = meta["dim"]
+       self._records = NodeRecordTable.load(self._path(RECORDS_FILENAME))
+       if os.path.exists(self._path(CENTROIDS_FILENAME)):
+           self._centroids = np.load(self._path(CENTROIDS_FILENAME))
+
+       for partition_id in meta["partitions"]:
+           partition = _Partition(self._dim)
+           partition.set_persisted(self._partition_paths(partition_id))
+           self._partitions[partition_id] = partition
+
+       logger.info(
+           message="loaded ivf vector store",
+           fields={
+               "persist_dir": self.persist_dir,
+               "num_vectors": len(self._records),
+               "num_partitions": len(self._partitions),
+               "trained": self.is_trained,
+           },
+       )
+
+   def _partition(self, partition_id: int) -> _Partition:
+       partition = self._partitions.get(partition_id)
+       if partition is None:
+           partition = _Partition(self._dim)
+           self._partitions[partition_id] = partition
+       return partition
+
+   def _append_to_partitions(self, vectors: np.ndarray, rows: np.ndarray) -> None:
+       if self.is_trained:
+           assignments = assign_to_centroids(vectors, self._centroids)
+       else:
+           assignments = np.zeros(len(vectors), dtype=np.int64)
+
+       for partition_id in np.unique(assignments):
+           selected = assignments == partition_id
+           partition = self._partition(int(partition_id))
+           partition.pending_vectors.extend(vectors[selected])
+           partition.pending_rows.extend(rows[selected])
+
+   def _all_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+       vectors, rows = [], []
+       for partition in self._partitions.values():
+           for chunk_vectors, chunk_rows in partition.chunks():
+               vectors.append(np.asarray(chunk_vectors))
+               rows.append(np.asarray(chunk_rows))
+       return np.concatenate(vectors), np.concatenate(rows)
+
+   def train(self) -> None:
+       """Train the coarse centroids on the current vectors and re-partition them."""
+       with self._lock:
+           vectors, rows = self._all_vectors()
+           alive = ~self._records.deleted[rows]
+           vectors, rows = vectors[alive], rows[alive]
+
+           rng = np.random.default_rng(0)
+           sample_size = min(len(vectors), self.nlist * TRAINING_SAMPLES_PER_CENTROID)
+           sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+           self._centroids = kmeans(sample, num_clusters=self.nlist)
+
+           old_partition_ids = list(self._partitions)
+           self._partitions = {}
+           self._append_to_partitions(vectors, rows)
+           self._obsolete_partitions.update(old_partition_ids)
+
+           logger.info(
+               message="trained ivf centroids",
+               fields={
+                   "persist_dir": self.persist_dir,
+                   "nlist": self.nlist,
+                   "num_vectors": len(vectors),
+               },
+           )
+
+   def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+       if not nodes:
+           return []
+       return self.add_embeddings(nodes, np.array([node.get_embedding() for node in nodes]))
+
+   def add_embeddings(self, nodes: Sequence[BaseNode], embeddings: np.ndarray) -> List[str]:
+       """Adds `nodes` with the rows of `embeddings`, instead of their `embedding` lists."""
+       if not nodes:
+           return []
+
+       vectors = normalize_rows(embeddings)
+       with self._lock:
+           if self._dim is None:
+               self._dim = vectors.shape[1]
+           elif vectors.shape[1] != self._dim:
+               raise ValueError(f"expected embeddings of dim {self._dim}, got {vectors.shape[1]}")
+
+           rows = np.asarray(self._records.append_nodes(nodes), dtype=np.int64)
+           self._append_to_partitions(vectors, rows)
+
+           if not self.is_trained and self._records.num_alive >= self.nlist * TRAINING_SAMPLES_PER_CENTROID:
+               self.train()
+
+       return [node.node_id for node in nodes]
+
+   def get_embeddings(self, node_ids: Sequence[str]) -> np.ndarray:
+       """Normalised vectors of `node_ids`, in order."""
+       with self._lock:
+           rows = np.asarray(self._records.rows_for_node_ids(node_ids), dtype=np.int64)
+           if len(rows) != len(node_ids):
+               raise KeyError("some nodes are not in the vector store")
+           position_by_row = {int(row): i for i, row in enumerate(rows)}
+           embeddings = np.empty((len(rows), self._dim or 0), dtype=np.float32)
+           for partition in self._partitions.values():
+               for chunk_vectors, chunk_rows in partition.chunks():
+                   selected = np.flatnonzero(np.isin(chunk_rows, rows))
+                   for i in selected:
+                       embeddings[position_by_row[int(chunk_rows[i])]] = chunk_vectors[i]
+           return embeddings
+
+   def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+       with self._lock:
+           self._records.mark_deleted(self._records.rows_for_ref_doc(ref_doc_id))
+
+   def delete_nodes(
+       self, node_ids: Optional[List[str]] = None, filters=None, **delete_kwargs: Any
+   ) -> None:
+       with self._lock:
+           rows = np.flatnonzero(self._records.build_mask(filters=filters, node_ids=node_ids))
+           self._records.mark_deleted(rows)
+
+   def _probe(self, query_vector: np.ndarray, nprobe: int) -> List[int]:
+       if not self.is_trained:
+           return list(self._partitions)
+       # same L2 metric the vectors were assigned with
+       half_norms = 0.5 * np.einsum("ij,ij->i", self._centroids, self._centroids)
+       nearest = top_k_indices(self._centroids @ query_vector - half_norms, nprobe)
+       return [int(partition_id) for partition_id in nearest if partition_id in self._partitions]
+
+   def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+       if query.query_embedding is None:
+           raise ValueError("IVFVectorStore only supports embedding queries")
+
+       nprobe = kwargs.get("nprobe", self.nprobe)
+       query_vector = normalize_rows(np.asarray(query.query_embedding)[None, :])[0]
+
+       with self._lock:
+           if not self._partitions:
+               return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+
+           mask = self._records.build_mask(
+               filters=query.filters, node_ids=query.node_ids, doc_ids=query.doc_ids
+           )
+           candidate_scores, candidate_rows = [], []
+           for partition_id in self._probe(query_vector, nprobe):
+               for vectors, rows in self._partitions[partition_id].chunks():
+                   selected = mask[rows]
+                   if not selected.any():
+                       continue
+                   if not selected.all():
+                       vectors, rows = vectors[selected], rows[selected]
+                   candidate_scores.append(np.asarray(vectors) @ query_vector)
+                   candidate_rows.append(np.asarray(rows))
+
+           if not candidate_rows:
+               return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+
+           scores = np.concatenate(candidate_scores)
+           rows = np.concatenate(candidate_rows)
+           best = top_k_indices(scores, query.similarity_top_k)
+           return VectorStoreQueryResult(
+               nodes=None,
+               similarities=scores[best].tolist(),
+               ids=[self._records.node_ids[row] for row in rows[best]],
+           )
+
+   def _compact(self) -> None:
+       """Drop deleted rows from the records and every partition."""
+       alive = ~self._records.deleted
+       remap = np.full(len(self._records), -1, dtype=np.int64)
+       remap[alive] = np.arange(int(alive.sum()))
+
+       for partition_id, partition in list(self._partitions.items()):
+           vectors, rows = [], []
+           for chunk_vectors, chunk_rows in partition.chunks():
+               keep = alive[chunk_rows]
+               vectors.append(np.asarray(chunk_vectors)[keep])
+               rows.append(remap[np.asarray(chunk_rows)[keep]])
+           partition.set_persisted(None)
+           partition.pending_vectors = GrowableArray.from_array(
+               np.concatenate(vectors) if vectors else np.empty((0, self._dim), dtype=np.float32)
+           )
+           partition.pending_rows = GrowableArray.from_array(
+               np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+           )
+           if len(partition) == 0:
+               self._remove_partition(partition_id)
+       self._records = self._records.compacted()
+
+   def _remove_partition(self, partition_id: int) -> None:
+       # the files stay listed in meta.json until the next persist, which deletes them
+       self._partitions.pop(partition_id, None)
+       self._obsolete_partitions.add(partition_id)
+
+   def persist(self, persist_path: Optional[str] = None, fs: Optional[Any] = None) -> None:
+       """
+       Flush the store to `persist_dir`, rewriting only the partitions that received
+       vectors since the last persist. `persist_path` is ignored.
+       """
+       with self._lock:
+           if self._dim is None:
+               return
+
+           num_deleted = len(self._records) - self._records.num_alive
+           if num_deleted and num_deleted >= self.compact_ratio * len(self._records):
+               self._compact()
+
+           for partition_id, partition in self._partitions.items():
+               if len(partition.pending_rows) == 0:
+                   continue
+               chunks = partition.chunks()
+               vectors = np.concatenate([np.asarray(v) for v, _ in chunks])
+               rows = np.concatenate([np.asarray(r) for _, r in chunks])
+
+               vectors_path, rows_path = self._partition_paths(partition_id)
+               atomic_save_npy(vectors_path, vectors)
+               atomic_save_npy(rows_path, rows)
+               partition.set_persisted((vectors_path, rows_path))
+               partition.pending_vectors = GrowableArray(
+                   dtype=np.float32, row_shape=(self._dim,), capacity=64
+               )
+               partition.pending_rows = GrowableArray(dtype=np.int64, capacity=64)
+
+           if self._centroids is not None:
+               atomic_save_npy(self._path(CENTROIDS_FILENAME), self._centroids)
+           self._records.save(self._path(RECORDS_FILENAME))
+           atomic_write_json(
+               self._path(META_FILENAME),
+               {
+                   "dim": self._dim,
+                   "nlist": self.nlist,
+                   "partitions": sorted(self._partitions),
+               },
+           )
+
+           # only once meta.json no longer lists them
+           for partition_id in self._obsolete_partitions.difference(self._partitions):
+               for path in self._partition_paths(partition_id):
+                   if os.path.exists(path):
+                       os.remove(path)
+           self._obsolete_partitions.clear()
+
+   def partition_sizes(self) -> Dict[int, int]:
+       with self._lock:
+           return {partition_id: len(p) for partition_id, p in self._partitions.items()}
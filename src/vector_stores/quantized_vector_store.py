@@ -0,0 +1,402 @@
+import os
+import json
+import threading
+from enum import Enum
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+   BasePydanticVectorStore,
+   VectorStoreQuery,
+   VectorStoreQueryResult,
+)
+
+from src.logger import CustomLogger
+from src.vector_stores.utils import (
+   META_FILENAME,
+   RECORDS_FILENAME,
+   GrowableArray,
+   NodeRecordTable,
+   assign_to_centroids,
+   atomic_save_npy,
+   atomic_write_json,
+   kmeans,
+   normalize_rows,
+   top_k_indices,
+)
+
+
+logger = CustomLogger(__name__)
+
+
+FULL_VECTORS_FILENAME = "full.f32"
+CODES_FILENAME = "codes.npy"
+SCALES_FILENAME = "scales.npy"
+CODEBOOKS_FILENAME = "pq_codebooks.npy"
+
+PQ_NUM_CENTROIDS = 256
+SCAN_BLOCK_SIZE = 65536
+
+
+class QuantizationType(str, Enum):
+   INT8 = "int8"
+   PQ = "pq"
+
+
+class QuantizedVectorStore(BasePydanticVectorStore):
+   """
+   Local vector store that keeps only compressed codes in memory.
+
+   Every vector is L2-normalised and stored twice: its full-precision float32 copy
+   is appended to a file on disk, and a compressed code is kept in memory. Two
+   compressions are supported:
+
+   - ``int8``: symmetric per-vector scalar quantization (4x smaller than float32).
+   - ``pq``: product quantization with 256 centroids per sub-vector, one byte per
+     sub-vector (e.g. 1536 dims / 96 sub-vectors = 64x smaller). Codebooks are
+     trained once enough vectors have been added; until then search is exact.
+
+   A query scans the codes to pick ``similarity_top_k * rescore_factor`` candidates
+   and re-scores only those against the memory-mapped full-precision vectors, so
+   returned similarities are exact cosine scores.
+
+   Node text is not stored here (``stores_text=False``), the docstore keeps it.
+   """
+
+   stores_text: bool = False
+   persist_dir: str
+   quantization: QuantizationType = QuantizationType.INT8
+   rescore_factor: int = 4
+   pq_subvectors: int = 96
+   pq_min_train_vectors: int = 4096
+   pq_max_train_vectors: int = 65536
+   compact_ratio: float = 0.25
+
+   _lock: Any = PrivateAttr()
+   _records: NodeRecordTable = PrivateAttr()
+   _dim: Optional[int] = PrivateAttr()
+   _codes: Optional[GrowableArray] = PrivateAttr()
+   _scales: Optional[GrowableArray] = PrivateAttr()
+   _codebooks: Optional[np.ndarray] = PrivateAttr()
+   _full_vectors: Optional[np.ndarray] = PrivateAttr()
+
+   def __init__(
+       self,
+       persist_dir: str,
+       quantization: QuantizationType = QuantizationType.INT8,
+       rescore_factor: int = 4,
+       pq_subvectors: int = 96,
+       **kwargs: Any,
+   ) -> None:
+       super().__init__(
+           persist_dir=persist_dir,
+           quantization=quantization,
+           rescore_factor=rescore_factor,
+           pq_subvectors=pq_subvectors,
+           **kwargs,
+       )
+       self._lock = threading.RLock()
+       self._records = NodeRecordTable()
+       self._dim = None
+       self._codes = None
+       self._scales = None
+       self._codebooks = None
+       self._full_vectors = None
+
+       os.makedirs(self.persist_dir, exist_ok=True)
+       self._load()
+
+   @classmethod
+   def class_name(cls) -> str:
+       return "QuantizedVectorStore"
+
+   @property
+   def client(self) -> Any:
+       return None
+
+   def _path(self, filename: str) -> str:
+       return os.path.join(self.persist_dir, filename)
+
+   def _load(self) -> None:
+       meta_path = self._path(META_FILENAME)
+       if not os.path.exists(meta_path):
+           return
+
+       with open(meta_path, "r") as f:
+           meta = json.load(f)
+       if meta["quantization"] != self.quantization.value:
+           raise ValueError(
+               f"store at {self.persist_dir} was built with `{meta['quantization']}` "
+               f"quantization, not `{self.quantization.value}`"
+           )
+
+       self._dim = meta["dim"]
+       self._records = NodeRecordTable.load(self._path(RECORDS_FILENAME))
+       num_vectors = len(self._records)
+
+       # drop vectors appended after the last persist, they have no records
+       full_path = self._path(FULL_VECTORS_FILENAME)
+       expected_size = num_vectors * self._dim * np.dtype(np.float32).itemsize
+       if os.path.getsize(full_path) > expected_size:
+           with open(full_path, "r+b") as f:
+               f.truncate(expected_size)
+
+       if self.quantization == QuantizationType.PQ and os.path.exists(self._path(CODEBOOKS_FILENAME)):
+           self._codebooks = np.load(self._path(CODEBOOKS_FILENAME))
+
+       codes_path = self._path(CODES_FILENAME)
+       if os.path.exists(codes_path) and len(np.load(codes_path, mmap_mode="r")) == num_vectors:
+           self._codes = GrowableArray.from_array(np.load(codes_path))
+           if self.quantization == QuantizationType.INT8:
+               self._scales = GrowableArray.from_array(np.load(self._path(SCALES_FILENAME)))
+       elif num_vectors:
+           logger.warning(
+               message="quantized codes out of date, re-encoding from full vectors",
+               fields={"persist_dir": self.persist_dir, "num_vectors": num_vectors},
+           )
+           self._encode_all()
+
+       logger.info(
+           message="loaded quantized vector store",
+           fields={"persist_dir": self.persist_dir, **self.memory_stats()},
+       )
+
+   def _full_view(self) -> np.ndarray:
+       """Memory-mapped view of the full-precision vectors."""
+       num_vectors = len(self._records)
+       if self._full_vectors is None or len(self._full_vectors) != num_vectors:
+           if num_vectors == 0:
+               return np.empty((0, self._dim or 0), dtype=np.float32)
+           self._full_vectors = np.memmap(
+               self._path(FULL_VECTORS_FILENAME),
+               dtype=np.float32,
+               mode="r",
+               shape=(num_vectors, self._dim),
+           )
+       return self._full_vectors
+
+   def _quantize_int8(self, vectors: np.ndarray):
+       scales = np.abs(vectors).max(axis=1) / 127.0
+       scales[scales == 0] = 1.0
+       codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+       return codes, scales.astype(np.float32)
+
+   def _encode_pq(self, vectors: np.ndarray) -> np.ndarray:
+       sub_dim = self._dim // self.pq_subvectors
+       codes = np.empty((len(vectors), self.pq_subvectors), dtype=np.uint8)
+       for m in range(self.pq_subvectors):
+           sub_vectors = vectors[:, m * sub_dim:(m + 1) * sub_dim]
+           codes[:, m] = assign_to_centroids(sub_vectors, self._codebooks[m])
+       return codes
+
+   def _train_pq(self) -> None:
+       if self._dim % self.pq_subvectors != 0:
+           raise ValueError(
+               f"embedding dim {self._dim} is not divisible by pq_subvectors {self.pq_subvectors}"
+           )
+       full = self._full_view()
+       rng = np.random.default_rng(0)
+       sample_size = min(len(full), self.pq_max_train_vectors)
+       sample = np.asarray(full[np.sort(rng.choice(len(full), sample_size, replace=False))])
+
+       sub_dim = self._dim // self.pq_subvectors
+       self._codebooks = np.stack([
+           kmeans(sample[:, m * sub_dim:(m + 1) * sub_dim], num_clusters=PQ_NUM_CENTROIDS, seed=m)
+           for m in range(self.pq_subvectors)
+       ])
+       logger.info(
+           message="trained product quantization codebooks",
+           fields={"persist_dir": self.persist_dir, "num_train_vectors": sample_size},
+       )
+
+   def _encode_all(self) -> None:
+       """(Re-)build the in-memory codes from the full-precision vectors on disk."""
+       full = self._full_view()
+       self._codes = None
+       self._scales = None
+       if self.quantization == QuantizationType.PQ:
+           if self._codebooks is None:
+               if len(full) < self.pq_min_train_vectors:
+                   return
+               self._train_pq()
+           self._codes = GrowableArray(dtype=np.uint8, row_shape=(self.pq_subvectors,))
+       else:
+           self._codes = GrowableArray(dtype=np.int8, row_shape=(self._dim,))
+           self._scales = GrowableArray(dtype=np.float32)
+
+       for start in range(0, len(full), SCAN_BLOCK_SIZE):
+           self._append_codes(np.asarray(full[start:start + SCAN_BLOCK_SIZE]))
+
+   def _append_codes(self, vectors: np.ndarray) -> None:
+       if self.quantization == QuantizationType.PQ:
+           self._codes.extend(self._encode_pq(vectors))
+       else:
+           codes, scales = self._quantize_int8(vectors)
+           self._codes.extend(codes)
+           self._scales.extend(scales)
+
+   def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+       if not nodes:
+           return []
+       return self.add_embeddings(nodes, np.array([node.get_embedding() for node in nodes]))
+
+   def add_embeddings(self, nodes: Sequence[BaseNode], embeddings: np.ndarray) -> List[str]:
+       """Adds `nodes` with the rows of `embeddings`, instead of their `embedding` lists."""
+       if not nodes:
+           return []
+
+       vectors = normalize_rows(embeddings)
+       with self._lock:
+           if self._dim is None:
+               self._dim = vectors.shape[1]
+           elif vectors.shape[1] != self._dim:
+               raise ValueError(f"expected embeddings of dim {self._dim}, got {vectors.shape[1]}")
+
+           with open(self._path(FULL_VECTORS_FILENAME), "ab") as f:
+               f.write(vectors.tobytes())
+           self._records.append_nodes(nodes)
+
+           if self._codes is not None:
+               self._append_codes(vectors)
+           else:
+               self._encode_all()
+
+       return [node.node_id for node in nodes]
+
+   def get_embeddings(self, node_ids: Sequence[str]) -> np.ndarray:
+       """Normalised full-precision vectors of `node_ids`, in order."""
+       with self._lock:
+           rows = self._records.rows_for_node_ids(node_ids)
+           if len(rows) != len(node_ids):
+               raise KeyError("some nodes are not in the vector store")
+           return np.asarray(self._full_view()[np.asarray(rows, dtype=np.int64)])
+
+   def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+       with self._lock:
+           self._records.mark_deleted(self._records.rows_for_ref_doc(ref_doc_id))
+
+   def delete_nodes(
+       self, node_ids: Optional[List[str]] = None, filters=None, **delete_kwargs: Any
+   ) -> None:
+       with self._lock:
+           rows = np.flatnonzero(self._records.build_mask(filters=filters, node_ids=node_ids))
+           self._records.mark_deleted(rows)
+
+   @staticmethod
+   def _block(array: np.ndarray, rows: np.ndarray, start: int, full_scan: bool) -> np.ndarray:
+       if full_scan:
+           return array[start:start + SCAN_BLOCK_SIZE]
+       return array[rows[start:start + SCAN_BLOCK_SIZE]]
+
+   def _approximate_scores(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+       codes = self._codes.view
+       scores = np.empty(len(rows), dtype=np.float32)
+       # unfiltered queries scan contiguous slices instead of gathering rows
+       full_scan = len(rows) == len(codes)
+       if self.quantization == QuantizationType.PQ:
+           sub_dim = self._dim // self.pq_subvectors
+           # (subvectors, 256) table of partial inner products
+           table = np.einsum(
+               "mkd,md->mk",
+               self._codebooks,
+               query.reshape(self.pq_subvectors, sub_dim),
+           )
+           subvector_index = np.arange(self.pq_subvectors)
+           for start in range(0, len(rows), SCAN_BLOCK_SIZE):
+               block = self._block(codes, rows, start, full_scan)
+               scores[start:start + SCAN_BLOCK_SIZE] = table[subvector_index, block].sum(axis=1)
+       else:
+           scales = self._scales.view
+           for start in range(0, len(rows), SCAN_BLOCK_SIZE):
+               block = self._block(codes, rows, start, full_scan).astype(np.float32)
+               block_scales = self._block(scales, rows, start, full_scan)
+               scores[start:start + SCAN_BLOCK_SIZE] = (block @ query) * block_scales
+       return scores
+
+   def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+       if query.query_embedding is None:
+           raise ValueError("QuantizedVectorStore only supports embedding queries")
+
+       rescore_factor = kwargs.get("rescore_factor", self.rescore_factor)
+       query_vector = normalize_rows(np.asarray(query.query_embedding)[None, :])[0]
+
+       with self._lock:
+           rows = np.flatnonzero(self._records.build_mask(
+               filters=query.filters, node_ids=query.node_ids, doc_ids=query.doc_ids
+           ))
+           if len(rows) == 0:
+               return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+
+           top_k = query.similarity_top_k
+           if self._codes is not None and len(rows) > top_k:
+               approximate = self._approximate_scores(query_vector, rows)
+               rows = rows[top_k_indices(approximate, top_k * rescore_factor)]
+               # sorted row order makes the memmap reads sequential
+               rows = np.sort(rows)
+
+           exact = np.asarray(self._full_view()[rows]) @ query_vector
+           best = top_k_indices(exact, top_k)
+           return VectorStoreQueryResult(
+               nodes=None,
+               similarities=exact[best].tolist(),
+               ids=[self._records.node_ids[row] for row in rows[best]],
+           )
+
+   def memory_stats(self) -> Dict[str, int]:
+       num_vectors = len(self._records)
+       code_bytes = 0
+       if self._codes is not None:
+           code_bytes += self._codes.view.nbytes
+       if self._scales is not None:
+           code_bytes += self._scales.view.nbytes
+       if self._codebooks is not None:
+           code_bytes += self._codebooks.nbytes
+       return {
+           "num_vectors": num_vectors,
+           "in_memory_bytes": code_bytes,
+           "full_precision_bytes": num_vectors * (self._dim or 0) * 4,
+       }
+
+   def _compact(self) -> None:
+       """Rewrite all files without the deleted rows."""
+       alive = np.flatnonzero(~self._records.deleted)
+       full = self._full_view()
+       tmp_path = self._path(FULL_VECTORS_FILENAME + ".tmp")
+       with open(tmp_path, "wb") as f:
+           for start in range(0, len(alive), SCAN_BLOCK_SIZE):
+               f.write(np.asarray(full[alive[start:start + SCAN_BLOCK_SIZE]]).tobytes())
+
+       self._full_vectors = None
+       os.replace(tmp_path, self._path(FULL_VECTORS_FILENAME))
+       if self._codes is not None:
+           self._codes = GrowableArray.from_array(self._codes.view[alive])
+       if self._scales is not None:
+           self._scales = GrowableArray.from_array(self._scales.view[alive])
+       self._records = self._records.compacted()
+
+   def persist(self, persist_path: Optional[str] = None, fs: Optional[Any] = None) -> None:
+       """
+       Flush the store to `persist_dir`. `persist_path` is ignored: the store lives in
+       its own directory and full-precision vectors are already written on `add`.
+       """
+       with self._lock:
+           if self._dim is None:
+               return
+
+           num_deleted = len(self._records) - self._records.num_alive
+           if num_deleted and num_deleted >= self.compact_ratio * len(self._records):
+               self._compact()
+
+           if self._codes is not None:
+               atomic_save_npy(self._path(CODES_FILENAME), self._codes.view)
+           if self._scales is not None:
+               atomic_save_npy(self._path(SCALES_FILENAME), self._scales.view)
+           if self._codebooks is not None:
+               atomic_save_npy(self._path(CODEBOOKS_FILENAME), self._codebooks)
+           self._records.save(self._path(RECORDS_FILENAME))
+           atomic_write_json(
+               self._path(META_FILENAME),
+               {"dim": self._dim, "quantization": self.quantization.value},
+           )
@@ -0,0 +1,342 @@
+import os
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+   FilterCondition,
+   FilterOperator,
+   MetadataFilter,
+   MetadataFilters,
+)
+
+
+RECORDS_FILENAME = "records.jsonl"
+META_FILENAME = "meta.json"
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+   """L2-normalise the rows of `vectors` so that inner product equals cosine similarity."""
+   vectors = np.asarray(vectors, dtype=np.float32)
+   norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+   norms[norms == 0] = 1.0
+   return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+   """Indices of the `k` highest scores, sorted by descending score."""
+   if k >= len(scores):
+       return np.argsort(-scores)
+   top = np.argpartition(-scores, k)[:k]
+   return top[np.argsort(-scores[top])]
+
+
+def assign_to_centroids(
+   vectors: np.ndarray, centroids: np.ndarray, block_size: int = 65536
+) -> np.ndarray:
+   """Index of the nearest (L2) centroid for every row of `vectors`."""
+   # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+   half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+   assignments = np.empty(len(vectors), dtype=np.int64)
+   for start in range(0, len(vectors), block_size):
+       block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+       assignments[start:start + block_size] = np.argmax(block @ centroids.T - half_norms, axis=1)
+   return assignments
+
+
+def kmeans(
+   vectors: np.ndarray, num_clusters: int, num_iters: int = 20, seed: int = 0
+) -> np.ndarray:
+   """Plain Lloyd's k-means; returns the `(num_clusters, dim)` centroids."""
+   rng = np.random.default_rng(seed)
+   vectors = np.asarray(vectors, dtype=np.float32)
+   replace = len(vectors) < num_clusters
+   centroids = vectors[rng.choice(len(vectors), num_clusters, replace=replace)].copy()
+
+   for _ in range(num_iters):
+       assignments = assign_to_centroids(vectors, centroids)
+       counts = np.bincount(assignments, minlength=num_clusters)
+       sums = np.zeros_like(centroids)
+       np.add.at(sums, assignments, vectors)
+
+       non_empty = counts > 0
+       centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+       # re-seed empty clusters from random points so every centroid stays useful
+       num_empty = int((~non_empty).sum())
+       if num_empty:
+           centroids[~non_empty] = vectors[rng.choice(len(vectors), num_empty)]
+   return centroids
+
+
+def atomic_write_json(path: str, obj: Any) -> None:
+   tmp_path = f"{path}.tmp"
+   with open(tmp_path, "w") as f:
+       json.dump(obj, f)
+   os.replace(tmp_path, path)
+
+
+def atomic_save_npy(path: str, array: np.ndarray) -> None:
+   tmp_path = f"{path}.tmp"
+   with open(tmp_path, "wb") as f:
+       np.save(f, array)
+   os.replace(tmp_path, path)
+
+
+class GrowableArray:
+   """
+   Append-only numpy buffer with amortised O(1) appends. `view` returns the filled
+   part of the buffer without copying.
+   """
+   def __init__(self, dtype: Any, row_shape: tuple = (), capacity: int = 1024):
+       self._dtype = np.dtype(dtype)
+       self._row_shape = tuple(row_shape)
+       self._buffer = np.empty((capacity, *self._row_shape), dtype=self._dtype)
+       self._size = 0
+
+   @classmethod
+   def from_array(cls, array: np.ndarray) -> "GrowableArray":
+       grow = cls(dtype=array.dtype, row_shape=array.shape[1:], capacity=max(len(array), 1024))
+       grow.extend(array)
+       return grow
+
+   def __len__(self) -> int:
+       return self._size
+
+   @property
+   def view(self) -> np.ndarray:
+       return self._buffer[:self._size]
+
+   def extend(self, rows: np.ndarray) -> None:
+       rows = np.asarray(rows, dtype=self._dtype)
+       required = self._size + len(rows)
+       if required > len(self._buffer):
+           capacity = max(required, 2 * len(self._buffer))
+           buffer = np.empty((capacity, *self._row_shape), dtype=self._dtype)
+           buffer[:self._size] = self._buffer[:self._size]
+           self._buffer = buffer
+       self._buffer[self._size:required] = rows
+       self._size = required
+
+
+class EncodedColumn:
+   """
+   Dictionary-encoded column: one int32 code per row in a growable array and the
+   distinct values the codes stand for. Filters compare codes in numpy and evaluate
+   range comparisons once per distinct value, e.g. once per index id of a bot.
+   """
+   def __init__(self, values: Iterable[Any] = ()):
+       self.values: List[Any] = []
+       self._code_by_value: Dict[Any, int] = {}
+       self._codes = GrowableArray(dtype=np.int32)
+       self._codes.extend(np.fromiter((self._code(value) for value in values), dtype=np.int32))
+
+   @property
+   def codes(self) -> np.ndarray:
+       return self._codes.view
+
+   def _code(self, value: Any) -> int:
+       code = self._code_by_value.get(value)
+       if code is None:
+           code = self._code_by_value[value] = len(self.values)
+           self.values.append(value)
+       return code
+
+   def append(self, value: Any) -> None:
+       self._codes.extend(np.full(1, self._code(value), dtype=np.int32))
+
+   def isin(self, values: Iterable[Any]) -> np.ndarray:
+       codes = [self._code_by_value[value] for value in values if value in self._code_by_value]
+       return np.isin(self.codes, np.asarray(codes, dtype=np.int32))
+
+   def where(self, predicate: Callable[[Any], bool]) -> np.ndarray:
+       matching = np.fromiter(
+           (predicate(value) for value in self.values), dtype=np.bool_, count=len(self.values)
+       )
+       return matching[self.codes]
+
+
+class NodeRecordTable:
+   """
+   Row-oriented table of the node id, ref doc id and flat metadata of every vector
+   kept by a local vector store. Row numbers are the positions of the vectors in the
+   store's arrays, and deleted rows are tombstoned until the store is compacted.
+   Metadata filters are evaluated here, so the docstore is never touched at query time:
+   the first filter on a key encodes its column, and appends keep it up to date.
+   """
+   def __init__(self):
+       self.node_ids: List[str] = []
+       self.ref_doc_ids: List[Optional[str]] = []
+       self.metadata: List[Dict[str, Any]] = []
+       self._deleted = GrowableArray(dtype=np.bool_)
+       self._row_by_node_id: Dict[str, int] = {}
+       self._rows_by_ref_doc_id: Dict[str, List[int]] = {}
+       self._columns: Dict[str, EncodedColumn] = {}
+       self._ref_doc_column: Optional[EncodedColumn] = None
+
+   def __len__(self) -> int:
+       return len(self.node_ids)
+
+   @property
+   def num_alive(self) -> int:
+       return len(self) - int(self._deleted.view.sum())
+
+   @property
+   def deleted(self) -> np.ndarray:
+       return self._deleted.view
+
+   def append(self, node_id: str, ref_doc_id: Optional[str], metadata: Dict[str, Any]) -> int:
+       row = len(self.node_ids)
+       previous_row = self._row_by_node_id.get(node_id)
+       if previous_row is not None:
+           # re-inserting a node replaces its previous vector
+           self.mark_deleted([previous_row])
+
+       self.node_ids.append(node_id)
+       self.ref_doc_ids.append(ref_doc_id)
+       self.metadata.append(metadata)
+       self._deleted.extend(np.zeros(1, dtype=np.bool_))
+       self._row_by_node_id[node_id] = row
+       if ref_doc_id is not None:
+           self._rows_by_ref_doc_id.setdefault(ref_doc_id, []).append(row)
+       for key, column in self._columns.items():
+           column.append(metadata.get(key))
+       if self._ref_doc_column is not None:
+           self._ref_doc_column.append(ref_doc_id)
+       return row
+
+   def append_nodes(self, nodes: Iterable[BaseNode]) -> List[int]:
+       return [
+           self.append(
+               node_id=node.node_id,
+               ref_doc_id=node.ref_doc_id,
+               metadata=flat_metadata(node.metadata),
+           )
+           for node in nodes
+       ]
+
+   def mark_deleted(self, rows: Iterable[int]) -> None:
+       for row in rows:
+           self._deleted.view[row] = True
+           if self._row_by_node_id.get(self.node_ids[row]) == row:
+               self._row_by_node_id.pop(self.node_ids[row])
+
+   def rows_for_ref_doc(self, ref_doc_id: str) -> List[int]:
+       rows = self._rows_by_ref_doc_id.pop(ref_doc_id, [])
+       return [row for row in rows if not self._deleted.view[row]]
+
+   def rows_for_node_ids(self, node_ids: Iterable[str]) -> List[int]:
+       return [
+           self._row_by_node_id[node_id]
+           for node_id in node_ids if node_id in self._row_by_node_id
+       ]
+
+   def build_mask(
+       self,
+       filters: Optional[MetadataFilters] = None,
+       node_ids: Optional[List[str]] = None,
+       doc_ids: Optional[List[str]] = None,
+   ) -> np.ndarray:
+       """Boolean mask over all rows: alive and matching every given restriction."""
+       mask = ~self._deleted.view.copy()
+       if filters is not None and filters.filters:
+           mask &= self._eval_filters(filters)
+       if node_ids is not None:
+           node_mask = np.zeros(len(self), dtype=np.bool_)
+           node_mask[self.rows_for_node_ids(node_ids)] = True
+           mask &= node_mask
+       if doc_ids is not None:
+           if self._ref_doc_column is None:
+               self._ref_doc_column = EncodedColumn(self.ref_doc_ids)
+           mask &= self._ref_doc_column.isin(doc_ids)
+       return mask
+
+   def _column(self, key: str) -> EncodedColumn:
+       column = self._columns.get(key)
+       if column is None:
+           column = self._columns[key] = EncodedColumn(
+               metadata.get(key) for metadata in self.metadata
+           )
+       return column
+
+   def _eval_filters(self, filters: MetadataFilters) -> np.ndarray:
+       masks = []
+       for metadata_filter in filters.filters:
+           if isinstance(metadata_filter, MetadataFilters):
+               masks.append(self._eval_filters(metadata_filter))
+           else:
+               masks.append(self._eval_filter(metadata_filter))
+
+       if filters.condition == FilterCondition.OR:
+           return np.logical_or.reduce(masks)
+       return np.logical_and.reduce(masks)
+
+   def _eval_filter(self, metadata_filter: MetadataFilter) -> np.ndarray:
+       column = self._column(metadata_filter.key)
+       value = metadata_filter.value
+       operator = metadata_filter.operator
+
+       if operator == FilterOperator.EQ:
+           return column.isin([value])
+       if operator == FilterOperator.NE:
+           return ~column.isin([value])
+       if operator in (FilterOperator.IN, FilterOperator.NIN):
+           matches = column.isin(value)
+           return matches if operator == FilterOperator.IN else ~matches
+
+       compare = {
+           FilterOperator.GT: lambda v: v is not None and v > value,
+           FilterOperator.GTE: lambda v: v is not None and v >= value,
+           FilterOperator.LT: lambda v: v is not None and v < value,
+           FilterOperator.LTE: lambda v: v is not None and v <= value,
+       }.get(operator)
+       if compare is None:
+           raise NotImplementedError(f"Filter operator {operator} not supported")
+       return column.where(compare)
+
+   def compacted(self) -> "NodeRecordTable":
+       """A copy of the table without the tombstoned rows."""
+       table = NodeRecordTable()
+       for row in np.flatnonzero(~self._deleted.view):
+           table.append(self.node_ids[row], self.ref_doc_ids[row], self.metadata[row])
+       return table
+
+   def save(self, path: str) -> None:
+       tmp_path = f"{path}.tmp"
+       with open(tmp_path, "w") as f:
+           for row, node_id in enumerate(self.node_ids):
+               record = {
+                   "node_id": node_id,
+                   "ref_doc_id": self.ref_doc_ids[row],
+                   "metadata": self.metadata[row],
+                   "deleted": bool(self._deleted.view[row]),
+               }
+               f.write(json.dumps(record) + "\n")
+       os.replace(tmp_path, path)
+
+   @classmethod
+   def load(cls, path: str) -> "NodeRecordTable":
+       table = cls()
+       if not os.path.exists(path):
+           return table
+
+       deleted_rows = []
+       with open(path, "r") as f:
+           for line in f:
+               record = json.loads(line)
+               row = table.append(record["node_id"], record["ref_doc_id"], record["metadata"])
+               if record["deleted"]:
+                   deleted_rows.append(row)
+       table.mark_deleted(deleted_rows)
+       for ref_doc_id in {table.ref_doc_ids[row] for row in deleted_rows}:
+           if ref_doc_id is not None:
+               table._rows_by_ref_doc_id[ref_doc_id] = table.rows_for_ref_doc(ref_doc_id)
+       return table
+
+
+def flat_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+   """Keep only the scalar metadata values, which are the ones filters can match on."""
+   return {
+       key: value for key, value in metadata.items()
+       if value is None or isinstance(value, (str, int, float, bool))
+   }